@@ -1,5 +1,5 @@
 import time
-from uagents import Agent, Context, Model
+import threading
 from typing import List, Dict
 from xrpl.transaction import submit_and_wait
 from xrpl.models.transactions.nftoken_mint import NFTokenMint, NFTokenMintFlag
@@ -55,12 +55,22 @@ class XRPLHelper:
 
 
 
-xrpl_helper = XRPLHelper()  # Initialize with empty seed for test account
+# Creating the helper requests a faucet wallet over the network, so it is
+# done on first use instead of at import time.
+xrpl_helper = None
+xrpl_helper_lock = threading.Lock()
+
+def get_xrpl_helper():
+    global xrpl_helper
+    with xrpl_helper_lock:
+        if xrpl_helper is None:
+            xrpl_helper = XRPLHelper()  # Initialize with empty seed for test account
+    return xrpl_helper
 
 def put_on_blockchain(urls):
     nft_ids = []
     for url in urls:
-        mint_success, result = xrpl_helper.mint_nft(url)
+        mint_success, result = get_xrpl_helper().mint_nft(url)
         if mint_success:
             nft_ids.append(result)
         else:
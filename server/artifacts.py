@@ -0,0 +1,234 @@
+"""
+Local, checksummed store of the model artifacts the server loads at startup.
+
+    python artifacts.py fetch     # download and convert everything (needs network)
+    python artifacts.py verify    # recompute and compare checksums
+
+Once fetched, the server loads from MODEL_STORE_DIR without network access.
+SAM weights are stored as a torch state dict and loaded with mmap=True and
+assigned to the model without a copy, so the pages come from the page cache:
+they are read on demand and shared by every process that loads the same file.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+MODEL_STORE_DIR = os.getenv("MODEL_STORE_DIR", "model_store")
+# With MODEL_STORE_OFFLINE=1 a missing artifact is an error instead of a download
+MODEL_STORE_OFFLINE = os.getenv("MODEL_STORE_OFFLINE", "0") == "1"
+# "size" compares file sizes at startup, "full" also recomputes the sha256
+MODEL_STORE_VERIFY = os.getenv("MODEL_STORE_VERIFY", "size")
+
+MANIFEST = "manifest.json"
+CHROMA_ONNX_MODEL = "all-MiniLM-L6-v2"
+
+load_times = {}
+load_times_lock = threading.Lock()
+
+if MODEL_STORE_OFFLINE:
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+
+class ArtifactError(Exception):
+    """Raised when an artifact is missing or does not match its checksum."""
+
+
+@contextmanager
+def timed_load(name):
+    """Record how long loading an artifact took for the startup report."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        with load_times_lock:
+            load_times[name] = round(time.perf_counter() - started, 3)
+        print(f"Loaded {name} in {load_times[name]}s")
+
+
+def load_report():
+    """Return the load time in seconds of every artifact loaded so far."""
+    with load_times_lock:
+        return dict(load_times)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_path(*parts):
+    return os.path.join(MODEL_STORE_DIR, *parts)
+
+
+def read_manifest():
+    try:
+        with open(store_path(MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest):
+    os.makedirs(MODEL_STORE_DIR, exist_ok=True)
+    temp_path = store_path(MANIFEST + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, store_path(MANIFEST))
+
+
+def record(manifest, name, directory):
+    """Checksum every file of an artifact directory into the manifest."""
+    files = {}
+    root = store_path(directory)
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files[os.path.relpath(path, root)] = {'sha256': sha256_file(path), 'size': os.path.getsize(path)}
+    manifest[name] = {'directory': directory, 'files': files}
+
+
+def verify(name, mode=MODEL_STORE_VERIFY):
+    """
+    Check a stored artifact against the manifest.
+
+    Returns:
+        str or None: The artifact's directory, or None if it is not in the store.
+
+    Raises:
+        ArtifactError: If a file is missing or does not match.
+    """
+    entry = read_manifest().get(name)
+    if entry is None:
+        return None
+
+    root = store_path(entry['directory'])
+    for relative_path, expected in entry['files'].items():
+        path = os.path.join(root, relative_path)
+        if not os.path.exists(path) or os.path.getsize(path) != expected['size']:
+            raise ArtifactError(f"Artifact {name} is missing or truncated: {relative_path}")
+        if mode == 'full' and sha256_file(path) != expected['sha256']:
+            raise ArtifactError(f"Artifact {name} failed its checksum: {relative_path}")
+    return root
+
+
+def locate(name):
+    """Return the verified store directory of an artifact, or None to fetch it from the network."""
+    root = verify(name)
+    if root is None and MODEL_STORE_OFFLINE:
+        raise ArtifactError(f"Artifact {name} is not in {MODEL_STORE_DIR} and MODEL_STORE_OFFLINE is set")
+    return root
+
+
+def artifact_dir(name):
+    return name.replace('/', '--')
+
+
+def yolo_path(path):
+    """Return the stored copy of a YOLO model if there is one, else the path itself."""
+    root = locate(os.path.basename(path))
+    return os.path.join(root, os.path.basename(path)) if root else path
+
+
+def load_sam_model(name):
+    """
+    Load a SAM model and processor, memory-mapping the stored weights.
+
+    Returns:
+        (SamModel, SamProcessor)
+    """
+    import torch
+    from transformers import SamConfig, SamModel, SamProcessor
+
+    root = locate(name)
+    if root is None:
+        with timed_load(name):
+            return SamModel.from_pretrained(name), SamProcessor.from_pretrained(name)
+
+    with timed_load(name):
+        config = SamConfig.from_pretrained(root)
+        # build the module structure without allocating or initialising weights
+        with torch.device("meta"):
+            model = SamModel(config)
+        state_dict = torch.load(os.path.join(root, "weights.pt"), mmap=True, weights_only=True)
+        model.load_state_dict(state_dict, assign=True)
+
+        if any(tensor.is_meta for tensor in list(model.parameters()) + list(model.buffers())):
+            print(f"Stored weights of {name} do not cover every tensor, loading normally")
+            model = SamModel.from_pretrained(root)
+
+        return model.eval(), SamProcessor.from_pretrained(root)
+
+
+def configure_chroma_embedding():
+    """Point chroma's default ONNX embedding model at the store if it is there."""
+    from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+    root = locate(CHROMA_ONNX_MODEL)
+    if root is not None:
+        ONNXMiniLM_L6_V2.DOWNLOAD_PATH = root
+
+
+def fetch_yolo(manifest, path):
+    from ultralytics import YOLO
+
+    name = os.path.basename(path)
+    directory = artifact_dir(name)
+    os.makedirs(store_path(directory), exist_ok=True)
+    model = YOLO(path)  # downloads the checkpoint if needed
+    shutil.copy(model.ckpt_path or path, store_path(directory, name))
+    record(manifest, name, directory)
+
+
+def fetch_sam(manifest, name):
+    import torch
+    from transformers import SamModel, SamProcessor
+
+    directory = artifact_dir(name)
+    root = store_path(directory)
+    model = SamModel.from_pretrained(name)
+    model.config.save_pretrained(root)
+    SamProcessor.from_pretrained(name).save_pretrained(root)
+    torch.save(model.state_dict(), os.path.join(root, "weights.pt"))
+    record(manifest, name, directory)
+
+
+def fetch_chroma_embedding(manifest):
+    from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+    directory = artifact_dir(CHROMA_ONNX_MODEL)
+    ONNXMiniLM_L6_V2.DOWNLOAD_PATH = store_path(directory)
+    ONNXMiniLM_L6_V2()(["test"])  # downloads and extracts the model
+    record(manifest, CHROMA_ONNX_MODEL, directory)
+
+
+def fetch():
+    """Download every artifact the server uses into the store."""
+    import backends
+
+    manifest = read_manifest()
+    fetch_yolo(manifest, backends.DETECTION_MODEL)
+    fetch_sam(manifest, backends.SAM_MODEL_NAME)
+    fetch_chroma_embedding(manifest)
+    write_manifest(manifest)
+    print(f"Stored {', '.join(sorted(manifest))} in {MODEL_STORE_DIR}")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+    if command == 'fetch':
+        fetch()
+    elif command == 'verify':
+        for name in read_manifest():
+            verify(name, mode='full')
+            print(f"{name}: ok")
+    else:
+        raise SystemExit(__doc__)
@@ -0,0 +1,178 @@
+"""
+Configurable inference backends for detection and segmentation.
+
+Detection runs through ultralytics, which picks the runtime from the model
+path: a .pt checkpoint runs in PyTorch, a .onnx file in ONNX Runtime and an
+*_openvino_model/ directory in OpenVINO (see export_yolo).
+
+Segmentation keeps SAM's prompt encoder and mask decoder in PyTorch, since
+they are cheap, and lets the expensive image encoder run on:
+- torch: the PyTorch vision encoder (SAM_QUANTIZE=int8 applies dynamic int8 quantization)
+- onnx: an exported encoder graph in ONNX Runtime (SAM_QUANTIZE=int8 quantizes the graph)
+- openvino: the exported encoder graph compiled by OpenVINO for the CPU
+SAM_MODEL_NAME picks the model family, e.g. facebook/sam-vit-base or a SlimSAM checkpoint.
+"""
+import os
+import re
+
+import numpy as np
+import torch
+
+import artifacts
+
+DETECTION_MODEL = os.getenv("DETECTION_MODEL", "yolov8n.pt")
+SAM_MODEL_NAME = os.getenv("SAM_MODEL_NAME", "facebook/sam-vit-huge")
+SAM_BACKEND = os.getenv("SAM_BACKEND", "torch")
+SAM_QUANTIZE = os.getenv("SAM_QUANTIZE", "none")
+SAM_EXPORT_DIR = os.getenv("SAM_EXPORT_DIR", "exported_models")
+
+SAM_BACKENDS = ("torch", "onnx", "openvino")
+
+
+def model_tag(*parts):
+    """Filesystem safe identifier of a model configuration."""
+    return re.sub(r'[^0-9A-Za-z.]+', '_', '-'.join(parts)).strip('_')
+
+
+class TorchEncoder:
+    """Runs SAM's image encoder in PyTorch, optionally dynamically quantized to int8."""
+
+    def __init__(self, model, device, quantize="none"):
+        self.model = model
+        self.device = device
+        if quantize == "int8":
+            model.vision_encoder = torch.ao.quantization.quantize_dynamic(
+                model.vision_encoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def __call__(self, pixel_values):
+        with torch.no_grad():
+            return self.model.get_image_embeddings(pixel_values.to(self.device))
+
+
+class VisionEncoderGraph(torch.nn.Module):
+    """Wraps SAM's vision encoder so it exports as pixel_values -> image_embeddings."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_encoder = model.vision_encoder
+
+    def forward(self, pixel_values):
+        return self.vision_encoder(pixel_values)[0]
+
+
+def export_sam_encoder(model, path, quantize="none"):
+    """
+    Export SAM's image encoder to an ONNX graph, optionally int8 quantized.
+
+    Args:
+        model (SamModel): The loaded PyTorch model.
+        path (str): Where to write the .onnx file.
+        quantize (str): "int8" to quantize the exported weights with ONNX Runtime.
+
+    Returns:
+        str: Path of the exported graph.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    float_path = path if quantize != "int8" else path.replace('.onnx', '.fp32.onnx')
+
+    if not os.path.exists(float_path):
+        print(f"Exporting SAM image encoder to {float_path}...")
+        dummy = torch.zeros(1, 3, 1024, 1024)
+        torch.onnx.export(
+            VisionEncoderGraph(model.cpu()).eval(),
+            dummy,
+            float_path,
+            input_names=["pixel_values"],
+            output_names=["image_embeddings"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeddings": {0: "batch"}},
+            opset_version=17,
+        )
+
+    if quantize == "int8" and not os.path.exists(path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"Quantizing SAM image encoder to {path}...")
+        quantize_dynamic(float_path, path, weight_type=QuantType.QUInt8)
+
+    return path
+
+
+class OnnxEncoder:
+    """Runs an exported SAM image encoder graph in ONNX Runtime."""
+
+    def __init__(self, path, device):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("SAM_BACKEND=onnx requires the onnxruntime package.")
+
+        self.device = device
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values):
+        embeddings = self.session.run(None, {"pixel_values": pixel_values.cpu().numpy().astype(np.float32)})[0]
+        return torch.from_numpy(embeddings).to(self.device)
+
+
+class OpenVINOEncoder:
+    """Runs an exported SAM image encoder graph with OpenVINO on the CPU."""
+
+    def __init__(self, path, device):
+        try:
+            import openvino
+        except ImportError:
+            raise ImportError("SAM_BACKEND=openvino requires the openvino package.")
+
+        self.device = device
+        self.model = openvino.Core().compile_model(path, "CPU")
+
+    def __call__(self, pixel_values):
+        embeddings = self.model(pixel_values.cpu().numpy().astype(np.float32))[0]
+        return torch.from_numpy(np.asarray(embeddings)).to(self.device)
+
+
+def load_sam(device, name=SAM_MODEL_NAME, backend=SAM_BACKEND, quantize=SAM_QUANTIZE):
+    """
+    Load a SAM model, its processor and the configured image encoder backend.
+
+    Returns:
+        (SamModel, SamProcessor, callable, str): The model, the processor, an
+        encoder mapping pixel_values to image embeddings, and a tag naming the
+        configuration (embeddings from different tags are not interchangeable).
+    """
+    if backend not in SAM_BACKENDS:
+        raise ValueError(f"Unknown SAM_BACKEND {backend}, expected one of {SAM_BACKENDS}")
+
+    model, processor = artifacts.load_sam_model(name)
+    tag = model_tag(name, backend, quantize)
+
+    if backend == "torch":
+        model = model.to(device)
+        encoder = TorchEncoder(model, device, quantize)
+    else:
+        path = export_sam_encoder(model, os.path.join(SAM_EXPORT_DIR, f"{tag}.onnx"), quantize)
+        model = model.to(device)
+        encoder = OnnxEncoder(path, device) if backend == "onnx" else OpenVINOEncoder(path, device)
+
+    return model, processor, encoder, tag
+
+
+def load_yolo(path=DETECTION_MODEL):
+    """Load a YOLO model, from the artifact store when it is there; ultralytics picks the runtime from the file type."""
+    from ultralytics import YOLO
+
+    with artifacts.timed_load(path):
+        return YOLO(artifacts.yolo_path(path), task="detect")
+
+
+def export_yolo(path=DETECTION_MODEL, format="onnx", int8=False):
+    """
+    Export a YOLO checkpoint for ONNX Runtime or OpenVINO.
+
+    Returns:
+        str: Path to pass as DETECTION_MODEL.
+    """
+    from ultralytics import YOLO
+
+    return YOLO(path).export(format=format, int8=int8)
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+
+class MicroBatcher:
+    """
+    Collects requests from many threads and runs them together as one batch.
+
+    A worker thread waits for the first pending request, then keeps collecting
+    for up to `max_wait_ms` or until `max_batch_size` requests are pending, runs
+    `run_batch` on all of them at once and hands each caller its own result.
+
+    Args:
+        run_batch (callable): Takes a list of requests, returns a list of results in the same order.
+        max_batch_size (int): Largest batch sent to `run_batch`.
+        max_wait_ms (float): How long the first request of a batch may wait for company.
+        name (str): Name used for the worker thread and in the statistics.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait_ms=10, name="batcher"):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self.name = name
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.batch_sizes = Counter()
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.loop, name=self.name, daemon=True)
+                self.worker.start()
+
+    def submit(self, request):
+        """Queue a request and return a Future for its result."""
+        self.start()
+        future = Future()
+        self.queue.put((request, future, time.perf_counter()))
+        return future
+
+    def __call__(self, request):
+        """Queue a request and block until its result is ready."""
+        return self.submit(request).result()
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            requests = [request for request, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                results = self.run_batch(requests)
+                if len(results) != len(requests):
+                    raise RuntimeError(f"{self.name} returned {len(results)} results for {len(requests)} requests")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                results = None
+            finished = time.perf_counter()
+
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.items += len(batch)
+                self.busy_seconds += finished - started
+                self.wait_seconds += sum(started - queued for _, _, queued in batch)
+
+            if results is not None:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+    def stats(self):
+        """Return batch-size and timing statistics collected so far."""
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                'name': self.name,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': batches,
+                'items': self.items,
+                'mean_batch_size': round(self.items / batches, 3) if batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'mean_queue_wait_ms': round(1000 * self.wait_seconds / self.items, 3) if self.items else 0.0,
+                'mean_batch_ms': round(1000 * self.busy_seconds / batches, 3) if batches else 0.0,
+                'pending': self.queue.qsize(),
+            }
@@ -0,0 +1,148 @@
+"""
+Compare inference backends against the PyTorch YOLOv8n + SAM ViT-H baseline.
+
+For every SAM configuration the baseline YOLO boxes are segmented again and
+the masks compared with the ViT-H masks (mean IoU); for every detector the
+boxes are compared with the baseline boxes (recall at IoU 0.5). Tiled
+detection configurations (see tiling.py) run the baseline detector on
+overlapping tiles and report the same recall plus how many boxes they find.
+Latency is the mean wall time per image after one warm-up image.
+
+    python benchmark_backends.py --images ../images \
+        --sam torch:facebook/sam-vit-base:none onnx:facebook/sam-vit-huge:int8 \
+        --detectors yolov8n.onnx --tiles 640:0.2 960:0.2
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import supervision as sv
+import torch
+from PIL import Image
+
+import backends
+import tiling
+from masks import mask_iou, upsample_masks
+
+BASELINE_SAM = "torch:facebook/sam-vit-huge:none"
+BASELINE_DETECTOR = "yolov8n.pt"
+
+
+def load_images(directory):
+    paths = sorted(glob.glob(os.path.join(directory, "*.jpg")) + glob.glob(os.path.join(directory, "*.png")))
+    return [(os.path.basename(path), Image.open(path).convert("RGB")) for path in paths]
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def detect(model, image):
+    # same settings as predict.detect_objects, without importing predict and its models
+    results = sv.Detections.from_ultralytics(model(image, conf=0.01)[0]).with_nms(threshold=0.05, class_agnostic=True)
+    return [result[0].tolist() for result in results]
+
+
+def detect_tiles(model, image, tile_size, overlap):
+    detections = tiling.detect_tiled(model, [image], nms_threshold=0.05, conf=0.01, mode="on", tile_size=tile_size, overlap=overlap)[0]
+    return [box.tolist() for box in detections.xyxy]
+
+
+def segment(model, processor, encoder, image, bboxes):
+    """Segment the boxes on an image with a loaded SAM configuration."""
+    if not bboxes:
+        return []
+    inputs = processor(image, input_boxes=[bboxes], return_tensors="pt")
+    pixel_values = inputs.pop("pixel_values")
+    with torch.no_grad():
+        inputs["image_embeddings"] = encoder(pixel_values)
+        outputs = model(**inputs, multimask_output=False)
+    pad_size = processor.image_processor.pad_size
+    return upsample_masks(
+        outputs.pred_masks[0, :, 0].cpu().numpy(),
+        tuple(inputs["original_sizes"][0].tolist()),
+        tuple(inputs["reshaped_input_sizes"][0].tolist()),
+        (pad_size["height"], pad_size["width"]),
+    )
+
+
+def box_iou(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def box_recall(reference, candidate, threshold=0.5):
+    if not reference:
+        return 1.0
+    matched = sum(1 for box in reference if any(box_iou(box, other) >= threshold for other in candidate))
+    return matched / len(reference)
+
+
+def run_sam(config, images, bboxes):
+    backend, name, quantize = config.split(":")
+    model, processor, encoder, tag = backends.load_sam(torch.device("cpu"), name, backend, quantize)
+    masks, seconds = [], []
+    for (_, image), boxes in zip(images, bboxes):
+        result, elapsed = timed(segment, model, processor, encoder, image, boxes)
+        masks.append(result)
+        seconds.append(elapsed)
+    return tag, masks, seconds
+
+
+def mean_latency(seconds):
+    # the first image warms up caches and lazy initialisation
+    seconds = seconds[1:] or seconds
+    return 1000 * sum(seconds) / len(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(__file__), "..", "images"))
+    parser.add_argument("--sam", nargs="*", default=[], help="backend:model_name:quantize configurations")
+    parser.add_argument("--detectors", nargs="*", default=[], help="YOLO model paths (.pt, .onnx, *_openvino_model)")
+    parser.add_argument("--tiles", nargs="*", default=[], help="tile_size:overlap tiled detection configurations")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        raise SystemExit(f"No images found in {args.images}")
+
+    print(f"Baseline {BASELINE_DETECTOR} + {BASELINE_SAM} on {len(images)} images")
+    yolo = backends.load_yolo(BASELINE_DETECTOR)
+    baseline_boxes, detector_seconds = [], []
+    for _, image in images:
+        boxes, elapsed = timed(detect, yolo, image)
+        baseline_boxes.append(boxes)
+        detector_seconds.append(elapsed)
+    baseline_tag, baseline_masks, baseline_seconds = run_sam(BASELINE_SAM, images, baseline_boxes)
+
+    print(f"\n{'detector':40} {'ms/image':>10} {'box recall':>11} {'boxes':>7}")
+    print(f"{BASELINE_DETECTOR:40} {mean_latency(detector_seconds):10.1f} {1.0:11.3f} {sum(map(len, baseline_boxes)):7}")
+    for path in args.detectors:
+        model = backends.load_yolo(path)
+        boxes, seconds = zip(*(timed(detect, model, image) for _, image in images))
+        recall = np.mean([box_recall(reference, candidate) for reference, candidate in zip(baseline_boxes, boxes)])
+        print(f"{path:40} {mean_latency(seconds):10.1f} {recall:11.3f} {sum(map(len, boxes)):7}")
+    for config in args.tiles:
+        tile_size, overlap = config.split(":")
+        boxes, seconds = zip(*(timed(detect_tiles, yolo, image, int(tile_size), float(overlap)) for _, image in images))
+        recall = np.mean([box_recall(reference, candidate) for reference, candidate in zip(baseline_boxes, boxes)])
+        print(f"{'tiled ' + config:40} {mean_latency(seconds):10.1f} {recall:11.3f} {sum(map(len, boxes)):7}")
+
+    print(f"\n{'segmentation':40} {'ms/image':>10} {'mask IoU':>11}")
+    print(f"{baseline_tag:40} {mean_latency(baseline_seconds):10.1f} {1.0:11.3f}")
+    for config in args.sam:
+        tag, masks, seconds = run_sam(config, images, baseline_boxes)
+        ious = [mask_iou(a, b) for reference, candidate in zip(baseline_masks, masks) for a, b in zip(reference, candidate)]
+        print(f"{tag:40} {mean_latency(seconds):10.1f} {np.mean(ious) if ious else 1.0:11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare stitching configurations against the previous full pipeline
+(SIFT, every pair matched, registration at 0.6 MP, full resolution output).
+
+Every configuration stitches the same keyframes. Quality is reported as the
+share of keyframes that made it into the panorama, the panorama size
+relative to the baseline, and the normalized cross-correlation of the
+grayscale panorama with the baseline one after resizing it to the same size.
+
+    python benchmark_stitching.py --video ../test3.mp4 \
+        --configs sift:0.6:4 orb:0.3:4 akaze:0.3:4 sift:0.15:4
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+import stitcher
+
+BASELINE = "sift:0.6:-1"
+
+
+def similarity(reference, candidate):
+    reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+    candidate = cv2.resize(cv2.cvtColor(candidate, cv2.COLOR_BGR2GRAY), reference.shape[::-1], interpolation=cv2.INTER_AREA)
+    return float(cv2.matchTemplate(candidate, reference, cv2.TM_CCOEFF_NORMED)[0, 0])
+
+
+def run(config, frames, final_megapix):
+    detector, registration_megapix, range_width = config.split(":")
+    started = time.perf_counter()
+    panorama, report = stitcher.stitch_frames(
+        frames,
+        detector=detector,
+        registration_megapix=float(registration_megapix),
+        seam_megapix=min(stitcher.STITCH_SEAM_MEGAPIX, float(registration_megapix)),
+        final_megapix=final_megapix,
+        range_width=int(range_width),
+        time_budget=0,
+    )
+    return panorama, report, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", default=os.path.join(os.path.dirname(__file__), "..", "test3.mp4"))
+    parser.add_argument("--configs", nargs="*", default=[], help="detector:registration_megapix:range_width configurations")
+    parser.add_argument("--final-megapix", type=float, default=stitcher.STITCH_FINAL_MEGAPIX)
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.video)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {args.video}")
+    frames = stitcher.extract_keyframes(cap)
+    cap.release()
+
+    baseline, report, seconds = run(BASELINE, frames, -1)
+    print(f"\n{'configuration':20} {'seconds':>8} {'features':>9} {'matching':>9} {'frames':>7} {'size':>6} {'NCC':>6}")
+
+    def row(config, panorama, report, seconds):
+        stages = report['seconds']
+        size = panorama.shape[0] * panorama.shape[1] / (baseline.shape[0] * baseline.shape[1])
+        print(
+            f"{config:20} {seconds:8.2f} {stages.get('features', 0):9.2f} {stages.get('matching', 0):9.2f} "
+            f"{report['frames_stitched'] / report['frames']:7.2f} {size:6.2f} {similarity(baseline, panorama):6.3f}"
+        )
+
+    row(BASELINE, baseline, report, seconds)
+    for config in args.configs:
+        try:
+            row(config, *run(config, frames, args.final_megapix))
+        except stitcher.StitchingError as e:
+            print(f"{config:20} failed: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,10 @@
 from PIL import Image
-import chromadb
 import numpy as np
 import uuid
-from image_embedding import EMBEDDING_DIM_SIZE
 import os
-import blockchain
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import db
 def generate_uuid():
     """Generate a new UUID."""
     return str(uuid.uuid4())
@@ -13,10 +13,36 @@ def generate_uuid():
 # Use environment variables for host and port for flexibility in deployment
 CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
 CHROMA_PORT = int(os.getenv("CHROMA_PORT", 8000))
-client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-
-# Create or get a collection
-collection = client.create_collection("image_vectors", get_or_create=True)
+# Page size of the one-time copy of Chroma metadata into SQLite
+MIGRATION_PAGE_SIZE = int(os.getenv("CHROMA_MIGRATION_PAGE_SIZE", 500))
+# The client connects over the network, so it is created on first use
+client = None
+collection = None
+collection_lock = threading.Lock()
+
+def get_collection():
+    """Return the image_vectors collection, connecting on first use."""
+    global client, collection
+    with collection_lock:
+        if collection is None:
+            import chromadb
+            client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+            # Create or get a collection
+            collection = client.create_collection("image_vectors", get_or_create=True)
+    return collection
+
+# Blockchain mints are slow network calls, so they run in the background
+blockchain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blockchain")
+
+def put_on_blockchain_async(url_paths):
+    """Mint the uploaded images on the blockchain without waiting for it."""
+    def mint():
+        try:
+            import blockchain
+            blockchain.put_on_blockchain(url_paths)
+        except Exception as e:
+            print(f"Error putting images on the blockchain: {str(e)}")
+    blockchain_executor.submit(mint)
 
 def add_image_vector_to_collection(vector_embedding, url_path, before: bool, status: str):
     """
@@ -32,30 +58,71 @@ def add_image_vector_to_collection(vector_embedding, url_path, before: bool, sta
         image_id: image_id of the new uploaded image
         item_id: id of the item associated with image
     """
+    return add_image_vectors_to_collection([vector_embedding], [url_path], before, status)[0]
+
+def add_image_vectors_to_collection(vector_embeddings, url_paths, before: bool, status: str, distance_threshold=0.5, job_id=None):
+    """
+    Add the embeddings of a whole upload to the ChromaDB collection with one
+    query and one add, however many images there are, and record the metadata
+    of the images in the SQLite Images table.
 
-    image_id = generate_uuid()
-    item_id = get_item_uuid_of_embedding(vector_embedding)
-
-    metadata = {
-        "image_id": image_id,
-        "item_id": item_id,
-        "url_path": url_path,
-        "before": before,
-        "status": status
-    }
-
-    # Add the vector embedding along with metadata to the collection
-    collection.add(
-        embeddings=vector_embedding,  # Ensure vector_embedding is converted to list
-        documents=[url_path],  # Typically a document is the reference (e.g., image URL)
-        ids=[image_id],  # Use the UUID as the unique identifier
-        metadatas=[metadata]  # Add metadata for this entry
+    Every image is matched to an item like get_item_uuid_of_embedding does,
+    against the stored vectors and against the earlier images of the batch,
+    as if they had been added one at a time.
+
+    Args:
+        vector_embeddings (list): Embedding per image, as returned by get_image_description_vector_embedding.
+        url_paths (list): URL path per image.
+        before (bool): A flag indicating if these are 'before' images.
+        status (str): The status of the images (e.g., 'processed', 'pending').
+        distance_threshold (float): The maximum distance to consider embeddings as the same item.
+        job_id (str, optional): The upload job the images come from, see db.add_images.
+
+    Return:
+        list: (image_id, item_id) per image.
+    """
+    if not url_paths:
+        return []
+
+    embeddings = np.asarray(vector_embeddings, dtype=np.float32).reshape(len(url_paths), -1)
+
+    # nearest stored vector of every image, in one round trip, and the items of those images
+    results = get_collection().query(query_embeddings=embeddings.tolist(), n_results=1, include=['distances'])
+    stored = db.get_images(ids[0] for ids in results['ids'] if ids)
+    nearest = [
+        (distances[0], stored[ids[0]]['item_id']) if distances and ids[0] in stored else (None, None)
+        for ids, distances in zip(results['ids'], results['distances'])
+    ]
+
+    # squared L2 between images of the batch, the collection's default distance
+    squared_norms = (embeddings ** 2).sum(axis=1)
+    batch_distances = squared_norms[:, None] + squared_norms[None, :] - 2 * embeddings @ embeddings.T
+
+    image_ids, item_ids = [], []
+    for i, (stored_distance, stored_item_id) in enumerate(nearest):
+        best_distance, best_item_id = stored_distance, stored_item_id
+        if i > 0:
+            j = int(np.argmin(batch_distances[i, :i]))
+            if best_distance is None or batch_distances[i, j] < best_distance:
+                best_distance, best_item_id = float(batch_distances[i, j]), item_ids[j]
+        if best_distance is None or best_distance > distance_threshold:
+            best_item_id = generate_uuid()
+        image_ids.append(generate_uuid())
+        item_ids.append(best_item_id)
+
+    # Add every vector embedding in one call, the metadata of the images lives in SQLite
+    get_collection().add(
+        embeddings=embeddings.tolist(),
+        ids=image_ids
     )
-    # put on blockchain
-    blockchain.put_on_blockchain([url_path])
+    db.add_images([
+        (image_id, item_id, url_path, before, status)
+        for image_id, item_id, url_path in zip(image_ids, item_ids, url_paths)
+    ], job_id)
+    put_on_blockchain_async(list(url_paths))
 
-    print(f"Added image with item_id {item_id} and URL {url_path} to the collection.")
-    return image_id, item_id
+    print(f"Added {len(image_ids)} images of {len(set(item_ids))} items to the collection.")
+    return list(zip(image_ids, item_ids))
 
 
 def find_k_nearest_images(vector_embedding, k):
@@ -64,7 +131,7 @@ def find_k_nearest_images(vector_embedding, k):
     """
     
     # Query ChromaDB for the nearest vector
-    results = collection.query(
+    results = get_collection().query(
         query_embeddings=vector_embedding,
         n_results=k
     )
@@ -98,91 +165,46 @@ def get_item_uuid_of_embedding(vector_embedding, distance_threshold=0.5):
 
         nearest_distance = results['distances'][0][0]  # Assuming 'distances' is a list of lists, take the first element
         
-        if nearest_distance <= distance_threshold:
+        nearest_image = db.get_images([results['ids'][0][0]]).get(results['ids'][0][0])
+        if nearest_distance <= distance_threshold and nearest_image:
             # Return the item ID of the nearest embedding if it's within the threshold
-            return results['metadatas'][0][0]['item_id']
+            return nearest_image['item_id']
     
     # If no similar embedding found or distance is above threshold, generate a new UUID
     return generate_uuid()
 
-def filter_images_by_metadata(item_id=None, url_path=None, before=None, status=None, num_results=100):
-    """
-    Filter the ChromaDB collection based on metadata fields.
-    
-    Args:
-        item_id (str, optional): The UUID of the associated item. Default is None.
-        url_path (str, optional): The URL path of the image. Default is None.
-        before (bool, optional): A flag indicating if it's a 'before' image. Default is None.
-        status (str, optional): The status of the image (e.g., 'processed', 'pending'). Default is None.
-        num_results (int, optional): The max number of images that will be returned. Default is 100.
+def remove_image(image_id):
+    try:
+        get_collection().delete(ids=[image_id])
+        db.remove_images([image_id])
+    except Exception as e:
+        print(f"Error removing image {image_id} from ChromaDB: {str(e)}")
 
-    Returns:
-        dict: The filtered results from the ChromaDB collection.
+def migrate_metadata_to_sqlite(page_size=MIGRATION_PAGE_SIZE):
     """
-    # Build the filter dictionary based on the provided metadata
-    filter_conditions = {}
-    
-    if item_id is not None:
-        filter_conditions['item_id'] = item_id
-    if url_path is not None:
-        filter_conditions['url_path'] = url_path
-    if before is not None:
-        filter_conditions['before'] = before
-    if status is not None:
-        filter_conditions['status'] = status
-
-    # Perform the query with the constructed filter
-    results = collection.query(
-        query_embeddings=[0]*EMBEDDING_DIM_SIZE,  # Empty because we are only filtering by metadata, not by vector
-        where=filter_conditions,  # Apply the filter conditions
-        n_results=num_results  # Set to a reasonable number; adjust based on your needs
-    )
-    
-    return results
+    Copy the image metadata stored in Chroma by earlier versions into the
+    SQLite Images table, once. Images already in the table are left as they are.
 
-def update_image_status(image_id, new_status):
-    """
-    Update the status of an image with the given image_id in the ChromaDB collection.
-    
-    Args:
-        image_id (str): The UUID of the image to update.
-        new_status (str): The new status to set for the image.
-    
     Returns:
-        bool: True if the update was successful, False otherwise.
+        int: The number of images copied, 0 if the migration already ran.
     """
-    try:
-        # First, we need to get the current metadata for the image
-        results = collection.get(
-            ids=[image_id],
-            include=['metadatas']
-        )
-
-        if not results['metadatas']:
-            print(f"No image found with id: {image_id}")
-            return False
-
-        # Get the current metadata
-        current_metadata = results['metadatas'][0]
-
-        # Update the status in the metadata
-        current_metadata['status'] = new_status
-
-        # Update the image in the collection with the new metadata
-        collection.update(
-            ids=[image_id],
-            metadatas=[current_metadata]
-        )
-
-        print(f"Successfully updated status of image {image_id} to {new_status}")
-        return True
-
-    except Exception as e:
-        print(f"An error occurred while updating image status: {str(e)}")
-        return False
-
-def remove_image(image_id):
-    try:
-        collection.delete(ids=[image_id])
-    except Exception as e:
-        print(f"Error removing image {image_id} from ChromaDB: {str(e)}")
\ No newline at end of file
+    if db.migration_applied('chroma_metadata'):
+        return 0
+
+    copied, offset = 0, 0
+    while True:
+        results = get_collection().get(limit=page_size, offset=offset, include=['metadatas'])
+        images = [
+            (image_id, metadata['item_id'], metadata.get('url_path'), metadata.get('before'), metadata.get('status'))
+            for image_id, metadata in zip(results['ids'], results['metadatas'])
+            if metadata and metadata.get('item_id')
+        ]
+        db.add_images(images)
+        copied += len(images)
+        offset += len(results['ids'])
+        if len(results['ids']) < page_size:
+            break
+
+    db.record_migration('chroma_metadata')
+    print(f"Copied the metadata of {copied} images from ChromaDB to SQLite")
+    return copied
\ No newline at end of file
@@ -0,0 +1,16 @@
+import pytest
+
+import db
+
+# a manual script that calls the vision API when it is imported, not a test
+collect_ignore = ['test_hyperbolic.py']
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Point db.py at an empty database in a temporary directory."""
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    db.close_connection()
+    db.initialize_database()
+    yield
+    db.close_connection()
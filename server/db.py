@@ -1,6 +1,10 @@
 import sqlite3
 import uuid
 import os
+import json
+import threading
+import time
+from contextlib import contextmanager
 
 def generate_uuid():
     """Generate a new UUID."""
@@ -8,13 +12,75 @@ def generate_uuid():
 
 # Use an environment variable for the database path for deployment flexibility.
 DB_PATH = os.getenv("DATABASE_PATH", "items_and_images.db")
+# Milliseconds a writer waits for another connection's write lock
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+# Page cache per connection in KiB
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", 16384))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+# Prepared statements kept per connection
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 128))
+# Page size used when a listing walks every matching image
+IMAGES_PAGE_SIZE = int(os.getenv("IMAGES_PAGE_SIZE", 500))
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A connection that stays open for the thread that opened it. close() only
+    rolls back what was not committed, so open_connection()/close() call sites
+    reuse the connection and its prepared statements.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+pool = threading.local()
+
+def connect(path=None):
+    """Open a new pooled connection in WAL mode with tuned pragmas."""
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT / 1000,
+        factory=PooledConnection,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+    )
+    # WAL lets readers run while a worker writes, NORMAL sync is safe in WAL mode
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
 
 def open_connection():
-    """Open a connection to the SQLite database."""
-    return sqlite3.connect(DB_PATH)
+    """Return this thread's connection to the SQLite database, opening it on first use."""
+    conn = getattr(pool, 'conn', None)
+    # a connection inherited from a forked parent must not be used
+    if conn is None or pool.pid != os.getpid():
+        conn = pool.conn = connect()
+        pool.pid = os.getpid()
+    return conn
+
+def close_connection():
+    """Really close this thread's pooled connection, e.g. when a worker thread exits."""
+    conn = getattr(pool, 'conn', None)
+    if conn is not None and pool.pid == os.getpid():
+        sqlite3.Connection.close(conn)
+    pool.conn = None
+
+@contextmanager
+def transaction():
+    """Run the statements of the block in one transaction on this thread's connection."""
+    conn = open_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 def initialize_database():
-    """Initialize the database by creating necessary tables."""
+    """Initialize the database by creating necessary tables. The database warm-up subsystem runs it."""
     conn = open_connection()
     cursor = conn.cursor()
 
@@ -31,6 +97,58 @@ def initialize_database():
         )
     ''')
 
+    # Create Jobs Table to track background upload processing
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Jobs (
+            id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            stage TEXT,
+            progress REAL,
+            result TEXT,
+            error TEXT,
+            created_at REAL,
+            updated_at REAL
+        )
+    ''')
+
+    # Create LabelCache Table of vision model labels keyed by perceptual hash
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS LabelCache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phash TEXT NOT NULL,
+            version TEXT NOT NULL,
+            result TEXT NOT NULL,
+            last_used REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_labelcache_last_used ON LabelCache (last_used)")
+
+    # Create Images Table, the metadata of every image whose embedding is in the vector store
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Images (
+            image_id TEXT PRIMARY KEY,
+            item_id TEXT NOT NULL,
+            url_path TEXT,
+            before TEXT,
+            status TEXT,
+            created_at REAL,
+            job_id TEXT
+        )
+    ''')
+    # Images tables created before uploads were tagged with their job
+    if 'job_id' not in [row[1] for row in cursor.execute("PRAGMA table_info(Images)")]:
+        cursor.execute("ALTER TABLE Images ADD COLUMN job_id TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_status_before ON Images (status, before)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_item_id ON Images (item_id)")
+
+    # Create Migrations Table of the one-time data migrations already applied
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Migrations (
+            name TEXT PRIMARY KEY,
+            applied_at REAL
+        )
+    ''')
+
     conn.commit()
     conn.close()
 
@@ -60,6 +178,15 @@ def set_item(name, description, category, price, item_id):
     conn.close()
     return item_id
 
+# New items count the image in before_count or after_count, existing items add to it
+UPSERT_ITEM = '''
+    INSERT INTO Items (id, name, description, category, price, before_count, after_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        before_count = before_count + excluded.before_count,
+        after_count = after_count + excluded.after_count
+'''
+
 def increment_item_count(item_id, before=True):
     """
     Increment the before_count or after_count of a given item by 1.
@@ -71,44 +198,19 @@ def increment_item_count(item_id, before=True):
     Returns:
         bool: True if the update was successful, False otherwise.
     """
-    conn = open_connection()
-    cursor = conn.cursor()
-
+    column = 'before_count' if before_text(before) == 'true' else 'after_count'
     try:
-        # First, check if the item exists
-        cursor.execute("SELECT before_count, after_count FROM Items WHERE id = ?", (item_id,))
-        result = cursor.fetchone()
-
-        if result is None:
-            print(f"No item found with id: {item_id}")
-            return False
-
-        before_count, after_count = result
-
-        if before:
-            new_count = before_count + 1
-            cursor.execute('''
-                UPDATE Items
-                SET before_count = ?
-                WHERE id = ?
-            ''', (new_count, item_id))
-            print(f"Item before_count updated. New count: {new_count}")
-        else:
-            new_count = after_count + 1
-            cursor.execute('''
-                UPDATE Items
-                SET after_count = ?
-                WHERE id = ?
-            ''', (new_count, item_id))
-            print(f"Item after_count updated. New count: {new_count}")
-
-        conn.commit()
-        return True
+        with transaction() as conn:
+            # a single statement, so concurrent workers cannot lose increments
+            cursor = conn.execute(f"UPDATE Items SET {column} = {column} + 1 WHERE id = ?", (item_id,))
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
         return False
-    finally:
-        conn.close()
+
+    if cursor.rowcount == 0:
+        print(f"No item found with id: {item_id}")
+        return False
+    return True
 
 def update_item(item_id, name, description, category, price, before=True):
     """
@@ -126,28 +228,31 @@ def update_item(item_id, name, description, category, price, before=True):
     Returns:
         str: The UUID of the item.
     """
-    conn = open_connection()
-    cursor = conn.cursor()
+    update_items([(item_id, name, description, category, price)], before)
+    return item_id
 
-    try:
-        # Check if the item_id already exists
-        cursor.execute("SELECT id FROM Items WHERE id = ?", (item_id,))
-        result = cursor.fetchone()
+def update_items(items, before=True):
+    """
+    Add or count the items of a whole upload in one transaction, one atomic
+    upsert per image.
 
-        if result:
-            # If the item exists, increment the appropriate count
-            print(f"Item with ID {item_id} already exists. Incrementing {'before' if before else 'after'} count.")
-            increment_item_count(item_id, before)
-        else:
-            # If the item doesn't exist, insert it with the provided details
-            print(f"Item with ID {item_id} does not exist. Creating new item.")
-            set_item(name, description, category, price, item_id)
+    Args:
+        items (list): (item_id, name, description, category, price) per image.
+            An item with several images is counted once per image.
+        before (bool or str, optional): If True or 'true', count the images in before_count,
+            otherwise in after_count.
+
+    Returns:
+        bool: True if every item was written, False if the transaction was rolled back.
+    """
+    counts = (1, 0) if before_text(before) == 'true' else (0, 1)
+    try:
+        with transaction() as conn:
+            conn.executemany(UPSERT_ITEM, [(*item, *counts) for item in items])
+        return True
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
-    finally:
-        conn.close()
-
-    return item_id
+        return False
 
 def get_item(item_id):
     """
@@ -188,6 +293,48 @@ def get_item(item_id):
     finally:
         conn.close()
 
+def get_items_by_id(item_ids, chunk_size=500):
+    """
+    Retrieve many items from the Items table with one connection.
+
+    Args:
+      item_ids (iterable): The UUIDs of the items to retrieve.
+      chunk_size (int, optional): Ids per SELECT, below SQLite's bound parameter limit.
+
+    Returns:
+      dict: Item UUID -> dictionary of the item's details, for the items that exist.
+    """
+    item_ids = [item_id for item_id in dict.fromkeys(item_ids) if item_id]
+    items = {}
+    if not item_ids:
+        return items
+
+    conn = open_connection()
+    cursor = conn.cursor()
+
+    try:
+        for start in range(0, len(item_ids), chunk_size):
+            chunk = item_ids[start:start + chunk_size]
+            placeholders = ', '.join('?' for _ in chunk)
+            cursor.execute(f"SELECT * FROM Items WHERE id IN ({placeholders})", chunk)
+            for result in cursor.fetchall():
+                items[result[0]] = {
+                    'id': result[0],
+                    'name': result[1],
+                    'description': result[2],
+                    'category': result[3],
+                    'price': result[4],
+                    'before_count': result[5],
+                    'after_count': result[6]
+                }
+        # keep the order the ids were given in
+        return {item_id: items[item_id] for item_id in item_ids if item_id in items}
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+        return items
+    finally:
+        conn.close()
+
 def remove_item(item_id):
     try:
         conn = open_connection()
@@ -206,5 +353,329 @@ def remove_item(item_id):
     finally:
         conn.close()
 
-# Initialize the database when this module is imported
-initialize_database()
\ No newline at end of file
+def before_text(before):
+    """Store the before flag as 'true'/'false', the way the client sends it."""
+    if before is None:
+        return None
+    if isinstance(before, bool):
+        return 'true' if before else 'false'
+    return str(before).lower()
+
+def image_row_to_dict(row):
+    return {
+        'image_id': row[0],
+        'item_id': row[1],
+        'url_path': row[2],
+        'before': row[3],
+        'status': row[4]
+    }
+
+# Jobs are ordered by their rowid, i.e. in the order they were submitted
+LATER_JOB_EXISTS = "EXISTS (SELECT 1 FROM Jobs WHERE rowid > (SELECT rowid FROM Jobs WHERE id = ?))"
+
+def add_images(images, job_id=None):
+    """
+    Insert the metadata of new images in one transaction. Images that are
+    already in the table are left as they are.
+
+    Args:
+        images (list): (image_id, item_id, url_path, before, status) per image.
+        job_id (str, optional): The upload job the images come from. Only the
+            latest upload keeps its images pending, so if another upload was
+            submitted after this job its pending images are stored as done.
+    """
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO Images (image_id, item_id, url_path, before, status, created_at, job_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(image_id, item_id, url_path, before_text(before), status, now, job_id)
+              for image_id, item_id, url_path, before, status in images])
+        if job_id is not None:
+            conn.execute(f"UPDATE Images SET status = 'done' WHERE job_id = ? AND status = 'pending' AND {LATER_JOB_EXISTS}",
+                         (job_id, job_id))
+
+def set_pending_before_job_to_done(job_id):
+    """
+    Start the upload session of a job: the images still pending from uploads
+    submitted before it, or from untracked uploads, are set to done.
+
+    Args:
+        job_id (str): The UUID of the new upload job.
+
+    Returns:
+        int: The number of images set to done.
+    """
+    with transaction() as conn:
+        cursor = conn.execute('''
+            UPDATE Images SET status = 'done'
+            WHERE status = 'pending' AND (
+                job_id IS NULL
+                OR job_id IN (SELECT id FROM Jobs WHERE rowid < (SELECT rowid FROM Jobs WHERE id = ?))
+            )
+        ''', (job_id,))
+        return cursor.rowcount
+
+def get_images(image_ids, chunk_size=500):
+    """
+    Retrieve the metadata of many images.
+
+    Args:
+        image_ids (iterable): The UUIDs of the images.
+        chunk_size (int, optional): Ids per SELECT, below SQLite's bound parameter limit.
+
+    Returns:
+        dict: Image UUID -> metadata dict, for the images that exist.
+    """
+    image_ids = list(dict.fromkeys(image_ids))
+    conn = open_connection()
+    images = {}
+    for start in range(0, len(image_ids), chunk_size):
+        chunk = image_ids[start:start + chunk_size]
+        placeholders = ', '.join('?' for _ in chunk)
+        for row in conn.execute(f"SELECT image_id, item_id, url_path, before, status FROM Images WHERE image_id IN ({placeholders})", chunk):
+            images[row[0]] = image_row_to_dict(row)
+    return images
+
+def image_filter(item_id=None, url_path=None, before=None, status=None):
+    """Build the WHERE conditions and parameters of an image listing."""
+    conditions, params = [], []
+    if item_id is not None:
+        if isinstance(item_id, (list, tuple, set)):
+            # one JSON parameter however many ids, so the listing stays a single keyset query
+            conditions.append("item_id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(item_id)))
+        else:
+            conditions.append("item_id = ?")
+            params.append(item_id)
+    if url_path is not None:
+        conditions.append("url_path = ?")
+        params.append(url_path)
+    if before is not None:
+        conditions.append("before = ?")
+        params.append(before_text(before))
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status)
+    return conditions, params
+
+def list_images(item_id=None, url_path=None, before=None, status=None, limit=IMAGES_PAGE_SIZE, cursor=0):
+    """
+    List one page of images matching the metadata filters, oldest first.
+
+    Args:
+        item_id (str or list, optional): The UUID of the associated item, or a list of them.
+        url_path (str, optional): The URL path of the image.
+        before (bool or str, optional): A flag indicating if it's a 'before' image.
+        status (str, optional): The status of the image (e.g., 'processed', 'pending').
+        limit (int, optional): The max number of images in the page.
+        cursor (int, optional): The next_cursor of the previous page, 0 for the first page.
+
+    Returns:
+        dict: 'ids' and 'metadatas' of the page, and 'next_cursor', None on the last page.
+    """
+    conditions, params = image_filter(item_id, url_path, before, status)
+    # keyset pagination on the rowid, so a page costs the same however deep it is
+    conditions.append("rowid > ?")
+    params += [cursor, limit]
+
+    conn = open_connection()
+    rows = conn.execute(f'''
+        SELECT rowid, image_id, item_id, url_path, before, status FROM Images
+        WHERE {' AND '.join(conditions)}
+        ORDER BY rowid LIMIT ?
+    ''', params).fetchall()
+    return {
+        'ids': [row[1] for row in rows],
+        'metadatas': [image_row_to_dict(row[1:]) for row in rows],
+        'next_cursor': rows[-1][0] if len(rows) == limit else None
+    }
+
+def iter_images(item_id=None, url_path=None, before=None, status=None, page_size=IMAGES_PAGE_SIZE):
+    """Yield every page of list_images for the filters."""
+    cursor = 0
+    while cursor is not None:
+        page = list_images(item_id, url_path, before, status, limit=page_size, cursor=cursor)
+        if page['ids']:
+            yield page
+        cursor = page['next_cursor']
+
+def filter_images_by_metadata(item_id=None, url_path=None, before=None, status=None, num_results=None):
+    """
+    Filter the images based on metadata fields.
+
+    Args:
+        item_id (str or list, optional): The UUID of the associated item, or a list of them. Default is None.
+        url_path (str, optional): The URL path of the image. Default is None.
+        before (bool or str, optional): A flag indicating if it's a 'before' image. Default is None.
+        status (str, optional): The status of the image (e.g., 'processed', 'pending'). Default is None.
+        num_results (int, optional): The max number of images that will be returned. Default is None, every match.
+
+    Returns:
+        dict: 'ids' and 'metadatas' of the matching images.
+    """
+    ids, metadatas = [], []
+    for page in iter_images(item_id, url_path, before, status):
+        ids += page['ids']
+        metadatas += page['metadatas']
+        if num_results is not None and len(ids) >= num_results:
+            return {'ids': ids[:num_results], 'metadatas': metadatas[:num_results]}
+    return {'ids': ids, 'metadatas': metadatas}
+
+def update_image_status(image_id, new_status):
+    """
+    Update the status of an image with the given image_id.
+
+    Args:
+        image_id (str): The UUID of the image to update.
+        new_status (str): The new status to set for the image.
+
+    Returns:
+        bool: True if the update was successful, False otherwise.
+    """
+    return image_id in update_images_status([image_id], new_status)['updated']
+
+def update_images_status(image_ids, new_status, chunk_size=500):
+    """
+    Update the status of many images in one transaction.
+
+    Args:
+        image_ids (list): The UUIDs of the images to update.
+        new_status (str): The new status to set for the images.
+        chunk_size (int, optional): Ids per statement, below SQLite's bound parameter limit.
+
+    Returns:
+        dict: 'updated', 'missing' (no image with that id) and 'failed' image ids.
+    """
+    report = {'updated': [], 'missing': [], 'failed': []}
+    image_ids = list(dict.fromkeys(image_ids))
+    if not image_ids:
+        return report
+
+    found = set()
+    try:
+        with transaction() as conn:
+            for start in range(0, len(image_ids), chunk_size):
+                chunk = image_ids[start:start + chunk_size]
+                placeholders = ', '.join('?' for _ in chunk)
+                found.update(row[0] for row in conn.execute(f"SELECT image_id FROM Images WHERE image_id IN ({placeholders})", chunk))
+                conn.execute(f"UPDATE Images SET status = ? WHERE image_id IN ({placeholders})", (new_status, *chunk))
+    except sqlite3.Error as e:
+        print(f"An error occurred while updating image status: {e}")
+        report['failed'] = image_ids
+        return report
+
+    report['updated'] = [image_id for image_id in image_ids if image_id in found]
+    report['missing'] = [image_id for image_id in image_ids if image_id not in found]
+    print(f"Updated status of {len(report['updated'])} images to {new_status} ({len(report['missing'])} missing)")
+    return report
+
+def remove_images(image_ids, chunk_size=500):
+    """Delete the metadata of the given images, in one transaction."""
+    image_ids = list(image_ids)
+    with transaction() as conn:
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:start + chunk_size]
+            conn.execute(f"DELETE FROM Images WHERE image_id IN ({', '.join('?' for _ in chunk)})", chunk)
+
+def migration_applied(name):
+    """Whether the one-time migration with this name already ran."""
+    return open_connection().execute("SELECT 1 FROM Migrations WHERE name = ?", (name,)).fetchone() is not None
+
+def record_migration(name):
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO Migrations (name, applied_at) VALUES (?, ?)", (name, time.time()))
+
+def create_job(job_id):
+    """
+    Insert a new queued job into the Jobs table.
+
+    Args:
+        job_id (str): The UUID of the job.
+
+    Returns:
+        str: The UUID of the job.
+    """
+    conn = open_connection()
+    cursor = conn.cursor()
+    now = time.time()
+
+    cursor.execute('''
+        INSERT INTO Jobs (id, state, stage, progress, result, error, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, 'queued', 'queued', 0.0, None, None, now, now))
+
+    conn.commit()
+    conn.close()
+    return job_id
+
+def update_job(job_id, state=None, stage=None, progress=None, result=None, error=None):
+    """
+    Update the fields of a job that are not None.
+
+    Args:
+        job_id (str): The UUID of the job.
+        state (str, optional): queued, running, done or failed.
+        stage (str, optional): The pipeline stage the job is currently in.
+        progress (float, optional): Fraction of the job completed, between 0 and 1.
+        result (object, optional): JSON serializable result of the job.
+        error (str, optional): Error message if the job failed.
+    """
+    fields = {'updated_at': time.time()}
+    if state is not None:
+        fields['state'] = state
+    if stage is not None:
+        fields['stage'] = stage
+    if progress is not None:
+        fields['progress'] = progress
+    if result is not None:
+        fields['result'] = json.dumps(result)
+    if error is not None:
+        fields['error'] = error
+
+    assignments = ', '.join(f"{column} = ?" for column in fields)
+
+    conn = open_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE Jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+def get_job(job_id):
+    """
+    Retrieve a job from the Jobs table by its UUID.
+
+    Args:
+      job_id (str): The UUID of the job to retrieve.
+
+    Returns:
+      dict: A dictionary containing the job's details, or None if the job does not exist.
+    """
+    conn = open_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("SELECT id, state, stage, progress, result, error, created_at, updated_at FROM Jobs WHERE id = ?", (job_id,))
+        result = cursor.fetchone()
+
+        if result:
+            return {
+                'id': result[0],
+                'state': result[1],
+                'stage': result[2],
+                'progress': result[3],
+                'result': json.loads(result[4]) if result[4] else None,
+                'error': result[5],
+                'created_at': result[6],
+                'updated_at': result[7]
+            }
+        return None
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+        return None
+    finally:
+        conn.close()
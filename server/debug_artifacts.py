@@ -0,0 +1,55 @@
+"""
+Opt-in debug images (e.g. the stitched panorama) written off the request path.
+
+Nothing is written unless DEBUG_ARTIFACTS_DIR is set. Images are encoded and
+written by a single background thread, and only the DEBUG_ARTIFACTS_KEEP
+newest files are kept in the directory.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+DEBUG_ARTIFACTS_DIR = os.getenv("DEBUG_ARTIFACTS_DIR", "")
+DEBUG_ARTIFACTS_KEEP = int(os.getenv("DEBUG_ARTIFACTS_KEEP", 20))
+
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug-artifacts")
+
+
+def cleanup(directory, keep):
+    """Delete all but the newest `keep` files of the directory."""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    paths = sorted((p for p in paths if os.path.isfile(p)), key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write_image(path, image, keep):
+    try:
+        cv2.imwrite(path, image)
+        cleanup(os.path.dirname(path), keep)
+    except Exception as e:
+        print(f"Error writing debug artifact {path}: {e}")
+
+
+def save_image(name, image, directory=DEBUG_ARTIFACTS_DIR, keep=DEBUG_ARTIFACTS_KEEP):
+    """
+    Queue a BGR image to be written as a debug artifact, if they are enabled.
+
+    Args:
+        name (str): File name prefix, e.g. "pano".
+        image (np.ndarray): The BGR image. It must not be modified afterwards.
+
+    Returns:
+        str or None: The path the image will be written to, or None if disabled.
+    """
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**6:06d}.png")
+    writer.submit(write_image, path, image, keep)
+    return path
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Number of SAM image embeddings kept in memory (about 4 MB each for ViT-H),
+# and an optional directory every entry is also written to so it survives
+# eviction and restarts.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 32))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")
+
+
+def image_hash(image):
+    """
+    Content hash of the decoded pixels of an image.
+
+    Args:
+        image (PIL.Image or np.ndarray): The image to hash.
+
+    Returns:
+        str: Hex digest identifying the image regardless of its file format.
+    """
+    pixels = np.ascontiguousarray(np.asarray(image))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(pixels.shape).encode())
+    digest.update(pixels.data)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of SAM image embeddings keyed by image content hash, with an
+    optional on-disk spill directory that also keeps the source image so it
+    can be re-segmented by hash alone.
+    """
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, spill_dir=EMBEDDING_CACHE_DIR):
+        self.max_entries = max(0, max_entries)
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def spill_path(self, key, suffix):
+        return os.path.join(self.spill_dir, f"{key}{suffix}")
+
+    def get(self, key):
+        """Return the cached embedding tensor for key, or None."""
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+
+        if self.spill_dir and os.path.exists(self.spill_path(key, '.pt')):
+            try:
+                embedding = torch.load(self.spill_path(key, '.pt'))
+            except Exception as e:
+                print(f"Error loading spilled embedding {key}: {e}")
+            else:
+                self.put(key, embedding, spill=False)
+                with self.lock:
+                    self.hits += 1
+                return embedding
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, embedding, spill=True):
+        """Store an embedding tensor, evicting the least recently used ones."""
+        embedding = embedding.detach().cpu()
+        with self.lock:
+            self.entries[key] = embedding
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        if spill and self.spill_dir and not os.path.exists(self.spill_path(key, '.pt')):
+            try:
+                torch.save(embedding, self.spill_path(key, '.pt'))
+            except Exception as e:
+                print(f"Error spilling embedding {key}: {e}")
+
+    def save_image(self, key, image):
+        """Keep the source image on disk so it can be re-segmented by hash."""
+        if self.spill_dir and not os.path.exists(self.spill_path(key, '.png')):
+            image.save(self.spill_path(key, '.png'))
+
+    def load_image(self, key):
+        """Return the spilled source image for key, or None."""
+        if not re.fullmatch(r'[0-9a-f]{32}', key or ''):
+            return None
+        if self.spill_dir and os.path.exists(self.spill_path(key, '.png')):
+            return Image.open(self.spill_path(key, '.png')).convert('RGB')
+        return None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'spill_dir': self.spill_dir,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -4,7 +4,108 @@ import base64
 import requests
 import io
 import json
-from PIL import Image
+import hashlib
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageDraw
+from label_cache import LABEL_CACHE_ENABLED, label_cache, perceptual_hash
+
+# Labeling runs up to LABEL_CONCURRENCY requests at once, across all jobs, over a pooled
+# keep-alive session, started at no more than LABEL_RATE_LIMIT per second
+# (0 disables the limit). Failed requests are retried LABEL_RETRIES times
+# with exponential backoff and jitter.
+LABEL_CONCURRENCY = int(os.getenv("LABEL_CONCURRENCY", 8))
+LABEL_RATE_LIMIT = float(os.getenv("LABEL_RATE_LIMIT", 4))
+LABEL_RETRIES = int(os.getenv("LABEL_RETRIES", 3))
+LABEL_BACKOFF_BASE = float(os.getenv("LABEL_BACKOFF_BASE", 0.5))
+LABEL_BACKOFF_MAX = float(os.getenv("LABEL_BACKOFF_MAX", 8))
+LABEL_TIMEOUT = float(os.getenv("LABEL_TIMEOUT", 60))
+
+# With LABEL_BATCH_SIZE > 1 several crops are labeled per request, attached as
+# separate images or, with LABEL_BATCH_LAYOUT=grid, as one numbered contact sheet.
+LABEL_BATCH_SIZE = int(os.getenv("LABEL_BATCH_SIZE", 1))
+LABEL_BATCH_LAYOUT = os.getenv("LABEL_BATCH_LAYOUT", "images")
+LABEL_GRID_CELL = int(os.getenv("LABEL_GRID_CELL", 336))
+
+API_URL = "https://api.hyperbolic.xyz/v1/chat/completions"
+LABEL_MODEL = "Qwen/Qwen2-VL-7B-Instruct"
+LABEL_PROMPT = """
+        List the following details for the item outlined by a thin red line in this image:
+        {"name": <string>, "description": <string>, "category": <string>, "price": <float>, "is_object": <int>}.
+        category can be one of the following: Electronics, Appliances, Furniture, Kitchenware, Containers, Clothing and Accessories, Toiletry, Tools and Equipment, Toys and Games, Home Decor, Bedding and Linens, Kitchenware, Hobby and Craft Supplies, Medical Equipment, Pet Supplies, Pets, Food, Firearms
+        is_object should be 1 for recognizable non-human objects/furniture. is_object should be 0 for walls, people, persons, humans, men, women and unrecognizable things. If you are at all unsure about what is outlined in red, say it is unrecognizable and set is_object to 0. You are checking if the thing highlighted by the outline is_object, NOT other objects in the image.
+        price is the estimated dollar value of the object.
+        json output should be one dict like the following example {"name": <string>, "description": <string>, "category": <string>, , "price": <float>, "is_object": <int>}
+        Start JSON output here:
+        """
+LABEL_BATCH_PROMPT = """
+        You are given {count} {layout}. For every one of them, in order from 1 to {count}, list the following details for the item it shows:
+        {{"index": <int>, "name": <string>, "description": <string>, "category": <string>, "price": <float>, "is_object": <int>}}.
+        category can be one of the following: Electronics, Appliances, Furniture, Kitchenware, Containers, Clothing and Accessories, Toiletry, Tools and Equipment, Toys and Games, Home Decor, Bedding and Linens, Kitchenware, Hobby and Craft Supplies, Medical Equipment, Pet Supplies, Pets, Food, Firearms
+        is_object should be 1 for recognizable non-human objects/furniture. is_object should be 0 for walls, people, persons, humans, men, women and unrecognizable things. If you are at all unsure about what an image shows, say it is unrecognizable and set is_object to 0.
+        price is the estimated dollar value of the object.
+        json output should be one JSON array of exactly {count} dicts, where index is the number of the image the dict describes.
+        Start JSON output here:
+        """
+# Cached labels are only reused while the prompts and model stay the same
+LABEL_VERSION = hashlib.sha1((LABEL_MODEL + LABEL_PROMPT + LABEL_BATCH_PROMPT).encode()).hexdigest()[:12]
+
+throughput = {}
+throughput_lock = threading.Lock()
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=LABEL_CONCURRENCY))
+# Shared by every upload job, so LABEL_CONCURRENCY bounds the requests of the
+# whole process and never outgrows the session's connection pool
+label_executor = ThreadPoolExecutor(max_workers=LABEL_CONCURRENCY, thread_name_prefix="label")
+
+
+class RetryableError(Exception):
+    """An API error worth retrying, e.g. rate limiting or a server error."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how fast requests are started."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = TokenBucket(LABEL_RATE_LIMIT, LABEL_CONCURRENCY)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter, honouring the server's Retry-After."""
+    delay = random.uniform(0, min(LABEL_BACKOFF_MAX, LABEL_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
 
 def encode_image(image):
     """Encodes a PIL image to a base64 string, converting RGBA to RGB if necessary."""
@@ -14,11 +115,9 @@ def encode_image(image):
     image.save(buffered, format="JPEG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-def get_item_details_from_image(image):
-    """Sends an image to the vision model and retrieves item details."""
-    base64_img = encode_image(image)
-
-    api = "https://api.hyperbolic.xyz/v1/chat/completions"
+def request_completion(message_content):
+    """Sends one chat completion request to the vision model and returns the reply text."""
+    api = API_URL
     # Load API key from environment variables for security
     api_key = os.getenv("HYPERBOLIC_API_KEY")
 
@@ -30,20 +129,6 @@ def get_item_details_from_image(image):
         "Authorization": f"Bearer {api_key}",
     }
 
-    # Prepare the message content
-    message_content = [
-        {"type": "text", "text": """
-        List the following details for the item outlined by a thin red line in this image:
-        {"name": <string>, "description": <string>, "category": <string>, "price": <float>, "is_object": <int>}.
-        category can be one of the following: Electronics, Appliances, Furniture, Kitchenware, Containers, Clothing and Accessories, Toiletry, Tools and Equipment, Toys and Games, Home Decor, Bedding and Linens, Kitchenware, Hobby and Craft Supplies, Medical Equipment, Pet Supplies, Pets, Food, Firearms
-        is_object should be 1 for recognizable non-human objects/furniture. is_object should be 0 for walls, people, persons, humans, men, women and unrecognizable things. If you are at all unsure about what is outlined in red, say it is unrecognizable and set is_object to 0. You are checking if the thing highlighted by the outline is_object, NOT other objects in the image.
-        price is the estimated dollar value of the object.
-        json output should be one dict like the following example {"name": <string>, "description": <string>, "category": <string>, , "price": <float>, "is_object": <int>}
-        Start JSON output here:
-        """},
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_img}"}}
-    ]
-
     payload = {
         "messages": [
             {
@@ -51,14 +136,25 @@ def get_item_details_from_image(image):
                 "content": message_content,
             }
         ],
-        "model": "Qwen/Qwen2-VL-7B-Instruct",
+        "model": LABEL_MODEL,
         "max_tokens": 32000,
         "temperature": 0.7,
         "top_p": 0.9
     }
 
-    # Make the API request
-    response = requests.post(api, headers=headers, json=payload)
+    # Make the API request, waiting for the rate limiter first
+    rate_limiter.acquire()
+    try:
+        response = session.post(api, headers=headers, json=payload, timeout=LABEL_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise RetryableError(f"Request failed: {e}")
+
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = response.headers.get("Retry-After")
+        raise RetryableError(
+            f"API returned {response.status_code}",
+            float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
     response_json = response.json()
 
     try:
@@ -68,32 +164,240 @@ def get_item_details_from_image(image):
         print("Error with API response:", response_json)
         return None
 
+def image_content(image):
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(image)}"}}
+
+def get_item_details_from_image(image):
+    """Sends an image to the vision model and retrieves item details."""
+    # Prepare the message content
+    message_content = [
+        {"type": "text", "text": LABEL_PROMPT},
+        image_content(image),
+    ]
+    return request_completion(message_content)
+
+def contact_sheet(images, cell_size=LABEL_GRID_CELL):
+    """Lays images out on a grid of numbered cells, numbered from 1 in reading order."""
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    sheet = Image.new("RGB", (columns * cell_size, rows * cell_size), "white")
+    draw = ImageDraw.Draw(sheet)
+
+    for i, image in enumerate(images):
+        x, y = (i % columns) * cell_size, (i // columns) * cell_size
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail((cell_size - 8, cell_size - 32))
+        sheet.paste(thumbnail, (x + 4, y + 28))
+        draw.rectangle((x, y, x + cell_size - 1, y + cell_size - 1), outline="gray")
+        draw.text((x + 6, y + 6), str(i + 1), fill="red")
+    return sheet
+
+def get_item_details_from_images(images, layout=LABEL_BATCH_LAYOUT):
+    """
+    Sends several images to the vision model in one request.
+
+    Args:
+        images: list of PIL images.
+        layout (str): "images" to attach every image, "grid" for one numbered contact sheet.
+
+    Returns:
+        str: The reply, expected to be a JSON array with one dict per image.
+    """
+    if layout == "grid":
+        layout_hint = "cells of the grid, numbered in the top-left corner of each cell"
+        attachments = [image_content(contact_sheet(images))]
+    else:
+        layout_hint = "images, numbered in the order they are attached"
+        attachments = [image_content(image) for image in images]
+
+    message_content = [{"type": "text", "text": LABEL_BATCH_PROMPT.format(count=len(images), layout=layout_hint)}]
+    return request_completion(message_content + attachments)
+
+# Details every object needs, ml.get_item_data reads them all
+REQUIRED_KEYS = ("name", "description", "category", "price")
+
+def valid_item(item_json):
+    """Whether a reply entry is a dict with every detail an object needs."""
+    if not isinstance(item_json, dict):
+        return False
+    return not item_json.get("is_object", False) or all(key in item_json for key in REQUIRED_KEYS)
+
+def parse_batch_details(item_details, count):
+    """
+    Parses a batch reply into one dict per image, in input order. Entries are
+    only matched to images by their index; an image whose index is missing or
+    duplicated, or whose entry is invalid, gets None.
+
+    Raises:
+        ValueError: If the reply is not a JSON array.
+    """
+    items = json.loads(item_details)
+    if not isinstance(items, list):
+        raise ValueError(f"Expected a JSON array of {count} items")
+
+    by_index = {}
+    duplicated = set()
+    for item in items:
+        index = item.get("index") if isinstance(item, dict) else None
+        if not isinstance(index, int) or not 1 <= index <= count:
+            continue
+        if index in by_index:
+            duplicated.add(index)
+        by_index[index] = item
+
+    return [
+        by_index[index] if index in by_index and index not in duplicated and valid_item(by_index[index]) else None
+        for index in range(1, count + 1)
+    ]
+
+def accept_item(item_json):
+    """Return the parsed item details if they describe an object, else None."""
+    if any(e in json.dumps(item_json).lower() for e in ["unrecognizable", "person","man","woman","human"]):
+        return None
+    if item_json.get("is_object", False):
+        return item_json
+    return None
+
+def request_label(image, phash=None):
+    """Ask the vision model for the details of one image, retrying failures with backoff."""
+    item_details = None
+    for attempt in range(LABEL_RETRIES):
+        retry_after = None
+        try:
+            item_details = get_item_details_from_image(image)
+            item_json = json.loads(item_details)
+            if not valid_item(item_json):
+                raise ValueError(f"Reply is missing some of {REQUIRED_KEYS}")
+            if phash is not None:
+                label_cache.put(phash, LABEL_VERSION, item_json)
+            return accept_item(item_json)
+        except RetryableError as e:
+            print(f"Error processing image: {e}")
+            retry_after = e.retry_after
+        except Exception as e:
+            print(f"Error processing image: {e}")
+            print(item_details)
+
+        if attempt < LABEL_RETRIES - 1:
+            time.sleep(backoff_delay(attempt, retry_after))
+
+    print(f"Failed to process image after {LABEL_RETRIES} attempts.")
+    return None
+
+def request_labels(images, phashes):
+    """
+    Ask the vision model for the details of several images in one request.
+    If the reply cannot be parsed, the images are labeled one by one, and so
+    are the images the reply has no valid entry for.
+    """
+    item_details = None
+    items = None
+    for attempt in range(LABEL_RETRIES):
+        try:
+            item_details = get_item_details_from_images(images)
+            items = parse_batch_details(item_details, len(images))
+            break
+        except RetryableError as e:
+            print(f"Error processing image batch: {e}")
+            if attempt < LABEL_RETRIES - 1:
+                time.sleep(backoff_delay(attempt, e.retry_after))
+        except Exception as e:
+            print(f"Could not parse batch reply, labeling {len(images)} images one by one: {e}")
+            print(item_details)
+            break
+
+    if items is None:
+        record_throughput("batch_fallback", requests=1)
+        return [request_label(image, phash) for image, phash in zip(images, phashes)]
+
+    results = []
+    missing = 0
+    for image, item_json, phash in zip(images, items, phashes):
+        if item_json is None:
+            missing += 1
+            results.append(request_label(image, phash))
+            continue
+        item_json.pop("index", None)
+        if phash is not None:
+            label_cache.put(phash, LABEL_VERSION, item_json)
+        results.append(accept_item(item_json))
+    if missing:
+        print(f"Batch reply had no valid entry for {missing} of {len(images)} images, labeled them one by one")
+        record_throughput("batch_fallback", requests=missing)
+    return results
+
+def label_image(image):
+    """
+    Label one image with the vision model, retrying failures with backoff.
+    Near-identical crops seen before are answered from the label cache.
+
+    Returns:
+        dict: The parsed item details, or None if the image is not an object
+        or could not be labeled.
+    """
+    return label_images([image], batch_size=1)[0]
+
+def label_images(images, batch_size=LABEL_BATCH_SIZE):
+    """
+    Label images concurrently, answering near-identical crops from the label
+    cache and, with batch_size > 1, packing several crops into each request.
+
+    Returns:
+        list: The parsed item details of each image, or None if it is not an
+        object or could not be labeled, in the same order as the input.
+    """
+    images = list(images)
+    results = [None] * len(images)
+    phashes = [None] * len(images)
+    pending = []
+
+    for i, image in enumerate(images):
+        if LABEL_CACHE_ENABLED:
+            phashes[i] = perceptual_hash(image)
+            cached = label_cache.get(phashes[i], LABEL_VERSION)
+            if cached is not None and valid_item(cached):
+                results[i] = accept_item(cached)
+                continue
+        pending.append(i)
+
+    if not pending:
+        return results
+
+    mode = "batch" if batch_size > 1 else "single"
+    chunks = [pending[start:start + max(1, batch_size)] for start in range(0, len(pending), max(1, batch_size))]
+    started = time.perf_counter()
+
+    def run(chunk):
+        if mode == "single":
+            return [request_label(images[chunk[0]], phashes[chunk[0]])]
+        return request_labels([images[i] for i in chunk], [phashes[i] for i in chunk])
+
+    for chunk, chunk_results in zip(chunks, label_executor.map(run, chunks)):
+        for i, result in zip(chunk, chunk_results):
+            results[i] = result
+
+    record_throughput(mode, crops=len(pending), requests=len(chunks), seconds=time.perf_counter() - started)
+    return results
+
+def record_throughput(mode, crops=0, requests=0, seconds=0.0):
+    with throughput_lock:
+        counters = throughput.setdefault(mode, {"crops": 0, "requests": 0, "seconds": 0.0})
+        counters["crops"] += crops
+        counters["requests"] += requests
+        counters["seconds"] += seconds
+
+def labeling_stats():
+    """Return crops labeled, requests sent and crops per second for each labeling mode."""
+    with throughput_lock:
+        return {
+            mode: dict(counters, crops_per_second=round(counters["crops"] / counters["seconds"], 3) if counters["seconds"] else 0.0)
+            for mode, counters in throughput.items()
+        }
+
 def process_images(images):
     """Processes a list of images, filters non-objects, and prints the result."""
-    items = []
-    
-    for image in images:
-        print("Processing image...")
-        retries = 3
-        while retries > 0:
-            try:
-              item_details = get_item_details_from_image(image)
-              if item_details:
-                  item_json = json.loads(item_details)
-
-              if any(e in item_details.lower() for e in ["unrecognizable", "person","man","woman","human"]):
-                break
-              if item_json.get("is_object", False):
-                items.append(item_json)
-              break
-            except Exception as e:
-              print(f"Error processing image: {e}")
-              print(item_details)
-              retries -= 1
-              if retries == 0:
-                  print("Failed to process image after 3 attempts.")
-    
-    return items
+    print(f"Processing {len(images)} images...")
+    return [item for item in label_images(images) if item]
 
 def load_images_from_files(file_paths):
     """Loads images from a list of file paths and returns a list of PIL Image objects."""
@@ -1,12 +1,7 @@
-import torch
-from torchvision import models, transforms
 from PIL.Image import Image, open
 from typing import List
-from chromadb.utils import embedding_functions
-
-# Check for GPU availability
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
+import threading
+import artifacts
 
 # # Load pre-trained ResNet50 model
 # embedding_model = models.resnet50(pretrained=True)
@@ -26,8 +21,36 @@ print(f"Using device: {device}")
 #     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 # ])
 
-default_ef = embedding_functions.DefaultEmbeddingFunction()
-EMBEDDING_DIM_SIZE = len(default_ef(["test"])[0])
+# The default embedding function downloads and loads an ONNX model, so it and
+# the torch/chromadb imports are deferred to first use instead of import time.
+device = None
+default_ef = None
+EMBEDDING_DIM_SIZE = None
+embedding_lock = threading.Lock()
+
+def get_embedding_function():
+    """Return the default embedding function, loading it on first use."""
+    global default_ef, EMBEDDING_DIM_SIZE, device
+    with embedding_lock:
+        if default_ef is None:
+            import torch
+            from chromadb.utils import embedding_functions
+
+            # Check for GPU availability
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            print(f"Using device: {device}")
+
+            with artifacts.timed_load(artifacts.CHROMA_ONNX_MODEL):
+                artifacts.configure_chroma_embedding()
+                ef = embedding_functions.DefaultEmbeddingFunction()
+                EMBEDDING_DIM_SIZE = len(ef(["test"])[0])
+            default_ef = ef
+    return default_ef
+
+def get_embedding_dim():
+    """Return the size of the description embeddings."""
+    get_embedding_function()
+    return EMBEDDING_DIM_SIZE
 
 # def get_image_vector_embedding(image: Image):
 #         """
@@ -58,4 +81,4 @@ def get_image_description_vector_embedding(name: str):
     from chromadb.utils import embedding_functions
     """
 
-    return default_ef([name])
+    return get_embedding_function()([name])
@@ -0,0 +1,102 @@
+import os
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.datastructures import FileStorage
+
+from db import create_job, update_job, get_job
+
+# Number of uploads processed concurrently by this process, and how many more
+# may wait in line before new uploads are rejected.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 8))
+
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="upload-job")
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_SIZE)
+
+
+class JobQueueFull(Exception):
+    """Raised when every worker is busy and the wait queue is full."""
+
+
+def buffer_file(file):
+    """
+    Copy an uploaded file into memory so it outlives the request that sent it.
+
+    Args:
+        file (FileStorage): The uploaded file from the request.
+
+    Returns:
+        FileStorage: A copy backed by an in-memory buffer.
+    """
+    return FileStorage(
+        stream=BytesIO(file.read()),
+        filename=file.filename,
+        content_type=file.content_type,
+    )
+
+
+def run_job(job_id, tasks):
+    """
+    Run every (function, file, kwargs) task of a job, recording progress.
+
+    Each task function must accept a `progress(stage, fraction)` and a `job_id`
+    keyword argument and return a list of URLs, or a dict of result lists such as
+    {'urls': [...], 'image_hashes': [...]}. The lists are concatenated per key
+    into the job result.
+    """
+    results = {'urls': []}
+    try:
+        update_job(job_id, state='running', stage='starting', progress=0.0)
+        for index, (function, file, kwargs) in enumerate(tasks):
+
+            def progress(stage, fraction, index=index):
+                overall = (index + fraction) / len(tasks)
+                update_job(job_id, stage=f"{stage} ({index + 1}/{len(tasks)})", progress=round(overall, 3))
+
+            output = function(file, progress=progress, job_id=job_id, **kwargs)
+            if not isinstance(output, dict):
+                output = {'urls': output}
+            for name, values in output.items():
+                results.setdefault(name, []).extend(r for r in values if r)
+
+        update_job(job_id, state='done', stage='done', progress=1.0, result=results)
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job_id, state='failed', stage='failed', result=results, error=str(e))
+    finally:
+        job_slots.release()
+
+
+def submit_job(tasks):
+    """
+    Queue a job made of (function, file, kwargs) tasks on the worker pool.
+
+    Args:
+        tasks (list): Tasks to run in order. Files must already be buffered.
+
+    Returns:
+        str: The UUID of the new job.
+
+    Raises:
+        JobQueueFull: If no slot is free for the job.
+    """
+    if not job_slots.acquire(blocking=False):
+        raise JobQueueFull()
+
+    job_id = str(uuid.uuid4())
+    try:
+        create_job(job_id)
+        executor.submit(run_job, job_id, tasks)
+    except Exception:
+        job_slots.release()
+        raise
+    return job_id
+
+
+def get_job_status(job_id):
+    """Return the stored status of a job, or None if it is unknown."""
+    return get_job(job_id)
@@ -0,0 +1,217 @@
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from db import open_connection
+
+# Crops whose perceptual hashes differ in at most LABEL_CACHE_MAX_DISTANCE of
+# 64 bits reuse the same label. The cache keeps the LABEL_CACHE_SIZE most
+# recently used labels.
+LABEL_CACHE_ENABLED = os.getenv("LABEL_CACHE_ENABLED", "1") == "1"
+LABEL_CACHE_MAX_DISTANCE = int(os.getenv("LABEL_CACHE_MAX_DISTANCE", 6))
+LABEL_CACHE_SIZE = int(os.getenv("LABEL_CACHE_SIZE", 5000))
+# Seconds between reads of the labels other workers added to the table
+LABEL_CACHE_REFRESH_SECONDS = float(os.getenv("LABEL_CACHE_REFRESH_SECONDS", 2))
+
+
+def perceptual_hash(image):
+    """
+    64-bit DCT perceptual hash of an image.
+
+    Args:
+        image (PIL.Image): The image to hash. Transparent pixels count as black,
+        the same way they are sent to the vision model.
+
+    Returns:
+        int: The hash.
+    """
+    gray = np.asarray(image.convert('RGB').convert('L'), dtype=np.float32)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(small)[:8, :8].flatten()[1:]  # drop the DC term
+    bits = low_frequencies > np.median(low_frequencies)
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+class HashIndex:
+    """
+    Hashes of one label version, bucketed by disjoint chunks of their bits.
+    Two hashes within max_distance bits of each other agree on at least one of
+    the max_distance + 1 chunks, so a lookup only compares the hashes that
+    share a bucket with it instead of every cached hash.
+    """
+
+    def __init__(self, max_distance):
+        chunks = min(max_distance + 1, 64)
+        bounds = [64 * i // chunks for i in range(chunks + 1)]
+        self.chunks = list(zip(bounds[:-1], bounds[1:]))
+        self.max_distance = max_distance
+        self.buckets = [{} for _ in self.chunks]  # per chunk: chunk value -> set of ids
+        self.hashes = {}  # id -> hash
+
+    def keys(self, phash):
+        return [(phash >> low) & ((1 << (high - low)) - 1) for low, high in self.chunks]
+
+    def add(self, entry_id, phash):
+        if entry_id in self.hashes:
+            return
+        self.hashes[entry_id] = phash
+        for bucket, key in zip(self.buckets, self.keys(phash)):
+            bucket.setdefault(key, set()).add(entry_id)
+
+    def remove(self, entry_id):
+        phash = self.hashes.pop(entry_id, None)
+        if phash is None:
+            return
+        for bucket, key in zip(self.buckets, self.keys(phash)):
+            ids = bucket.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del bucket[key]
+
+    def nearest(self, phash):
+        """Return the ids of the hashes within max_distance, closest first."""
+        candidates = set()
+        for bucket, key in zip(self.buckets, self.keys(phash)):
+            candidates.update(bucket.get(key, ()))
+        matches = []
+        for entry_id in candidates:
+            distance = (phash ^ self.hashes[entry_id]).bit_count()
+            if distance <= self.max_distance:
+                matches.append((distance, entry_id))
+        return [entry_id for _, entry_id in sorted(matches)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class LabelCache:
+    """
+    Persistent cache of parsed vision model labels, keyed by the perceptual
+    hash of the crop and the prompt/model version, stored in SQLite.
+
+    Every process keeps an index of the hashes in memory. The rows other
+    workers add are read into it at most every refresh_seconds, and a hit is
+    checked against the table, so rows another worker evicted are dropped.
+    """
+
+    def __init__(self, max_distance=LABEL_CACHE_MAX_DISTANCE, max_entries=LABEL_CACHE_SIZE,
+                 refresh_seconds=LABEL_CACHE_REFRESH_SECONDS):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.indexes = {}  # version -> HashIndex
+        self.last_id = 0  # highest row id read from the table
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def index(self, version):
+        if version not in self.indexes:
+            self.indexes[version] = HashIndex(self.max_distance)
+        return self.indexes[version]
+
+    def size(self):
+        return sum(len(index) for index in self.indexes.values())
+
+    def refresh(self):
+        """Read the rows added since the last refresh. Call with the lock held."""
+        now = time.monotonic()
+        if self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+            return
+        self.refreshed_at = now
+
+        # rows evicted by other workers pile up in the index until they are
+        # hit, so rebuild it once it holds twice as many hashes as the table can
+        if self.size() > 2 * self.max_entries:
+            self.indexes = {}
+            self.last_id = 0
+
+        conn = open_connection()
+        try:
+            rows = conn.execute("SELECT id, phash, version FROM LabelCache WHERE id > ? ORDER BY id", (self.last_id,)).fetchall()
+        finally:
+            conn.close()
+        for entry_id, phash, version in rows:
+            self.index(version).add(entry_id, int(phash, 16))
+            self.last_id = entry_id
+
+    def forget(self, entry_ids):
+        """Drop rows that are no longer in the table from the index. Call with the lock held."""
+        for entry_id in entry_ids:
+            for index in self.indexes.values():
+                index.remove(entry_id)
+
+    def get(self, phash, version):
+        """Return the cached label for a crop hash, or None on a miss."""
+        with self.lock:
+            self.refresh()
+            entry_ids = self.index(version).nearest(phash)
+
+        row, gone = None, []
+        conn = open_connection()
+        try:
+            for entry_id in entry_ids:
+                row = conn.execute("SELECT result FROM LabelCache WHERE id = ?", (entry_id,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE LabelCache SET last_used = ? WHERE id = ?", (time.time(), entry_id))
+                    conn.commit()
+                    break
+                gone.append(entry_id)
+        finally:
+            conn.close()
+
+        with self.lock:
+            self.forget(gone)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, phash, version, result):
+        """Store a parsed label and evict the least recently used labels over the size limit."""
+        conn = open_connection()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO LabelCache (phash, version, result, last_used) VALUES (?, ?, ?, ?)",
+                (format(phash, '016x'), version, json.dumps(result), time.time()),
+            )
+            entry_id = cursor.lastrowid
+
+            # count the table, which every worker writes to, not this process's index
+            total = conn.execute("SELECT COUNT(*) FROM LabelCache").fetchone()[0]
+            evicted = []
+            if total > self.max_entries:
+                evicted = [row[0] for row in conn.execute(
+                    "SELECT id FROM LabelCache ORDER BY last_used ASC LIMIT ?",
+                    (total - self.max_entries,),
+                )]
+                conn.executemany("DELETE FROM LabelCache WHERE id = ?", [(evicted_id,) for evicted_id in evicted])
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self.lock:
+            self.index(version).add(entry_id, phash)
+            self.forget(evicted)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': self.size(),
+                'max_entries': self.max_entries,
+                'max_distance': self.max_distance,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+label_cache = LabelCache()
@@ -0,0 +1,200 @@
+import cv2
+import numpy as np
+
+
+class CompactMask:
+    """
+    Boolean mask of an object in a larger image, stored bit-packed and only
+    inside the tight box around its pixels.
+
+    Args:
+        mask (np.ndarray): 2D boolean mask of a region of the image.
+        x_offset (int): Column of the region's left edge in the image.
+        y_offset (int): Row of the region's top edge in the image.
+        image_size (tuple): (height, width) of the full image.
+        score (float): Optional quality score of the mask, e.g. SAM's predicted IoU.
+    """
+
+    def __init__(self, mask, x_offset, y_offset, image_size, score=None):
+        self.image_size = tuple(int(v) for v in image_size)
+        self.score = score
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+
+        if len(rows) == 0:
+            self.bbox = None
+            self.shape = (0, 0)
+            self.bits = np.zeros((0, 0), dtype=np.uint8)
+            return
+
+        mask = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        # bbox is inclusive: [x_min, y_min, x_max, y_max] of the mask pixels
+        self.bbox = (
+            int(x_offset + cols[0]),
+            int(y_offset + rows[0]),
+            int(x_offset + cols[-1]),
+            int(y_offset + rows[-1]),
+        )
+        self.shape = mask.shape
+        self.bits = np.packbits(mask, axis=-1)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def array(self):
+        """Return the mask inside its bbox as a boolean array."""
+        return np.unpackbits(self.bits, axis=-1, count=self.shape[1]).astype(bool)
+
+    def crop(self, x_min, y_min, x_max, y_max):
+        """Return the mask over the image region [x_min, x_max) x [y_min, y_max)."""
+        out = np.zeros((y_max - y_min, x_max - x_min), dtype=bool)
+        if self.bbox is None:
+            return out
+
+        mx, my = self.bbox[0], self.bbox[1]
+        x0, x1 = max(x_min, mx), min(x_max, mx + self.shape[1])
+        y0, y1 = max(y_min, my), min(y_max, my + self.shape[0])
+        if x0 < x1 and y0 < y1:
+            out[y0 - y_min:y1 - y_min, x0 - x_min:x1 - x_min] = self.array()[y0 - my:y1 - my, x0 - mx:x1 - mx]
+        return out
+
+    def crop_scaled(self, x_min, y_min, x_max, y_max, scale):
+        """
+        Return the mask over a region of an image `scale` times larger than
+        the one the mask was predicted on, upsampled with smooth edges.
+
+        Args:
+            x_min, y_min, x_max, y_max (int): Region [x_min, x_max) x [y_min, y_max) of the larger image.
+            scale (float): Size of the larger image over the size of the mask's image.
+        """
+        if scale == 1:
+            return self.crop(x_min, y_min, x_max, y_max)
+
+        height, width = self.image_size
+        # the region of the mask's own image covering the requested one
+        px0, py0 = int(np.floor(x_min / scale)), int(np.floor(y_min / scale))
+        px1, py1 = min(width, int(np.ceil(x_max / scale))), min(height, int(np.ceil(y_max / scale)))
+        out = np.zeros((y_max - y_min, x_max - x_min), dtype=bool)
+        if px1 <= px0 or py1 <= py0:
+            return out
+
+        region = self.crop(px0, py0, px1, py1).astype(np.uint8) * 255
+        size = (max(1, round((px1 - px0) * scale)), max(1, round((py1 - py0) * scale)))
+        upsampled = cv2.resize(region, size, interpolation=cv2.INTER_LINEAR) > 127
+
+        ox, oy = round(x_min - px0 * scale), round(y_min - py0 * scale)
+        upsampled = upsampled[oy:oy + out.shape[0], ox:ox + out.shape[1]]
+        out[:upsampled.shape[0], :upsampled.shape[1]] = upsampled
+        return out
+
+    def to_array(self):
+        """Return the mask over the full image."""
+        height, width = self.image_size
+        return self.crop(0, 0, width, height)
+
+
+def mask_regions(logits, scale_y, scale_x, image_size, threshold=0.0):
+    """
+    Find, for all masks at once, the image region that can contain mask pixels.
+
+    A bilinearly upsampled pixel can only pass the threshold if one of the low
+    resolution samples next to it does, so the low resolution extent grown by
+    one sample bounds the full resolution mask.
+
+    Args:
+        logits (np.ndarray): Low resolution mask logits of shape (N, h, w).
+        scale_y, scale_x (float): Low resolution samples per image pixel.
+        image_size (tuple): (height, width) of the image.
+
+    Returns:
+        np.ndarray: (N, 4) int regions [x_start, y_start, x_end, y_end), all zero for empty masks.
+    """
+    height, width = image_size
+    _, low_h, low_w = logits.shape
+
+    positive = logits > threshold
+    rows = positive.any(axis=2)
+    cols = positive.any(axis=1)
+    present = rows.any(axis=1)
+
+    y0 = rows.argmax(axis=1)
+    y1 = low_h - 1 - rows[:, ::-1].argmax(axis=1)
+    x0 = cols.argmax(axis=1)
+    x1 = low_w - 1 - cols[:, ::-1].argmax(axis=1)
+
+    regions = np.stack([
+        np.floor((x0 - 1) / scale_x),
+        np.floor((y0 - 1) / scale_y),
+        np.ceil((x1 + 2) / scale_x),
+        np.ceil((y1 + 2) / scale_y),
+    ], axis=1)
+    regions = np.clip(regions, 0, [width, height, width, height]).astype(int)
+    regions[~present] = 0
+    return regions
+
+
+def interpolation_indices(start, end, scale, size):
+    """Neighbouring low resolution samples and weights for image pixels start..end."""
+    positions = (np.arange(start, end) + 0.5) * scale - 0.5
+    positions = np.clip(positions, 0, size - 1)
+    low = np.floor(positions).astype(int)
+    high = np.minimum(low + 1, size - 1)
+    return low, high, (positions - low).astype(np.float32)
+
+
+def upsample_masks(logits, image_size, reshaped_size, pad_size=(1024, 1024), threshold=0.0, scores=None):
+    """
+    Turn SAM low resolution mask logits into CompactMasks at image resolution,
+    upsampling each mask only inside its own region.
+
+    Args:
+        logits (np.ndarray): Mask logits of shape (N, h, w), usually 256x256.
+        image_size (tuple): (height, width) of the original image.
+        reshaped_size (tuple): (height, width) the image was resized to inside SAM's input.
+        pad_size (tuple): (height, width) of SAM's padded input.
+        threshold (float): Logit above which a pixel belongs to the mask.
+        scores (np.ndarray): Optional (N,) quality score per mask, kept on the CompactMask.
+
+    Returns:
+        list: One CompactMask per input mask.
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    _, low_h, low_w = logits.shape
+    height, width = image_size
+    scale_y = reshaped_size[0] / height * low_h / pad_size[0]
+    scale_x = reshaped_size[1] / width * low_w / pad_size[1]
+
+    scores = [None] * len(logits) if scores is None else [float(score) for score in scores]
+
+    masks = []
+    regions = mask_regions(logits, scale_y, scale_x, image_size, threshold)
+    for mask_logits, (x_start, y_start, x_end, y_end), score in zip(logits, regions, scores):
+        if x_end <= x_start or y_end <= y_start:
+            masks.append(CompactMask(np.zeros((0, 0), dtype=bool), 0, 0, image_size, score))
+            continue
+
+        y_low, y_high, y_weight = interpolation_indices(y_start, y_end, scale_y, low_h)
+        x_low, x_high, x_weight = interpolation_indices(x_start, x_end, scale_x, low_w)
+
+        # Separable bilinear interpolation over the few low resolution rows involved
+        row_start, row_end = y_low.min(), y_high.max() + 1
+        band = mask_logits[row_start:row_end]
+        columns = band[:, x_low] * (1 - x_weight) + band[:, x_high] * x_weight
+        region = columns[y_low - row_start] * (1 - y_weight)[:, None] + columns[y_high - row_start] * y_weight[:, None]
+
+        masks.append(CompactMask(region > threshold, x_start, y_start, image_size, score))
+    return masks
+
+
+def mask_iou(a, b):
+    """Intersection over union of two CompactMasks of the same image."""
+    if a.bbox is None or b.bbox is None:
+        return 1.0 if a.bbox is None and b.bbox is None else 0.0
+
+    x_min, y_min = min(a.bbox[0], b.bbox[0]), min(a.bbox[1], b.bbox[1])
+    x_max, y_max = max(a.bbox[2], b.bbox[2]) + 1, max(a.bbox[3], b.bbox[3]) + 1
+    mask_a = a.crop(x_min, y_min, x_max, y_max)
+    mask_b = b.crop(x_min, y_min, x_max, y_max)
+    union = np.logical_or(mask_a, mask_b).sum()
+    return float(np.logical_and(mask_a, mask_b).sum() / union) if union else 0.0
@@ -6,15 +6,45 @@ from typing import List
 from image_embedding import get_image_description_vector_embedding
 import hyperbolic
 import stitcher
-from predict import segment, get_unique_filename, show_masks_and_boxes_on_image
+import tracking
+from predict import segment, detect, segment_boxes, crop_segments, get_unique_filename, show_masks_and_boxes_on_image
+from embedding_cache import EMBEDDING_CACHE_DIR, image_hash
 import threading
-from chroma import add_image_vector_to_collection
+from chroma import add_image_vectors_to_collection
 from aws import upload_image_to_s3
-from db import update_item
+from db import update_items
 import io
 from io import BytesIO
 import base64
+import os
+import time
+import cv2
 import numpy as np
+from PIL import ImageOps
+
+# "panorama" stitches the video and segments the panorama, falling back to
+# "keyframes" when stitching fails; "keyframes" skips the panorama and
+# labels the best view of every item tracked across the keyframes.
+VIDEO_MODE = os.getenv("VIDEO_MODE", "panorama")
+
+# Uploaded photos are decoded at no more than this many pixels on their
+# longest side; JPEGs are decoded directly at a reduced DCT scale. Detection
+# and segmentation run on a SEGMENT_PROXY_MAX_SIDE proxy of the decoded
+# image, the crops are cut from the decoded image itself, so this is kept
+# above the proxy size for the crops to be sharper than the proxy.
+IMAGE_DECODE_MAX_SIDE = int(os.getenv("IMAGE_DECODE_MAX_SIDE", 8192))
+
+def report_progress(progress, stage, fraction):
+    """
+    Report the current pipeline stage to an optional progress callback.
+
+    Args
+    -   progress: callable(stage, fraction) or None
+    -   stage(str): name of the stage that is starting
+    -   fraction(float): fraction of the pipeline completed, between 0 and 1
+    """
+    if progress is not None:
+        progress(stage, fraction)
 
 def get_items_from_image(image, debug: bool = False):
     """
@@ -23,10 +53,76 @@ def get_items_from_image(image, debug: bool = False):
     
     Returns list of cropped segmented 
     images of items (PIL.Image)
-    from a single panoramic image. 
+    from a single panoramic image,
+    and the hashes of the images segmented.
+    """
+    segmented_images, segmented_images_bboxes, transparent_segmented_images, key = segment(image, debug)
+    return segmented_images, segmented_images_bboxes, transparent_segmented_images, [key]
+
+def get_items_from_keyframes(frames):
+    """
+    Args
+    -   frames: list of BGR keyframes of a video, in order
+
+    Returns the same lists as get_items_from_image, with one crop
+    per item tracked across the keyframes instead of per panorama detection.
+    """
+    frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
+    segmented_images, segmented_images_bboxes, transparent_segmented_images, keys = [], [], [], []
+    for index, bboxes in tracking.best_views(frames, detect).items():
+        _, masks = segment_boxes(frames[index], bboxes)
+        crops, crop_bboxes, transparent_crops = crop_segments(Image.fromarray(frames[index]), masks)
+        segmented_images += crops
+        segmented_images_bboxes += crop_bboxes
+        transparent_segmented_images += transparent_crops
+        keys.append(image_hash(frames[index]))
+    return segmented_images, segmented_images_bboxes, transparent_segmented_images, keys
+
+def get_items_from_video(video, progress=None):
+    """
+    Args
+    -   video: a video file of a room
+    -   progress: optional callable(stage, fraction)
+
+    Returns the segmented item crops of the video according to VIDEO_MODE,
+    and the hashes of the images segmented.
+    """
+    if VIDEO_MODE == 'panorama':
+        # 1) load panorama photo from video
+        report_progress(progress, 'stitching', 0.0)
+        panorama_image = stitcher.create_panorama(video)
+        if panorama_image is not None:
+            print("Panorama image created.")
+            print("pano type", type(panorama_image))
+            print("pano shape", panorama_image.shape)
+
+            # 2) get items from the image
+            report_progress(progress, 'segmenting', 0.4)
+            return get_items_from_image(panorama_image)
+        print("Stitching failed, falling back to keyframe tracking.")
+
+    # 1) load keyframes close enough together to track items between them
+    report_progress(progress, 'reading keyframes', 0.0)
+    frames = stitcher.read_keyframes(video, min_motion=tracking.TRACK_MIN_MOTION, budget=tracking.TRACK_FRAME_BUDGET)
+
+    # 2) get the best view of every tracked item
+    report_progress(progress, 'tracking', 0.2)
+    return get_items_from_keyframes(frames)
+
+def get_item_data(result):
     """
-    segmented_images, segmented_images_bboxes, transparent_segmented_images = segment(image, debug)
-    return segmented_images, segmented_images_bboxes, transparent_segmented_images
+    Given the labeling result of an image, returns a tuple of all the image data
+
+    Returns:
+    - (vectorEmbedding, name, desc, category, price)
+    """
+    name = result['name'] # PRANAV: get name
+    desc = result['description'] # PRANAV: get desc
+    category = result['category'] # PRANAV: get category
+    price = result['price']
+    vector_embedding = get_image_description_vector_embedding(name+": "+desc)
+
+    return (vector_embedding, name, desc, category, price)
 
 def get_image_data(image, transparent_image):
     """
@@ -36,24 +132,17 @@ def get_image_data(image, transparent_image):
     - (vectorEmbedding, name, desc, category)
     """
 
-    results = hyperbolic.process_images([transparent_image])
-    if not results:
+    result = hyperbolic.label_images([transparent_image])[0]
+    if not result:
         return None
     else:
-        result = results[0]
-
-        name = result['name'] # PRANAV: get name
-        desc = result['description'] # PRANAV: get desc
-        category = result['category'] # PRANAV: get category
-        price = result['price']
-        vector_embedding = get_image_description_vector_embedding(name+": "+desc)
-
-        return (vector_embedding, name, desc, category, price)
+        return get_item_data(result)
 
 def get_image_filtered_list_data(images, transparent_images, bboxes: List[List[int]]):
     """
     Given a list of images (tensors) returns a list of
-    tuples where each tuple contains important data of the image
+    tuples where each tuple contains important data of the image.
+    All images are labeled concurrently by hyperbolic.label_images.
 
     Args:
     - list of unfiltered images
@@ -63,38 +152,42 @@ def get_image_filtered_list_data(images, transparent_images, bboxes: List[List[i
     """
     res = []
     filtered_images = []
-    for image, transparent_image, bbox in zip(images, transparent_images, bboxes):
-        img_data = get_image_data(image, transparent_image)
-        if img_data: # only if image data is valid append
-            res.append(img_data)
+    results = hyperbolic.label_images(transparent_images)
+    for image, transparent_image, bbox, result in zip(images, transparent_images, bboxes, results):
+        if result: # only if image data is valid append
+            res.append(get_item_data(result))
             filtered_images.append(transparent_image)
     return res, filtered_images
 
-def process_video(video: object, s3: object, before=True, status='pending'):
+def upload_result(image_urls, image_hashes):
+    """The result of an upload task, with the image hashes only if /resegment can find images by hash."""
+    if not EMBEDDING_CACHE_DIR:
+        return {'urls': image_urls}
+    return {'urls': image_urls, 'image_hashes': image_hashes}
+
+def process_video(video: object, s3: object, before=True, status='pending', progress=None, job_id=None):
     """
     Args
     - video: a video file of a room
     - s3: s3 client
     - before(bool): boolean of whether video is from before damage (True) or after image (False)
     - status(str): status of item images generated by video (pending, rejected, etc.)
+    - progress: optional callable(stage, fraction) notified as each stage starts
+    - job_id(str): optional upload job the images belong to
 
     Return
-    - List[String]: response of successful image upload
+    - dict: 'urls' of the uploaded item images and, if EMBEDDING_CACHE_DIR is set, 'image_hashes' of the segmented images
     """
 
-    # 1) load panorama photo from video
-    panorama_image = stitcher.create_panorama(video)
-    print("Panorama image created.")
-    print("pano type", type(panorama_image))
-    print("pano shape", panorama_image.shape)
-
-    # 2) get items from the image
-    segmented_images, segmented_images_bboxes, transparent_segmented_images = get_items_from_image(panorama_image)
+    # 1-2) get items from the video, via a panorama or tracked keyframes (see VIDEO_MODE)
+    segmented_images, segmented_images_bboxes, transparent_segmented_images, image_hashes = get_items_from_video(video, progress)
 
     # 3) get image data from the segmented images
+    report_progress(progress, 'labeling', 0.6)
     image_data_list, filtered_images = get_image_filtered_list_data(segmented_images, transparent_segmented_images, segmented_images_bboxes)
     
     # 4) upload ALL (item) IMAGE DATA to chromadb using vector embedding + name, desc, category, price
+    report_progress(progress, 'uploading', 0.9)
     image_urls = []
     
     for file in filtered_images:
@@ -104,35 +197,76 @@ def process_video(video: object, s3: object, before=True, status='pending'):
         image_url = upload_image_to_s3(s3, buffered_img)
         image_urls.append(image_url)
 
-    for url, data in zip(image_urls, image_data_list):
-        vector_embedding, name, desc, category, price = data
-
-        # Add image to chromadb
-        image_id, item_id = add_image_vector_to_collection(vector_embedding, url, before, status)
-        print(f"Added image with item_id {image_id} to the collection.")
+    # Add all images to chromadb in one batch
+    ids = add_image_vectors_to_collection([data[0] for data in image_data_list], image_urls, before, status, job_id=job_id)
 
-        # Update item in SQLite db with image data
-        update_item(item_id, name, desc, category, price, before)
+    # Update the items in SQLite db with image data in one transaction
+    update_items([
+        (item_id, name, desc, category, price)
+        for (image_id, item_id), (vector_embedding, name, desc, category, price) in zip(ids, image_data_list)
+    ], before)
     
 
-    # filtered_images are the images we want to display on frontend
-    return image_urls
+    # filtered_images are the images we want to display on frontend,
+    # the hashes let /resegment reuse the SAM embeddings of this upload
+    return upload_result(image_urls, image_hashes)
+
+def current_rss_mb():
+    """Resident memory of this process in MB right now, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return None
+
+def decode_image(file, max_side=IMAGE_DECODE_MAX_SIDE):
+    """
+    Decode an uploaded photo straight from its stream into an RGB array,
+    upright according to its EXIF orientation and no larger than needed.
+
+    Args
+    -   file: FileStorage of the upload
+    -   max_side(int): longest side of the decoded image, 0 for full size
 
-def process_image(image, s3: object, before=True, status='pending'):
+    Returns np.ndarray of shape (height, width, 3)
+    """
+    started = time.perf_counter()
+    rss_before = current_rss_mb()
+    image = Image.open(file.stream)
+    full_size = image.size
+
+    if max_side and max(image.size) > max_side:
+        ratio = max_side / max(image.size)
+        # JPEG only: let libjpeg decode at 1/2, 1/4 or 1/8 scale, no smaller than the target
+        image.draft('RGB', (round(image.width * ratio), round(image.height * ratio)))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=2.0)
+
+    array = np.asarray(image)
+    rss_after = current_rss_mb()
+    rss_change = f", RSS {rss_after - rss_before:+.0f} MB" if rss_before is not None and rss_after is not None else ""
+    print(f"Decoded {full_size[0]}x{full_size[1]} image at {array.shape[1]}x{array.shape[0]} "
+          f"({array.nbytes / 2**20:.0f} MB) in {time.perf_counter() - started:.3f}s{rss_change}")
+    return array
+
+def process_image(image, s3: object, before=True, status='pending', progress=None):
     """
     Args
     - image: a single image of a room
     - s3: s3 client
     - before(bool): boolean of whether video is from before damage (True) or after image (False)
     - status(str): status of item images generated by video (pending, rejected, etc.)
+    - progress: optional callable(stage, fraction) notified as each stage starts
+    - job_id(str): optional upload job the images belong to
 
     Return
-    - List[String]: response of successful image upload
+    - dict: 'urls' of the uploaded item images and, if EMBEDDING_CACHE_DIR is set, 'image_hashes' of the segmented images
     """
-    image = Image.open(io.BytesIO(image.read()))
-
-    image = image.convert('RGB')
-    image = np.asarray(image)
+    image = decode_image(image)
 
     # print image shape
     print("image type", type(image))
@@ -141,14 +275,17 @@ def process_image(image, s3: object, before=True, status='pending'):
 
     # 1) get items from the image
     print("Processing image...")
-    segmented_images, segmented_images_bboxes, transparent_segmented_images = get_items_from_image(image)
+    report_progress(progress, 'segmenting', 0.0)
+    segmented_images, segmented_images_bboxes, transparent_segmented_images, image_hashes = get_items_from_image(image)
 
     print("Segmented images")
     # 2) get image data from the segmented images
+    report_progress(progress, 'labeling', 0.4)
     image_data_list, filtered_images = get_image_filtered_list_data(segmented_images, transparent_segmented_images, segmented_images_bboxes)
     
     print("Image data list")
     # 3) upload ALL (item) IMAGE DATA to chromadb using vector embedding + name, desc, category, price
+    report_progress(progress, 'uploading', 0.85)
     image_urls = []
     
     for file in filtered_images:
@@ -158,16 +295,16 @@ def process_image(image, s3: object, before=True, status='pending'):
         image_url = upload_image_to_s3(s3, buffered_img)
         image_urls.append(image_url)
 
-    for url, data in zip(image_urls, image_data_list):
-        vector_embedding, name, desc, category, price = data
-
-        # Add image to chromadb
-        image_id, item_id = add_image_vector_to_collection(vector_embedding, url, before, status)
-        print(f"Added image with item_id {image_id} to the collection.")
+    # Add all images to chromadb in one batch
+    ids = add_image_vectors_to_collection([data[0] for data in image_data_list], image_urls, before, status, job_id=job_id)
 
-        # Update item in SQLite db with image data
-        update_item(item_id, name, desc, category, price, before)
+    # Update the items in SQLite db with image data in one transaction
+    update_items([
+        (item_id, name, desc, category, price)
+        for (image_id, item_id), (vector_embedding, name, desc, category, price) in zip(ids, image_data_list)
+    ], before)
     
 
-    # filtered_images are the images we want to display on frontend
-    return image_urls
\ No newline at end of file
+    # filtered_images are the images we want to display on frontend,
+    # the hashes let /resegment reuse the SAM embeddings of this upload
+    return upload_result(image_urls, image_hashes)
\ No newline at end of file
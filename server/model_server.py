@@ -0,0 +1,195 @@
+"""
+Standalone process that holds the YOLO and SAM models once and serves
+detection/segmentation requests to the API workers over a local socket.
+
+Run it next to gunicorn with the same MODEL_SERVER_ADDRESS, e.g.
+
+    MODEL_SERVER_ADDRESS=/tmp/insurai-models.sock python model_server.py
+
+MODEL_SERVER_ADDRESS is either a unix socket path or host:port.
+
+Requests are unpickled, so whoever can connect can run code in this process.
+MODEL_SERVER_AUTHKEY must be set to the same secret for the server and the
+API workers whenever the address is host:port; without it the server only
+listens on a unix socket, which only its own user can open.
+"""
+import os
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+MODEL_SERVER_ADDRESS = os.getenv("MODEL_SERVER_ADDRESS")
+MODEL_SERVER_AUTHKEY = os.getenv("MODEL_SERVER_AUTHKEY")
+MODEL_SERVER_AUTHKEY = MODEL_SERVER_AUTHKEY.encode() if MODEL_SERVER_AUTHKEY else None
+
+
+def parse_address(address):
+    """Turn 'host:port' into a (host, port) tuple, leave socket paths as they are."""
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+class ModelServerClient:
+    """
+    Client used by the API workers. Keeps one connection per thread and
+    reconnects once if the model server was restarted.
+    """
+
+    def __init__(self, address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = Client(self.address, authkey=self.authkey)
+        return self.local.conn
+
+    def call(self, request):
+        for attempt in range(2):
+            try:
+                conn = self.connection()
+                conn.send(request)
+                response = conn.recv()
+                break
+            except (EOFError, OSError):
+                self.local.conn = None
+                if attempt == 1:
+                    raise
+        if not response.get('ok'):
+            raise RuntimeError(f"Model server error: {response.get('error')}")
+        return response
+
+    def detect_and_segment(self, image, scale=1.0):
+        """
+        Run YOLO detection and SAM segmentation on the model server.
+
+        Args:
+            image (np.ndarray): RGB image array.
+            scale (float): Full resolution size over the image size, for a proxy.
+
+        Returns:
+            (list, list): Bounding boxes and a bit-packed CompactMask per box.
+        """
+        response = self.call({'op': 'segment', 'image': np.ascontiguousarray(image), 'scale': scale})
+        return response['bboxes'], response['masks']
+
+    def detect(self, image):
+        """Run YOLO detection only, see predict.detect_local."""
+        return self.call({'op': 'detect', 'image': np.ascontiguousarray(image)})['detections']
+
+    def segment_boxes(self, image, bboxes):
+        """Segment given boxes, see predict.segment_boxes_local."""
+        response = self.call({'op': 'segment_boxes', 'image': np.ascontiguousarray(image), 'bboxes': bboxes})
+        return response['bboxes'], response['masks']
+
+    def resegment(self, image, boxes=None, points=None, labels=None):
+        """Decode extra prompts on the model server, see predict.resegment_local."""
+        response = self.call({
+            'op': 'resegment',
+            'image': np.ascontiguousarray(image),
+            'boxes': boxes,
+            'points': points,
+            'labels': labels,
+        })
+        return response['image_hash'], response['masks']
+
+    def load_cached_image(self, key):
+        """Return the source image spilled to the model server's embedding cache, or None."""
+        return self.call({'op': 'cached_image', 'image_hash': key})['image']
+
+    def ping(self):
+        return self.call({'op': 'ping'})
+
+    def stats(self):
+        """Return the batching statistics of the model server."""
+        return self.call({'op': 'stats'})['stats']
+
+
+def handle_request(request):
+    """Run a single request against the models loaded in this process."""
+    import predict
+
+    op = request.get('op')
+    if op == 'ping':
+        return {'ok': True}
+    if op == 'stats':
+        return {'ok': True, 'stats': predict.inference_stats()}
+    if op == 'segment':
+        bboxes, masks = predict.detect_and_segment_local(request['image'], request.get('scale', 1.0))
+        return {'ok': True, 'bboxes': bboxes, 'masks': masks}
+    if op == 'detect':
+        return {'ok': True, 'detections': predict.detect_local(request['image'])}
+    if op == 'segment_boxes':
+        bboxes, masks = predict.segment_boxes_local(request['image'], request['bboxes'])
+        return {'ok': True, 'bboxes': bboxes, 'masks': masks}
+    if op == 'resegment':
+        key, masks = predict.resegment_local(request['image'], request['boxes'], request['points'], request['labels'])
+        return {'ok': True, 'image_hash': key, 'masks': masks}
+    if op == 'cached_image':
+        # read the cache of this process, predict.load_cached_image may forward to a client
+        image = predict.EMBEDDING_CACHE.load_image(request['image_hash'])
+        return {'ok': True, 'image': None if image is None else np.asarray(image)}
+    return {'ok': False, 'error': f"Unknown op {op}"}
+
+
+def serve_connection(conn):
+    try:
+        while True:
+            request = conn.recv()
+            try:
+                # requests from different workers meet in the predict.py batchers
+                response = handle_request(request)
+            except Exception as e:
+                traceback.print_exc()
+                response = {'ok': False, 'error': str(e)}
+            conn.send(response)
+    except EOFError:
+        pass
+    finally:
+        conn.close()
+
+
+def serve(address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+    """Load the models once and answer requests until the process is killed."""
+    address = parse_address(address)
+    if not isinstance(address, str) and not authkey:
+        raise SystemExit("MODEL_SERVER_AUTHKEY must be set to serve models over TCP.")
+
+    import predict
+
+    predict.load_models()
+    # predict.py builds a client from MODEL_SERVER_ADDRESS too; in this process
+    # its dispatchers must run locally instead of calling the server itself
+    predict.MODEL_CLIENT = None
+
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+
+    # the socket file takes its mode from the umask when the listener binds it
+    old_umask = os.umask(0o177) if isinstance(address, str) else None
+    try:
+        listener = Listener(address, authkey=authkey)
+    finally:
+        if old_umask is not None:
+            os.umask(old_umask)
+
+    with listener:
+        print(f"Model server listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Error accepting model server connection: {e}")
+                continue
+            threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    if not MODEL_SERVER_ADDRESS:
+        raise SystemExit("MODEL_SERVER_ADDRESS environment variable not set.")
+    serve()
@@ -5,19 +5,66 @@ import matplotlib.patches as patches
 import gc
 from PIL import Image, ImageDraw
 import os
-from transformers import pipeline, SamModel, SamProcessor
-from ultralytics import YOLO
+import threading
 import supervision as sv
 import cv2
+from batching import MicroBatcher
+from embedding_cache import EmbeddingCache, image_hash
+from masks import upsample_masks
+import backends
+import pruning
+import tiling
 
 # --- Global Model Loading ---
-# Load models once at application startup to avoid reloading on every request.
-print("Loading ML models into memory...")
+# Load models once, on first use or by the warm-up in warmup.py, to avoid
+# reloading on every request. When MODEL_SERVER_ADDRESS is set the models live
+# in model_server.py instead, and this process only forwards requests to it.
+# The model family and runtime are configured in backends.py.
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-YOLO_MODEL = YOLO("yolov8n.pt")
-SAM_MODEL = SamModel.from_pretrained("facebook/sam-vit-huge").to(DEVICE)
-SAM_PROCESSOR = SamProcessor.from_pretrained("facebook/sam-vit-huge")
-print("ML models loaded successfully.")
+MODEL_SERVER_ADDRESS = os.getenv("MODEL_SERVER_ADDRESS")
+YOLO_MODEL = None
+SAM_MODEL = None
+SAM_PROCESSOR = None
+SAM_ENCODER = None
+SAM_TAG = None
+MODEL_CLIENT = None
+
+# Cross-request micro-batching knobs: a larger batch or wait raises throughput
+# under concurrent uploads at the cost of latency for a lone request.
+DETECTION_BATCH_SIZE = int(os.getenv("DETECTION_BATCH_SIZE", 4))
+SEGMENTATION_BATCH_SIZE = int(os.getenv("SEGMENTATION_BATCH_SIZE", 2))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 10))
+
+EMBEDDING_CACHE = EmbeddingCache()
+
+# Images are segmented, and detected unless tiling.py slices them, at no more
+# than this many pixels on their longest side (SAM works at 1024 internally);
+# crops are cut at full resolution.
+SEGMENT_PROXY_MAX_SIDE = int(os.getenv("SEGMENT_PROXY_MAX_SIDE", 4096))
+
+def load_models():
+    """Load the YOLO and SAM models into this process."""
+    global YOLO_MODEL, SAM_MODEL, SAM_PROCESSOR, SAM_ENCODER, SAM_TAG
+    print("Loading ML models into memory...")
+    YOLO_MODEL = backends.load_yolo()
+    SAM_MODEL, SAM_PROCESSOR, SAM_ENCODER, SAM_TAG = backends.load_sam(DEVICE)
+    print(f"ML models loaded successfully ({backends.DETECTION_MODEL}, {SAM_TAG}).")
+
+MODELS_LOCK = threading.Lock()
+
+def ensure_models():
+    """Load the models if they are not loaded yet, or check the model server answers."""
+    if MODEL_CLIENT is not None:
+        MODEL_CLIENT.ping()
+        return
+    with MODELS_LOCK:
+        if YOLO_MODEL is None or SAM_ENCODER is None:
+            load_models()
+
+if MODEL_SERVER_ADDRESS:
+    from model_server import ModelServerClient
+    MODEL_CLIENT = ModelServerClient(MODEL_SERVER_ADDRESS)
+    print(f"Using model server at {MODEL_SERVER_ADDRESS}")
 # --- End Global Model Loading ---
 
 def show_mask(mask, ax, random_color=False):
@@ -57,8 +104,7 @@ def show_masks_and_boxes_on_image(raw_image, masks, bboxes, save_path):
     ax = plt.gca()
     ax.set_autoscale_on(False)
     for mask in masks:
-        for m in mask:
-            show_mask(np.array(m), ax=ax, random_color=True)
+        show_mask(mask.to_array(), ax=ax, random_color=True)
     for bbox in bboxes:
         x_min, y_min, x_max, y_max = bbox
         rect = patches.Rectangle((x_min, y_min), x_max - x_min, y_max - y_min, linewidth=1, edgecolor='g', facecolor='none')
@@ -68,73 +114,291 @@ def show_masks_and_boxes_on_image(raw_image, masks, bboxes, save_path):
     plt.close()
     gc.collect()
 
+def to_detections(result):
+    """Apply class-agnostic NMS to a YOLO result and return it as sv.Detections."""
+    return sv.Detections.from_ultralytics(result).with_nms(threshold=0.05, class_agnostic=True)
+
+def detections_to_bboxes(result):
+    """Apply class-agnostic NMS to a YOLO result and return its boxes as lists."""
+    return [box.tolist() for box in to_detections(result).xyxy]
+
 def detect_objects(image: Image, yolo_model):
     """Detect objects in an image using the global YOLO model."""
     results = yolo_model(image, conf=0.01)[0]
-    results = sv.Detections.from_ultralytics(results).with_nms(threshold=0.05, class_agnostic=True)
-    bboxes = [result[0].tolist() for result in results]
+    bboxes = detections_to_bboxes(results)
     return image, bboxes
 
-def segment_image(raw_image, bboxes):
+def detect_objects_batch(images):
     """
-    Segment the image using the global SAM model and return the masks.
+    Detect objects in several images with batched YOLO forward passes.
+    Large images are sliced into overlapping tiles whose boxes are merged
+    back, see tiling.py.
+
+    Returns a list of sv.Detections, one per image.
+    """
+    return tiling.detect_tiled(YOLO_MODEL, list(images), nms_threshold=0.05, conf=0.01)
+
+def segment_images_batch(requests):
+    """
+    Segment several images with one batched SAM encoder and decoder pass.
+
+    Args:
+        requests: list of (PIL.Image, bboxes) tuples, every bboxes list non-empty.
+
+    Returns a list of CompactMask lists, one per image.
     """
     # Use the globally loaded models and device
     device = DEVICE
     model = SAM_MODEL
     processor = SAM_PROCESSOR
 
-    inputs = processor(raw_image, return_tensors="pt").to(device)
-    image_embeddings = model.get_image_embeddings(inputs["pixel_values"])
+    images = [raw_image for raw_image, _ in requests]
+    box_counts = [len(bboxes) for _, bboxes in requests]
+
+    # The decoder needs the same number of prompts per image, so shorter box
+    # lists are padded with their first box and the extra masks dropped below
+    max_boxes = max(box_counts)
+    input_boxes = [list(bboxes) + [bboxes[0]] * (max_boxes - len(bboxes)) for _, bboxes in requests]
 
-    inputs = processor(raw_image, input_boxes=[bboxes], return_tensors="pt").to(device)
-    inputs.pop("pixel_values", None)
-    inputs.update({"image_embeddings": image_embeddings})
+    inputs = processor(images, input_boxes=input_boxes, return_tensors="pt").to(device)
+    pixel_values = inputs.pop("pixel_values")
 
     with torch.no_grad():
+        inputs["image_embeddings"] = get_image_embeddings(images, pixel_values)
         outputs = model(**inputs, multimask_output=False)
 
-    masks = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu())
-    return masks[0]
+    return [
+        low_res_to_masks(
+            outputs.pred_masks[i, :count, 0],
+            inputs["original_sizes"][i],
+            inputs["reshaped_input_sizes"][i],
+            outputs.iou_scores[i, :count, 0],
+        )
+        for i, count in enumerate(box_counts)
+    ]
 
-def segment(image: Image, debug=False, padding=10):
+def low_res_to_masks(low_res_masks, original_size, reshaped_size, scores=None):
     """
-    Segment objects in an image and return segmented images with masks outlined.
+    Upsample SAM's low resolution mask logits to the original image size,
+    only inside each mask's own region, instead of post_process_masks
+    producing N full resolution masks. SAM's predicted IoU of each mask is
+    kept as its score.
     """
-    image = Image.fromarray(image)
-    raw_image, bboxes = detect_objects(image, YOLO_MODEL)
-    masks = segment_image(raw_image, bboxes)
-    if debug:
-        if not os.path.exists("./images"):
-            os.makedirs("./images")
-        save_boxes_path = get_unique_filename("./images/boxes_image.png") 
-        show_masks_and_boxes_on_image(raw_image, [], bboxes, save_boxes_path)
-        save_masked_path = get_unique_filename("./images/masked_image.png")
-        show_masks_and_boxes_on_image(raw_image, masks, [], save_masked_path)
+    pad_size = SAM_PROCESSOR.image_processor.pad_size
+    return upsample_masks(
+        low_res_masks.cpu().numpy(),
+        tuple(original_size.tolist()),
+        tuple(reshaped_size.tolist()),
+        (pad_size["height"], pad_size["width"]),
+        scores=None if scores is None else scores.cpu().numpy(),
+    )
 
+def get_image_embeddings(images, pixel_values, keys=None):
+    """
+    Return SAM image embeddings for a batch, running the image encoder only
+    for images whose embedding is not in EMBEDDING_CACHE.
+
+    Args:
+        images: list of PIL images.
+        pixel_values: preprocessed batch from the SAM processor.
+        keys: optional precomputed image hashes.
+    """
+    keys = keys or [image_hash(image) for image in images]
+    # Embeddings from different SAM models or runtimes are not interchangeable
+    embedding_keys = [f"{key}-{SAM_TAG}" for key in keys]
+    embeddings = [EMBEDDING_CACHE.get(key) for key in embedding_keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    if missing:
+        computed = SAM_ENCODER(pixel_values[missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding.unsqueeze(0)
+            EMBEDDING_CACHE.put(embedding_keys[i], embeddings[i])
+            EMBEDDING_CACHE.save_image(keys[i], images[i])
+
+    return torch.cat(embeddings).to(DEVICE)
+
+def decode_prompts(raw_image, key, **prompts):
+    """
+    Run only the SAM mask decoder for one image and a set of prompts,
+    reusing the cached image embedding when there is one.
+
+    Returns a list of CompactMask.
+    """
+    inputs = SAM_PROCESSOR(raw_image, return_tensors="pt", **prompts).to(DEVICE)
+    pixel_values = inputs.pop("pixel_values")
+
+    with torch.no_grad():
+        inputs["image_embeddings"] = get_image_embeddings([raw_image], pixel_values, keys=[key])
+        outputs = SAM_MODEL(**inputs, multimask_output=False)
+
+    return low_res_to_masks(
+        outputs.pred_masks[0, :, 0], inputs["original_sizes"][0], inputs["reshaped_input_sizes"][0], outputs.iou_scores[0, :, 0]
+    )
+
+def resegment_local(image, boxes=None, points=None, labels=None):
+    """
+    Segment extra prompts on an image with the models in this process.
+
+    Args:
+        image (np.ndarray): RGB image array.
+        boxes (list): Optional [x_min, y_min, x_max, y_max] boxes, one mask each.
+        points (list): Optional [x, y] points that together describe one object.
+        labels (list): One label per point, 1 for foreground and 0 for background.
+
+    Returns:
+        (str, list): The image hash and a CompactMask per prompt.
+    """
+    raw_image = Image.fromarray(image)
+    key = image_hash(image)
+    masks = []
+
+    if boxes:
+        masks += decode_prompts(raw_image, key, input_boxes=[boxes])
+    if points:
+        labels = labels or [1] * len(points)
+        masks += decode_prompts(raw_image, key, input_points=[[points]], input_labels=[[labels]])
+
+    return key, masks
+
+def resegment(image, boxes=None, points=None, labels=None):
+    """Segment extra prompts on the model server if configured, else locally."""
+    if MODEL_CLIENT is not None:
+        return MODEL_CLIENT.resegment(image, boxes, points, labels)
+    ensure_models()
+    return resegment_local(image, boxes, points, labels)
+
+def load_cached_image(key):
+    """Return the source image spilled to the embedding cache for key, or None."""
+    if MODEL_CLIENT is not None:
+        image = MODEL_CLIENT.load_cached_image(key)
+    else:
+        image = EMBEDDING_CACHE.load_image(key)
+    return None if image is None else np.asarray(image)
+
+def segment_image(raw_image, bboxes):
+    """
+    Segment the image using the global SAM model and return the masks.
+    """
+    return segment_images_batch([(raw_image, bboxes)])[0]
+
+DETECTION_BATCHER = MicroBatcher(detect_objects_batch, DETECTION_BATCH_SIZE, BATCH_MAX_WAIT_MS, name="yolo-detection")
+SEGMENTATION_BATCHER = MicroBatcher(segment_images_batch, SEGMENTATION_BATCH_SIZE, BATCH_MAX_WAIT_MS, name="sam-segmentation")
+
+def detect_local(image, scale=1.0):
+    """
+    Run YOLO detection with the model in this process, batched with
+    concurrent callers, and drop the detections pruning.py rules out.
+    scale is the full resolution size over the size of image, when it is a proxy.
+
+    Returns the kept sv.Detections.
+    """
+    detections = DETECTION_BATCHER(Image.fromarray(image))
+    keep = pruning.prune_detections(
+        detections.xyxy,
+        detections.confidence,
+        detections.class_id,
+        detections.data.get('class_name'),
+        image.shape[:2],
+        scale,
+    )
+    return detections[keep]
+
+def segment_boxes_local(image, bboxes):
+    """
+    Segment boxes on an image with the SAM model in this process, batched
+    with concurrent callers, and drop the masks pruning.py rules out.
+
+    Returns the kept bounding boxes and a CompactMask per box.
+    """
+    if not bboxes:
+        return [], []
+    masks = SEGMENTATION_BATCHER((Image.fromarray(image), bboxes))
+    keep = pruning.prune_masks(masks)
+    return [bboxes[i] for i in keep], [masks[i] for i in keep]
+
+def detect_and_segment_local(image, scale=1.0):
+    """
+    Run YOLO detection and SAM segmentation with the models in this process.
+    Detections and masks that pruning.py rules out are dropped before they
+    cost a SAM decode or a labeling call.
+
+    Returns the bounding boxes and a CompactMask per box.
+    """
+    detections = detect_local(image, scale)
+    return segment_boxes_local(image, [box.tolist() for box in detections.xyxy])
+
+def inference_stats():
+    """Return the batching statistics of whichever process runs the models."""
+    if MODEL_CLIENT is not None:
+        return MODEL_CLIENT.stats()
+    return {
+        'batchers': [DETECTION_BATCHER.stats(), SEGMENTATION_BATCHER.stats()],
+        'embedding_cache': EMBEDDING_CACHE.stats(),
+        'pruning': pruning.stats(),
+        'tiling': tiling.stats(),
+    }
+
+def detect_and_segment(image, scale=1.0):
+    """Run detection and segmentation on the model server if configured, else locally."""
+    if MODEL_CLIENT is not None:
+        return MODEL_CLIENT.detect_and_segment(image, scale)
+    ensure_models()
+    return detect_and_segment_local(image, scale)
+
+def detect(image):
+    """Run detection only, on the model server if configured, else locally."""
+    if MODEL_CLIENT is not None:
+        return MODEL_CLIENT.detect(image)
+    ensure_models()
+    return detect_local(image)
+
+def segment_boxes(image, bboxes):
+    """Segment given boxes, on the model server if configured, else locally."""
+    if MODEL_CLIENT is not None:
+        return MODEL_CLIENT.segment_boxes(image, bboxes)
+    ensure_models()
+    return segment_boxes_local(image, bboxes)
+
+def crop_segments(raw_image, masks, padding=10, min_size=50, scale=1.0):
+    """
+    Cut a square crop around every mask, once as is and once with everything
+    outside the mask made transparent.
+
+    Args:
+        raw_image (PIL.Image): The image to crop from.
+        masks (list): CompactMask per object.
+        padding (int): Pixels of context added around each mask.
+        min_size (int): Masks whose extent is smaller than this are skipped.
+        scale (float): Size of raw_image over the size of the image the masks
+        were predicted on, when they were predicted on a downscaled proxy.
+
+    Returns:
+        (list, list, list): Crops, their [x_min, y_min, x_max, y_max] boxes and transparent crops.
+    """
     segmented_images = []
     segmented_images_bboxes = []
     transparent_segmented_images = []
     
     # Loop over the masks and create cropped images with masks outlined
     for i, mask in enumerate(masks):
-        mask_np = np.array(mask).squeeze()  # Ensure mask is 2D by removing extra dimensions if present
-
-        # Find the bounding box for the mask by getting min/max coordinates where the mask is present
-        y_indices, x_indices = np.where(mask_np > 0)  # Ensure mask is binary
-        if len(y_indices) == 0 or len(x_indices) == 0:
+        # The bounding box of the mask pixels is computed when the mask is built
+        if mask.bbox is None:
           continue  # Skip if mask is empty
 
-        x_min, x_max = np.min(x_indices), np.max(x_indices)
-        y_min, y_max = np.min(y_indices), np.max(y_indices)
+        # Mask coordinates are in the proxy image, crops are cut at full resolution
+        x_min, y_min, x_max, y_max = mask.bbox
+        if scale != 1:
+            x_min, y_min = int(x_min * scale), int(y_min * scale)
+            x_max, y_max = int((x_max + 1) * scale) - 1, int((y_max + 1) * scale) - 1
 
         # Create a square bounding box around the mask
         bbox_width = x_max - x_min
         bbox_height = y_max - y_min
         bbox_size = max(bbox_width, bbox_height)
 
-        # Skip masks that are smaller than 50 by 50 pixels
-        if bbox_size < 50:
+        # Skip masks that are smaller than min_size by min_size pixels
+        if bbox_size < min_size:
           continue
 
         # Add padding to include more context around the mask
@@ -162,11 +426,59 @@ def segment(image: Image, debug=False, padding=10):
         # Create transparent segmented image
         transparent_img = Image.new("RGBA", cropped_image.size)
         cropped_image_rgba = cropped_image.convert("RGBA")
-        mask_cropped = mask_np[y_min:y_max, x_min:x_max]
+        mask_cropped = mask.crop_scaled(x_min, y_min, x_max, y_max, scale)
         mask_rgba = Image.fromarray((mask_cropped * 255).astype(np.uint8)).convert("L")
         transparent_img.paste(cropped_image_rgba, (0, 0), mask_rgba)
         transparent_segmented_images.append(transparent_img)
-    
+
+    return segmented_images, segmented_images_bboxes, transparent_segmented_images
+
+def make_proxy(image, max_side=SEGMENT_PROXY_MAX_SIDE):
+    """
+    Downscale an image array so its longest side is at most max_side.
+
+    Returns:
+        (np.ndarray, float): The proxy image, and the full size over the proxy size.
+    """
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image, 1.0
+    scale = max(height, width) / max_side
+    size = (max(1, round(width / scale)), max(1, round(height / scale)))
+    proxy = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return proxy, width / size[0]
+
+def segment(image: Image, debug=False, padding=10):
+    """
+    Segment objects in an image and return segmented images with masks outlined.
+    Detection and segmentation run on a proxy no larger than
+    SEGMENT_PROXY_MAX_SIDE; only the final crops use the full resolution.
+    Images large enough to be detected tile by tile (see tiling.py), such as
+    wide panoramas, are detected at full resolution instead so that their
+    small items survive, and SAM takes the boxes scaled to the proxy.
+
+    Returns the crops, their bounding boxes, the transparent crops, and the
+    hash of the proxy that /resegment can reuse the SAM embedding of.
+    """
+    image = np.asarray(image)
+    proxy, scale = make_proxy(image)
+    if scale != 1.0 and tiling.should_tile((image.shape[1], image.shape[0])):
+        detections = detect(image)
+        bboxes, masks = segment_boxes(proxy, (detections.xyxy / scale).tolist())
+    else:
+        bboxes, masks = detect_and_segment(proxy, scale)
+    raw_image = Image.fromarray(image)
+    if debug:
+        if not os.path.exists("./images"):
+            os.makedirs("./images")
+        proxy_image = Image.fromarray(proxy)
+        save_boxes_path = get_unique_filename("./images/boxes_image.png") 
+        show_masks_and_boxes_on_image(proxy_image, [], bboxes, save_boxes_path)
+        save_masked_path = get_unique_filename("./images/masked_image.png")
+        show_masks_and_boxes_on_image(proxy_image, masks, [], save_masked_path)
+
+    segmented_images, segmented_images_bboxes, transparent_segmented_images = crop_segments(raw_image, masks, padding, scale=scale)
+
     if debug:
         # Save the segmented images with masks outlined
         for i, img in enumerate(segmented_images):
@@ -180,4 +492,4 @@ def segment(image: Image, debug=False, padding=10):
                 os.makedirs("./images/transparent_segments")
             img.save(f"./images/transparent_segments/transparent_segmented_{i}.png")
 
-    return segmented_images, segmented_images_bboxes, transparent_segmented_images
+    return segmented_images, segmented_images_bboxes, transparent_segmented_images, image_hash(proxy)
@@ -0,0 +1,178 @@
+"""
+Drop low value candidates between detection and labeling.
+
+YOLO runs at a very low confidence so that unusual household items are not
+missed, which also lets through people, walls and duplicate boxes that would
+each cost a SAM decode and a vision model call before process_images threw
+them away. The rules below run in two places:
+
+- on the detections, before SAM: excluded classes, confidence (opt-in), box size
+  (each dropped box saves a SAM decode, and a labeling call unless it was
+  too small to be cropped anyway)
+- on the masks, before cropping: SAM's predicted mask quality and near
+  duplicate masks (each dropped mask saves a labeling call)
+
+PRUNE_ENABLED=0 turns every rule off.
+"""
+import os
+import threading
+
+import numpy as np
+
+PRUNE_ENABLED = os.getenv("PRUNE_ENABLED", "1") == "1"
+# Comma separated YOLO class names or ids that are never inventory items
+PRUNE_EXCLUDE_CLASSES = [c.strip() for c in os.getenv("PRUNE_EXCLUDE_CLASSES", "person").split(",") if c.strip()]
+# The default is the confidence YOLO runs at, so no detection is dropped for its
+# confidence unless a stricter value is opted into, which also lowers recall
+PRUNE_MIN_CONFIDENCE = float(os.getenv("PRUNE_MIN_CONFIDENCE", 0.01))
+# Boxes whose longest side (in full resolution pixels) is shorter than this give
+# masks crop_segments skips anyway
+PRUNE_MIN_BOX_SIZE = int(os.getenv("PRUNE_MIN_BOX_SIZE", 50))
+# Boxes covering most of the image are walls, floors or the whole room
+PRUNE_MAX_AREA_FRACTION = float(os.getenv("PRUNE_MAX_AREA_FRACTION", 0.9))
+PRUNE_MIN_MASK_SCORE = float(os.getenv("PRUNE_MIN_MASK_SCORE", 0.7))
+PRUNE_MAX_MASK_IOU = float(os.getenv("PRUNE_MAX_MASK_IOU", 0.85))
+# Longest side of the grid masks are rasterized to when comparing them
+PRUNE_IOU_GRID = int(os.getenv("PRUNE_IOU_GRID", 256))
+
+counters = {}
+counters_lock = threading.Lock()
+
+
+def record(rule, dropped, sam_decodes=True, vlm_calls=True):
+    """Count the candidates a rule dropped and the work that saved."""
+    if not dropped:
+        return
+    with counters_lock:
+        counter = counters.setdefault(rule, {'dropped': 0, 'sam_decodes_saved': 0, 'vlm_calls_saved': 0})
+        counter['dropped'] += dropped
+        if sam_decodes:
+            counter['sam_decodes_saved'] += dropped
+        if vlm_calls:
+            counter['vlm_calls_saved'] += dropped
+
+
+def stats():
+    """Return the per-rule counts of dropped candidates and saved work."""
+    with counters_lock:
+        rules = {rule: dict(counter) for rule, counter in counters.items()}
+    return {
+        'enabled': PRUNE_ENABLED,
+        'rules': rules,
+        'sam_decodes_saved': sum(c['sam_decodes_saved'] for c in rules.values()),
+        'vlm_calls_saved': sum(c['vlm_calls_saved'] for c in rules.values()),
+    }
+
+
+def prune_detections(boxes, confidences, class_ids, class_names, image_size, scale=1.0):
+    """
+    Apply the detection rules.
+
+    Args:
+        boxes (np.ndarray): (N, 4) [x_min, y_min, x_max, y_max] boxes.
+        confidences (np.ndarray): (N,) detection confidences.
+        class_ids (np.ndarray): (N,) YOLO class ids.
+        class_names (list): Class name per box, or None.
+        image_size (tuple): (height, width) of the image.
+        scale (float): Full resolution pixels per image pixel, when the image is
+            a downscaled proxy. Box sizes are compared at full resolution.
+
+    Returns:
+        np.ndarray: Indices of the boxes to keep, in their original order.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    keep = np.ones(len(boxes), dtype=bool)
+    if not PRUNE_ENABLED or len(boxes) == 0:
+        return np.flatnonzero(keep)
+
+    class_names = class_names if class_names is not None else [None] * len(boxes)
+    excluded = np.array([
+        str(class_id) in PRUNE_EXCLUDE_CLASSES or name in PRUNE_EXCLUDE_CLASSES
+        for class_id, name in zip(np.asarray(class_ids).tolist(), class_names)
+    ], dtype=bool)
+
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    height, width = image_size
+    rules = [
+        ('excluded_class', excluded),
+        ('min_confidence', np.asarray(confidences) < PRUNE_MIN_CONFIDENCE),
+        ('min_box_size', np.maximum(widths, heights) * scale < PRUNE_MIN_BOX_SIZE),
+        ('max_area', widths * heights > PRUNE_MAX_AREA_FRACTION * height * width),
+    ]
+
+    # each box is credited to the first rule that drops it
+    for rule, drop in rules:
+        # a box below the crop size would never have been labeled
+        record(rule, int((keep & drop).sum()), vlm_calls=rule != 'min_box_size')
+        keep &= ~drop
+    return np.flatnonzero(keep)
+
+
+def rasterize(masks, size=PRUNE_IOU_GRID):
+    """
+    Sample CompactMasks onto a common low resolution grid.
+
+    Returns:
+        np.ndarray: (N, cells) float32 matrix, one flattened mask per row.
+    """
+    height, width = masks[0].image_size
+    scale = min(1.0, size / max(height, width))
+    grid_h, grid_w = max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+    # image pixel at the centre of every grid cell
+    ys = np.minimum(((np.arange(grid_h) + 0.5) / scale).astype(int), height - 1)
+    xs = np.minimum(((np.arange(grid_w) + 0.5) / scale).astype(int), width - 1)
+
+    grid = np.zeros((len(masks), grid_h, grid_w), dtype=np.float32)
+    for i, mask in enumerate(masks):
+        if mask.bbox is None:
+            continue
+        x_min, y_min, x_max, y_max = mask.bbox
+        rows = np.flatnonzero((ys >= y_min) & (ys <= y_max))
+        cols = np.flatnonzero((xs >= x_min) & (xs <= x_max))
+        if len(rows) and len(cols):
+            grid[i, rows[:, None], cols[None, :]] = mask.array()[ys[rows] - y_min][:, xs[cols] - x_min]
+    return grid.reshape(len(masks), -1)
+
+
+def mask_iou_matrix(masks, size=PRUNE_IOU_GRID):
+    """Pairwise IoU of CompactMasks of one image, computed on a low resolution grid."""
+    flat = rasterize(masks, size)
+    intersections = flat @ flat.T
+    areas = np.diag(intersections)
+    unions = areas[:, None] + areas[None, :] - intersections
+    return np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+
+def prune_masks(masks):
+    """
+    Apply the mask rules: drop masks SAM scores as poor and keep only the
+    best scoring of masks that cover nearly the same pixels.
+
+    Args:
+        masks (list): CompactMask per kept box, with the SAM score set.
+
+    Returns:
+        list: Indices of the masks to keep, in their original order.
+    """
+    if not PRUNE_ENABLED or not masks:
+        return list(range(len(masks)))
+
+    scores = np.array([1.0 if mask.score is None else mask.score for mask in masks], dtype=np.float32)
+    empty = np.array([mask.bbox is None for mask in masks], dtype=bool)
+    low_score = ~empty & (scores < PRUNE_MIN_MASK_SCORE)
+    # empty masks are never cropped, so dropping them here saves nothing
+    record('min_mask_score', int(low_score.sum()), sam_decodes=False)
+    candidates = np.flatnonzero(~empty & ~low_score)
+
+    if len(candidates) < 2:
+        return candidates.tolist()
+
+    ious = mask_iou_matrix([masks[i] for i in candidates])
+    kept = []
+    # greedy: best score first, drop anything too close to an already kept mask
+    for position in np.argsort(-scores[candidates], kind='stable'):
+        if not kept or ious[position, kept].max() < PRUNE_MAX_MASK_IOU:
+            kept.append(position)
+    record('duplicate_mask', len(candidates) - len(kept), sam_decodes=False)
+    return sorted(candidates[kept].tolist())
@@ -10,7 +10,14 @@ from chroma import *
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from ml import process_image, process_video
+from jobs import JobQueueFull, buffer_file, get_job_status, submit_job
+from warmup import readiness, require
+from artifacts import load_report
+import warmup
+from PIL import Image
+import base64
+import io
+import numpy as np
 from werkzeug.utils import secure_filename
 from db import *
 
@@ -20,22 +27,46 @@ app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}})
 app.config['CORS_HEADERS'] = 'Content-Type'
 
+# Heavy subsystems (models, vector store, blockchain) load in the background
+# or on first use, see warmup.py
+warmup.start()
+
 
 @app.route('/')
 def hello_world():
     return 'Hello, World!'
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    is_ready, subsystems = readiness()
+    return jsonify({
+        'ready': is_ready,
+        'subsystems': subsystems,
+        'artifact_load_seconds': load_report(),
+    }), 200 if is_ready else 503
+
+
+###################
+# Pipeline entry points for upload jobs, they wait for the pipeline to be warm
+
+def process_video(video, **kwargs):
+    return require('pipeline').process_video(video, **kwargs)
+
+
+def process_image(image, **kwargs):
+    return require('pipeline').process_image(image, **kwargs)
+
+
 ###################
 # Upload media
 
 
 @app.route('/upload_media', methods=['POST'])
 def upload_media():
-    before = request.args.get('before')
-
-    # with each new upload session set prev pending to done
-    set_pending_to_done()
+    require('database')
+    # the client sends before=true/false, anything else is an after upload
+    before = before_text(request.args.get('before')) == 'true'
 
     print('upload_media')
 
@@ -53,7 +84,7 @@ def upload_media():
     if len(files) == 0:
         return jsonify({'error': 'No files provided'}), 400
 
-    uploaded_images = []
+    tasks = []
 
     for file in files:
 
@@ -61,19 +92,133 @@ def upload_media():
         if file.content_type not in ['image/jpeg', 'image/png', 'image/gif', 'video/mp4', 'video/quicktime']:
             return jsonify({'error': 'Invalid file type'}), 400
 
-        # TODO: send the files through the pipeline (call process_video or process_image)
+        # queue the file for the pipeline (process_video or process_image)
         if file.content_type == 'video/mp4' or file.content_type == 'video/quicktime':
-            print('processing video', file)
-            uploads = process_video(file, s3, before)
+            print('queueing video', file)
+            tasks.append((process_video, buffer_file(file), {'s3': s3, 'before': before}))
         else:
-            print('processing image', file)
-            uploads = process_image(file, s3, before)
-        
-        uploaded_images += uploads
+            print('queueing image', file)
+            tasks.append((process_image, buffer_file(file), {'s3': s3, 'before': before}))
+
+    try:
+        job_id = submit_job(tasks)
+    except JobQueueFull:
+        return jsonify({'error': 'Too many uploads in progress, try again later'}), 503
+
+    # with each new upload session set prev pending to done, images of
+    # earlier jobs that are still running are stored as done when they finish
+    require('vector_store')
+    set_pending_before_job_to_done(job_id)
 
-    # # Return the image URLs
-    # return jsonify({'urls': uploaded_images}), 200
-    return jsonify({'message': 'Media uploaded successfully'}), 200
+    return jsonify({
+        'message': 'Media upload queued',
+        'job_id': job_id,
+        'status_url': f'/jobs/{job_id}'
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_info(job_id):
+    require('database')
+    job = get_job_status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job), 200
+
+
+def is_number_lists(value, length):
+    """Return whether value is a list of lists of `length` finite numbers."""
+    return isinstance(value, list) and all(
+        isinstance(entry, list) and len(entry) == length and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) and np.isfinite(v) for v in entry
+        )
+        for entry in value
+    )
+
+
+@app.route('/resegment', methods=['POST'])
+def resegment_image():
+    """
+    Segment extra box or point prompts on an image that was already uploaded.
+    The SAM image embedding is reused from the cache, so only the mask decoder runs.
+
+    Form fields:
+    - file: the image, or image_hash: a hash from an upload job's result or a previous call;
+      prompts on a hash are in the coordinates of the image that was segmented.
+      Images are only kept by hash when EMBEDDING_CACHE_DIR is set, otherwise
+      no hash is returned and the file must be sent every time
+    - boxes: JSON list of [x_min, y_min, x_max, y_max]
+    - points: JSON list of [x, y] describing one object, labels: JSON list of 1/0
+    """
+    try:
+        boxes = json.loads(request.form.get('boxes', 'null'))
+        points = json.loads(request.form.get('points', 'null'))
+        labels = json.loads(request.form.get('labels', 'null'))
+    except json.JSONDecodeError:
+        return jsonify({'error': 'Prompts must be JSON lists'}), 400
+
+    if not boxes and not points:
+        return jsonify({'error': 'No boxes or points provided'}), 400
+    if boxes and not is_number_lists(boxes, 4):
+        return jsonify({'error': 'boxes must be a list of [x_min, y_min, x_max, y_max]'}), 400
+    if points and not is_number_lists(points, 2):
+        return jsonify({'error': 'points must be a list of [x, y]'}), 400
+    if labels is not None and not (
+        points and isinstance(labels, list) and len(labels) == len(points)
+        and all(label in (0, 1) and not isinstance(label, bool) for label in labels)
+    ):
+        return jsonify({'error': 'labels must be a list of 1/0, one per point'}), 400
+
+    predict = require('models')
+    keeps_images = bool(predict.EMBEDDING_CACHE.spill_dir)
+    if 'file' in request.files:
+        # decoded and downscaled like the upload pipeline does, so the proxy
+        # hashes the same as the one whose embedding the upload cached
+        image = require('pipeline').decode_image(request.files['file'])
+        proxy, scale = predict.make_proxy(image)
+    elif request.form.get('image_hash'):
+        if not keeps_images:
+            return jsonify({'error': 'This server does not keep images by hash, send the file instead'}), 409
+        # the cached image is the proxy that was segmented
+        proxy = predict.load_cached_image(request.form['image_hash'])
+        if proxy is None:
+            return jsonify({'error': 'Image not found, send the file instead'}), 404
+        image, scale = proxy, 1.0
+    else:
+        return jsonify({'error': 'No image provided'}), 400
+
+    # prompts are in the coordinates of the image, SAM runs on the proxy
+    if boxes:
+        boxes = [[v / scale for v in box] for box in boxes]
+    if points:
+        points = [[v / scale for v in point] for point in points]
+
+    key, masks = predict.resegment(proxy, boxes, points, labels)
+    _, bboxes, transparent_images = predict.crop_segments(Image.fromarray(image), masks, min_size=0, scale=scale)
+
+    segments = []
+    for bbox, transparent_image in zip(bboxes, transparent_images):
+        buffered_img = io.BytesIO()
+        transparent_image.save(buffered_img, format="PNG")
+        segments.append({
+            'bbox': [int(v) for v in bbox],
+            'image': 'data:image/png;base64,' + base64.b64encode(buffered_img.getvalue()).decode('utf-8'),
+        })
+
+    response = {'segments': segments}
+    if keeps_images:
+        response['image_hash'] = key
+    return jsonify(response), 200
+
+
+@app.route('/inference_stats', methods=['GET'])
+def get_inference_stats():
+    stats = require('models').inference_stats()
+    import hyperbolic
+    stats['label_cache'] = hyperbolic.label_cache.stats()
+    stats['labeling'] = hyperbolic.labeling_stats()
+    return jsonify(stats), 200
 
 
 ###################
@@ -81,6 +226,7 @@ def upload_media():
 
 @app.route('/inventory', methods=['GET'])
 def get_items():
+    require('vector_store')
     # do something to get inventory
 
     # metadata to filter by
@@ -89,77 +235,58 @@ def get_items():
     before = request.args.get('before')
     status = request.args.get('status')
 
-    filtered_images = filter_images_by_metadata(
-        item_id, url_path, before, status)
-    
-    # print("Filtered images", filtered_images)
-
-    ids = filtered_images['ids'][0]
-    metadatas = filtered_images['metadatas'][0]
-
-    results = list(zip(ids, metadatas))
-
-    print("looping through results")
-
-    items = {}
-    for id, metadata in results:
-        print(f"Item ID: {id}, Metadata: {metadata}")
-        # Get the item details from the image
-        item_id = metadata.get('item_id')
-        if not item_id:
-            continue
-        item_details = get_item(item_id)
-        if item_details and item_details['id'] not in items:
-            item_details['images'] = []
-            items[item_details['id']] = item_details
-
-    print("BEFORE IMAGES ADDED TO ITEMS")
-    # Print out the items
-    for item in items.values():
-        print(f"Item: {item}")
-
-    # Now add the images to the items
-    for id, metadata in results:
-        print(f"Adding image to item {id}")
-        item_obj = items.get(metadata.get('item_id', None), None)
-        if item_obj:
-            item_obj['images'].append(metadata)
-
-    print("AFTER IMAGES ADDED TO ITEMS")
-    # print out the items
+    # ?limit=N returns one page of images, continue with ?cursor=<next_cursor>
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', 0, type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    if limit is None:
+        filtered_images = filter_images_by_metadata(
+            item_id, url_path, before, status)
+        next_cursor = None
+    else:
+        filtered_images = list_images(
+            item_id, url_path, before, status, limit=limit, cursor=cursor)
+        next_cursor = filtered_images['next_cursor']
+
+    ids = filtered_images['ids']
+    metadatas = filtered_images['metadatas']
+
+    # Fetch every referenced item at once, then attach the images in one pass
+    items = get_items_by_id(metadata.get('item_id') for metadata in metadatas)
     for item in items.values():
-        print(f"Item: {item}")
+        item['images'] = []
+    for metadata in metadatas:
+        item = items.get(metadata.get('item_id'))
+        if item:
+            item['images'].append(metadata)
 
     # convert the items dict to a list
     items = list(items.values())
+    print(f"Inventory: {len(items)} items from {len(ids)} images")
 
     # returns all the items in the inventory, joined with their images
-    return jsonify({"items": items}), 200
+    return jsonify({"items": items, "next_cursor": next_cursor}), 200
 
 @app.route('/confirm_matches', methods=['POST'])
 def confirm_matches():
+    require('vector_store')
     data = request.json
     item_ids = data.get('item_ids', [])
 
     if not item_ids:
         return jsonify({"error": "No item IDs provided"}), 400
 
-    matched_images = []
-
-    # For each item to claim
-    for item_id in item_ids:
-        # Find and remove associated images from ChromaDB
-        images = filter_images_by_metadata(item_id=item_id)
-        if images and 'ids' in images:
-            image_ids = images['ids'][0]
-            for image_id in image_ids:
-                update_image_status(image_id, new_status='matched')        
-                matched_images.append(image_id)
+    # Find the images of every item to claim with one listing
+    images = filter_images_by_metadata(item_id=item_ids)
+    report = update_images_status(images['ids'], 'matched')
 
     return jsonify({
         "message": "Claim processed successfully. Image statuses updated to 'claimed'",
         "claimed_items": item_ids,
-        "matched_images": matched_images
+        "matched_images": report['updated'],
+        "failed_images": report['failed']
     }), 200
 
 
@@ -168,6 +295,7 @@ def confirm_matches():
 
 @app.route('/pending_uploads', methods=['GET'])
 def get_pending_uploads():
+    require('vector_store')
     # do something to get pending uploads
     filtered_images = filter_images_by_metadata(status='pending')
 
@@ -182,22 +310,21 @@ def get_pending_uploads():
 ###################
 # Set pending images to done
 def set_status_to_status(old_status, new_status):
+    require('vector_store')
     # data = request.json
 
     print(f"Setting {old_status} images to {new_status} status")
 
     result = filter_images_by_metadata(status=old_status)
-    image_ids = result['ids'][0]
-    for id in image_ids:
-        update_image_status(id, new_status=new_status)
+    report = update_images_status(result['ids'], new_status)
+    image_ids = report['updated']
 
     print(f"Images {image_ids} updated from {old_status} to {new_status} status")
 
-    return jsonify({"message": f"Images {image_ids} updated from {old_status} to {new_status} status"}), 200
-
-
-def set_pending_to_done():
-    return set_status_to_status(old_status='pending', new_status='done')
+    return jsonify({
+        "message": f"Images {image_ids} updated from {old_status} to {new_status} status",
+        "failed_images": report['failed']
+    }), 200
 
 
 
@@ -206,18 +333,21 @@ def set_pending_to_done():
 
 @app.route('/accept_to_inventory', methods=['POST'])
 def accept_to_inventory():
+    require('vector_store')
     data = request.json
     image_ids = data['image_ids']
     print(f"Accepting images to inventory: {image_ids}")
 
-    for image_id in image_ids:
-        # update the status of the image to 'inventory'
-        update_image_status(image_id, 'inventory')
+    # update the status of the images to 'inventory'
+    report = update_images_status(image_ids, 'inventory')
+    if not report['updated'] and (report['missing'] or report['failed']):
+        return jsonify({"error": "No images were accepted to inventory", **report}), 500 if report['failed'] else 404
 
-    return jsonify({"message": "Images accepted to inventory successfully"}), 200
+    return jsonify({"message": "Images accepted to inventory successfully", **report}), 200
 
 @app.route('/delete_from_inventory', methods=['POST'])
 def delete_from_inventory():
+    require('vector_store')
     data = request.json
     item_id = data['item_id']
     print(f"Deleting images from inventory: {item_id}")
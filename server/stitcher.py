@@ -1,52 +1,369 @@
 from stitching import Stitcher
+from stitching.stitching_error import StitchingError
 import os
 import cv2
+import math
+import shutil
 import tempfile
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import debug_artifacts
 
 os.environ['KMP_WARNINGS'] = '0'
 
-def create_panorama(video):
-  # Save the FileStorage object to a temporary file
-  temp_video_path = tempfile.mktemp(suffix='.mp4')
-  video.save(temp_video_path)
+# Keyframe extraction: frames are decoded at about KEYFRAME_SAMPLE_FPS (the
+# rest are only grabbed), and at most KEYFRAME_MAX_SAMPLES of them, so long or
+# high fps videos cost about as much as short ones. A new keyframe is taken
+# once the camera has moved KEYFRAME_MIN_MOTION of the frame width since the
+# last one, or the view changed by KEYFRAME_MIN_NOVELTY pHash bits; the
+# sharpest of the last KEYFRAME_WINDOW sampled frames is kept.
+KEYFRAME_BUDGET = int(os.getenv("KEYFRAME_BUDGET", 24))
+KEYFRAME_SAMPLE_FPS = float(os.getenv("KEYFRAME_SAMPLE_FPS", 6))
+KEYFRAME_MAX_SAMPLES = int(os.getenv("KEYFRAME_MAX_SAMPLES", 360))
+KEYFRAME_WINDOW = int(os.getenv("KEYFRAME_WINDOW", 6))
+KEYFRAME_MIN_MOTION = float(os.getenv("KEYFRAME_MIN_MOTION", 0.25))
+KEYFRAME_MIN_NOVELTY = int(os.getenv("KEYFRAME_MIN_NOVELTY", 32))
+# Laplacian variance (on the analysis thumbnail) below which a frame is too blurry to use
+KEYFRAME_MIN_SHARPNESS = float(os.getenv("KEYFRAME_MIN_SHARPNESS", 20))
 
-  # Open the video file using cv2
-  cap = cv2.VideoCapture(temp_video_path)
+ANALYSIS_WIDTH = 160
 
-  # Check if the video object is valid
-  if not cap.isOpened():
-    print("Error: Could not open video.")
-    return None
+# Stitching: registration (features, matching, camera estimation) runs at
+# STITCH_REGISTRATION_MEGAPIX, seam finding at STITCH_SEAM_MEGAPIX and only
+# compositing at STITCH_FINAL_MEGAPIX (-1 keeps the video resolution).
+# Keyframes are in video order, so each is only matched with the next
+# STITCH_RANGE_WIDTH ones (-1 matches every pair).
+STITCH_DETECTOR = os.getenv("STITCH_DETECTOR", "sift")
+STITCH_FEATURES = int(os.getenv("STITCH_FEATURES", 500))
+STITCH_REGISTRATION_MEGAPIX = float(os.getenv("STITCH_REGISTRATION_MEGAPIX", 0.6))
+STITCH_SEAM_MEGAPIX = float(os.getenv("STITCH_SEAM_MEGAPIX", 0.1))
+STITCH_FINAL_MEGAPIX = float(os.getenv("STITCH_FINAL_MEGAPIX", -1))
+STITCH_RANGE_WIDTH = int(os.getenv("STITCH_RANGE_WIDTH", 4))
+STITCH_WORKERS = int(os.getenv("STITCH_WORKERS", os.cpu_count() or 1))
+# Seconds a stitch may take before it is abandoned, 0 for no limit
+STITCH_TIME_BUDGET = float(os.getenv("STITCH_TIME_BUDGET", 120))
 
-  # Get video frame rate (fps)
-  fps = cap.get(cv2.CAP_PROP_FPS)
+def create_akaze(nfeatures):
+  # OpenCV 5 moved AKAZE to the contrib xfeatures2d module
+  create = getattr(cv2, "AKAZE_create", None) or getattr(getattr(cv2, "xfeatures2d", None), "AKAZE_create", None)
+  if create is None:
+    raise StitchingError("AKAZE is not available in this OpenCV build, install opencv-contrib-python")
+  return create()
 
-  # Extract 1/10th of the frames
-  frame_number = 0
-  extracted_frames = []
+STITCH_DETECTORS = {
+  "orb": lambda nfeatures: cv2.ORB_create(nfeatures),
+  "akaze": create_akaze,
+  "sift": lambda nfeatures: cv2.SIFT_create(nfeatures),
+}
+
+def frame_thumbnail(frame):
+  """Small grayscale copy of a frame used for motion, blur and novelty."""
+  height, width = frame.shape[:2]
+  size = (ANALYSIS_WIDTH, max(1, round(height * ANALYSIS_WIDTH / width)))
+  return np.float32(cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY))
+
+def frame_hash(thumbnail):
+  """64-bit DCT perceptual hash of a thumbnail."""
+  low_frequencies = cv2.dct(cv2.resize(thumbnail, (32, 32), interpolation=cv2.INTER_AREA))[:8, :8].flatten()[1:]
+  bits = low_frequencies > np.median(low_frequencies)
+  return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+def sharpness(thumbnail):
+  return float(cv2.Laplacian(thumbnail, cv2.CV_32F).var())
+
+class KeyframeSelector:
+  """
+  Picks keyframes from a stream of sampled frames, holding at most
+  KEYFRAME_WINDOW candidate frames and KEYFRAME_BUDGET keyframes.
+  """
+
+  def __init__(self, budget=KEYFRAME_BUDGET, window=KEYFRAME_WINDOW, min_motion=KEYFRAME_MIN_MOTION,
+               min_novelty=KEYFRAME_MIN_NOVELTY, min_sharpness=KEYFRAME_MIN_SHARPNESS):
+    self.budget = budget
+    self.window_size = window
+    self.min_motion = min_motion
+    self.min_novelty = min_novelty
+    self.min_sharpness = min_sharpness
+    self.keyframes = []  # (frame index, frame)
+    self.window = []  # (sharpness, frame index, frame, hash) since the last keyframe
+    self.previous = None
+    self.motion = np.zeros(2)
+    self.last_hash = None
+    self.skipped_blurry = 0
+
+  def add(self, index, frame):
+    thumbnail = frame_thumbnail(frame)
+    if self.previous is not None and self.previous.shape == thumbnail.shape:
+      (dx, dy), _ = cv2.phaseCorrelate(self.previous, thumbnail)
+      self.motion += (dx, dy)
+    self.previous = thumbnail
+
+    score = sharpness(thumbnail)
+    phash = frame_hash(thumbnail)
+    if score < self.min_sharpness:
+      self.skipped_blurry += 1
+    else:
+      self.window.append((score, index, frame, phash))
+      if len(self.window) > self.window_size:
+        # keep the window bounded by forgetting its blurriest frame
+        self.window.remove(min(self.window, key=lambda candidate: candidate[0]))
+
+    if not self.window:
+      return
+    moved = np.hypot(*self.motion) / thumbnail.shape[1]
+    novel = self.last_hash is not None and (phash ^ self.last_hash).bit_count() >= self.min_novelty
+    if self.last_hash is None or moved >= self.min_motion or novel:
+      self.emit()
 
-  while cap.isOpened():
-    ret, frame = cap.read()
-    
-    if not ret:
-      break  # Video is finished or cannot read frame
+  def emit(self):
+    _, index, frame, phash = max(self.window, key=lambda candidate: candidate[0])
+    self.keyframes.append((index, frame))
+    self.window = []
+    self.motion[:] = 0
+    self.last_hash = phash
 
-    # Add every 1/10th frame to the list
-    if frame_number % 10 == 0:
-      extracted_frames.append(frame)
+    if len(self.keyframes) > self.budget:
+      # over budget: keep every other keyframe and ask for twice the motion from now on
+      self.keyframes = self.keyframes[::2]
+      self.min_motion *= 2
 
+  def finish(self):
+    """Return the keyframes in video order, including the end of the video if it moved on."""
+    if self.window and np.hypot(*self.motion) / self.previous.shape[1] >= self.min_motion / 2:
+      self.emit()
+    return [frame for _, frame in self.keyframes]
+
+def extract_keyframes(cap, sample_fps=KEYFRAME_SAMPLE_FPS, max_samples=KEYFRAME_MAX_SAMPLES, **selector_options):
+  """
+  Stream a video and return its keyframes, decoding only the sampled frames.
+
+  Args:
+    cap (cv2.VideoCapture): An opened video.
+    sample_fps (float): How many frames per second of video to analyse.
+    max_samples (int): Upper bound on the number of frames analysed.
+
+  Returns:
+    list: Keyframes as BGR arrays, in video order.
+  """
+  fps = cap.get(cv2.CAP_PROP_FPS) or 30
+  frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+  step = max(1, round(fps / sample_fps))
+  if frame_count > 0:
+    step = max(step, math.ceil(frame_count / max_samples))
+
+  selector = KeyframeSelector(**selector_options)
+  frame_number = 0
+  while True:
+    # grab() advances without decoding, only sampled frames are decoded
+    if not cap.grab():
+      break
+    if frame_number % step == 0:
+      ret, frame = cap.retrieve()
+      if not ret:
+        break
+      selector.add(frame_number, frame)
     frame_number += 1
 
-  # Release the video capture object
-  cap.release()
+  keyframes = selector.finish()
+  print(f"Selected {len(keyframes)} keyframes from {frame_number} frames "
+        f"(every {step}th analysed, {selector.skipped_blurry} too blurry)")
+  return keyframes
+
+class StitchingTimeout(StitchingError):
+  """Raised when a stitch runs past its time budget."""
+
+class MultiResolutionStitcher(Stitcher):
+  """
+  Stitcher that registers frames at a reduced resolution, extracts features
+  on several threads with ORB, AKAZE or SIFT, and gives up once the time
+  budget is spent. The budget is only checked between stages, so a slow
+  stage runs to its end, and a stitch whose compositing finished is never
+  thrown away. Per stage timings are kept in self.timings.
+  """
+
+  def __init__(self, detector=STITCH_DETECTOR, nfeatures=STITCH_FEATURES, workers=STITCH_WORKERS,
+               time_budget=STITCH_TIME_BUDGET, **settings):
+    if detector not in STITCH_DETECTORS:
+      raise ValueError(f"Unknown STITCH_DETECTOR {detector}, expected one of {tuple(STITCH_DETECTORS)}")
+    self.detector_name = detector
+    self.nfeatures = nfeatures
+    self.workers = max(1, workers)
+    self.time_budget = time_budget
+    self.local = threading.local()
+    # fail here, where callers handle StitchingError, if this OpenCV build lacks the detector
+    try:
+      self.local.detector = STITCH_DETECTORS[detector](nfeatures)
+    except (AttributeError, cv2.error) as e:
+      raise StitchingError(f"Feature detector {detector} is not available: {e}")
+    self.timings = {}
+    # binary descriptors (ORB, AKAZE) need the looser match confidence
+    settings.setdefault("match_conf", 0.65 if detector == "sift" else 0.3)
+    super().__init__(detector="sift" if detector == "sift" else "orb", nfeatures=nfeatures, **settings)
+
+  def stage(self, name, check_budget=True):
+    """Close the timing of the previous stage and check the budget before the next."""
+    now = time.perf_counter()
+    self.timings[self.current_stage] = round(now - self.stage_started, 3)
+    if check_budget and self.time_budget and now - self.started > self.time_budget:
+      raise StitchingTimeout(f"Stitching exceeded its {self.time_budget}s budget before {name}")
+    self.current_stage, self.stage_started = name, now
+
+  def stitch(self, images, feature_masks=[]):
+    self.timings = {}
+    self.started = self.stage_started = time.perf_counter()
+    self.current_stage = 'resize'
+    panorama = super().stitch(images, feature_masks)
+    # the panorama is complete, keep it even if the last stage overran
+    self.stage('done', check_budget=False)
+    self.timings['total'] = round(time.perf_counter() - self.started, 3)
+    return panorama
+
+  def detect_features(self, img):
+    # OpenCV feature detectors are not shared between threads
+    if getattr(self.local, 'detector', None) is None:
+      self.local.detector = STITCH_DETECTORS[self.detector_name](self.nfeatures)
+    return cv2.detail.computeImageFeatures2(self.local.detector, img)
+
+  def find_features(self, imgs, feature_masks=[]):
+    self.stage('features')
+    if feature_masks:
+      return super().find_features(imgs, feature_masks)
+    # OpenCV releases the GIL, so threads extract features in parallel
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(self.detect_features, imgs))
+
+  def match_features(self, features):
+    self.stage('matching')
+    return super().match_features(features)
+
+  def estimate_camera_parameters(self, features, matches):
+    self.stage('cameras')
+    return super().estimate_camera_parameters(features, matches)
+
+  def resize_low_resolution(self, imgs=None):
+    self.stage('seams')
+    return super().resize_low_resolution(imgs)
+
+  def resize_final_resolution(self):
+    self.stage('compositing')
+    return super().resize_final_resolution()
+
+def stitch_frames(frames, detector=STITCH_DETECTOR, registration_megapix=STITCH_REGISTRATION_MEGAPIX,
+                  seam_megapix=STITCH_SEAM_MEGAPIX, final_megapix=STITCH_FINAL_MEGAPIX,
+                  range_width=STITCH_RANGE_WIDTH, time_budget=STITCH_TIME_BUDGET):
+  """
+  Stitch keyframes into a panorama.
+
+  Returns:
+    (np.ndarray, dict): The BGR panorama, and a report of the seconds spent
+    per stage and how many of the frames made it into the panorama.
+  """
+  stitcher = MultiResolutionStitcher(
+    detector=detector,
+    time_budget=time_budget,
+    medium_megapix=registration_megapix,
+    low_megapix=seam_megapix,
+    final_megapix=final_megapix,
+    range_width=range_width,
+    confidence_threshold=0.05,
+    matches_graph_dot_file=False,
+    crop=False,
+  )
+  panorama = stitcher.stitch(frames)
+  report = {'seconds': stitcher.timings, 'frames': len(frames), 'frames_stitched': len(stitcher.images.names)}
+  return panorama, report
+
+@contextmanager
+def open_video(video):
+  """
+  Open an uploaded video with OpenCV without copying it to a file on disk.
+
+  OpenCV 4.11+ reads straight from the upload stream. Older versions get an
+  anonymous in-memory file (memfd) instead, and only systems without memfd
+  fall back to a temporary file, which is deleted afterwards.
+
+  Args:
+    video: FileStorage of the upload, with a seekable stream.
+
+  Yields:
+    cv2.VideoCapture: The opened video, released on exit.
+  """
+  stream = video.stream
+  # rewind so the same upload can be read more than once
+  stream.seek(0)
+  cap, fd, temp_path = None, None, None
+  try:
+    try:
+      cap = cv2.VideoCapture(stream, cv2.CAP_FFMPEG, [])
+    except (TypeError, cv2.error):
+      cap = None
+
+    if cap is None or not cap.isOpened():
+      stream.seek(0)
+      if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("upload-video")
+        with os.fdopen(os.dup(fd), "wb") as f:
+          shutil.copyfileobj(stream, f)
+        cap = cv2.VideoCapture(f"/proc/self/fd/{fd}")
+      else:
+        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as f:
+          temp_path = f.name
+          shutil.copyfileobj(stream, f)
+        cap = cv2.VideoCapture(temp_path)
+    yield cap
+  finally:
+    if cap is not None:
+      cap.release()
+    if fd is not None:
+      os.close(fd)
+    if temp_path is not None:
+      os.remove(temp_path)
+
+def read_keyframes(video, **options):
+  """
+  Read the keyframes of an uploaded video.
+
+  Args:
+    video: FileStorage of the upload.
+    options: extract_keyframes options, e.g. a lower min_motion for tracking.
+
+  Returns:
+    list: Keyframes as BGR arrays, empty if the video could not be opened.
+  """
+  with open_video(video) as cap:
+    # Check if the video object is valid
+    if not cap.isOpened():
+      print("Error: Could not open video.")
+      return []
+
+    extracted_frames = extract_keyframes(cap, **options)
 
   print(f"read frames {len(extracted_frames)}")
-  settings = {"detector": "sift", "confidence_threshold": 0.05, "matches_graph_dot_file": False, "crop": False}
-  stitcher = Stitcher(**settings)
+  return extracted_frames
+
+def create_panorama(video):
+  """
+  Stitch an uploaded video into a panorama.
+
+  Returns:
+    np.ndarray or None: The BGR panorama, or None if the video could not be
+    read or stitched.
+  """
+  extracted_frames = read_keyframes(video)
+  if not extracted_frames:
+    return None
 
   print("stitching")
-  panorama = stitcher.stitch(extracted_frames)
+  try:
+    panorama, report = stitch_frames(extracted_frames)
+  except (StitchingError, cv2.error) as e:
+    print(f"Error: Could not stitch video: {e}")
+    return None
+  print(f"stitched {panorama.shape[1]}x{panorama.shape[0]} panorama: {report}")
+
+  debug_artifacts.save_image("pano", panorama)
 
-  cv2.imwrite("pano.png", panorama)
-  
   return panorama
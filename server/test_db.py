@@ -0,0 +1,123 @@
+import pytest
+
+import db
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+def counts(item_id):
+    item = db.get_item(item_id)
+    return item['before_count'], item['after_count']
+
+
+def test_update_items_counts_the_before_flag_sent_as_text():
+    db.update_items([('a', 'Lamp', 'A lamp', 'Furniture', 10.0)], 'true')
+    db.update_items([('b', 'Desk', 'A desk', 'Furniture', 50.0)], 'false')
+    assert counts('a') == (1, 0)
+    assert counts('b') == (0, 1)
+
+
+def test_update_items_adds_to_existing_counts():
+    item = ('a', 'Lamp', 'A lamp', 'Furniture', 10.0)
+    db.update_items([item, item], True)
+    db.update_items([item], 'false')
+    db.update_items([item], False)
+    assert counts('a') == (2, 2)
+
+
+def add_pending(job_id, *image_ids):
+    db.add_images([(image_id, 'item', f'/{image_id}.png', 'true', 'pending') for image_id in image_ids], job_id)
+
+
+def statuses():
+    page = db.list_images()
+    return {image_id: metadata['status'] for image_id, metadata in zip(page['ids'], page['metadatas'])}
+
+
+def test_new_upload_sets_only_earlier_pending_images_to_done():
+    db.create_job('first')
+    add_pending('first', 'a')
+    db.create_job('second')
+    add_pending('second', 'b')
+    db.set_pending_before_job_to_done('second')
+    assert statuses() == {'a': 'done', 'b': 'pending'}
+
+
+def test_images_of_a_superseded_job_are_stored_as_done():
+    db.create_job('first')
+    db.create_job('second')
+    db.set_pending_before_job_to_done('second')
+    # the first job finishes after the second upload started its session
+    add_pending('first', 'a')
+    add_pending('second', 'b')
+    assert statuses() == {'a': 'done', 'b': 'pending'}
+
+
+def add(count, start=0, **metadata):
+    image_ids = [f'image-{i:05d}' for i in range(start, start + count)]
+    db.add_images([
+        (image_id, metadata.get('item_id', f'item-{i % 3}'), f'/{image_id}.png',
+         metadata.get('before', 'true'), metadata.get('status', 'pending'))
+        for i, image_id in enumerate(image_ids, start)
+    ])
+    return image_ids
+
+
+def test_keyset_pages_cover_every_image_once_in_order():
+    image_ids = add(25)
+    pages, cursor = [], 0
+    while cursor is not None:
+        page = db.list_images(limit=10, cursor=cursor)
+        pages.append(page['ids'])
+        cursor = page['next_cursor']
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == image_ids
+
+
+def test_keyset_pagination_ends_on_a_full_last_page():
+    add(20)
+    first = db.list_images(limit=10)
+    second = db.list_images(limit=10, cursor=first['next_cursor'])
+    third = db.list_images(limit=10, cursor=second['next_cursor'])
+    assert third == {'ids': [], 'metadatas': [], 'next_cursor': None}
+    assert len(list(db.iter_images(page_size=10))) == 2
+
+
+def test_images_added_between_pages_are_neither_skipped_nor_repeated():
+    add(15)
+    first = db.list_images(limit=10)
+    added = add(5, start=15)
+    second = db.list_images(limit=10, cursor=first['next_cursor'])
+    assert first['ids'] + second['ids'] == [f'image-{i:05d}' for i in range(20)]
+    assert second['ids'][-5:] == added
+
+
+def test_filters_combine_across_pages():
+    add(12, status='pending', before='true')
+    add(12, start=12, status='done', before='false')
+    pending = db.filter_images_by_metadata(item_id=['item-0', 'item-1'], status='pending', before=True)
+    assert pending['ids'] == [f'image-{i:05d}' for i in range(12) if i % 3 != 2]
+    assert all(m['before'] == 'true' and m['status'] == 'pending' for m in pending['metadatas'])
+    assert db.filter_images_by_metadata(status='done', num_results=4)['ids'] == [f'image-{i:05d}' for i in range(12, 16)]
+
+
+def test_a_long_item_id_list_is_one_parameter():
+    add(30)
+    item_ids = [f'unknown-{i}' for i in range(40000)] + ['item-1']
+    found = db.filter_images_by_metadata(item_id=item_ids)['ids']
+    assert found == [f'image-{i:05d}' for i in range(30) if i % 3 == 1]
+
+
+def test_id_lists_longer_than_a_chunk():
+    image_ids = add(1203)
+    unknown = ['unknown-1', 'unknown-2']
+    assert set(db.get_images(image_ids + unknown)) == set(image_ids)
+    assert len(db.get_images(image_ids[:20], chunk_size=7)) == 20
+
+    report = db.update_images_status(image_ids[:1100] + unknown + image_ids[:3], 'matched')
+    assert report['updated'] == image_ids[:1100]
+    assert report['missing'] == unknown
+    assert len(db.filter_images_by_metadata(status='matched')['ids']) == 1100
+
+    db.remove_images(image_ids[:1201])
+    assert db.filter_images_by_metadata()['ids'] == image_ids[1201:]
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from label_cache import HashIndex, LabelCache
+
+pytestmark = pytest.mark.usefixtures('database')
+
+LABEL = {'is_object': True, 'name': 'Lamp'}
+
+
+def worker(**kwargs):
+    return LabelCache(max_distance=6, refresh_seconds=0, **kwargs)
+
+
+def test_hash_index_finds_the_same_hashes_as_a_full_scan():
+    rng = random.Random(0)
+    index = HashIndex(max_distance=6)
+    hashes = {}
+    for entry_id in range(2000):
+        base = rng.getrandbits(64)
+        hashes[entry_id] = base
+        index.add(entry_id, base)
+
+    for entry_id in rng.sample(sorted(hashes), 200):
+        flipped = rng.sample(range(64), rng.randint(0, 8))
+        phash = hashes[entry_id] ^ sum(1 << bit for bit in flipped)
+        expected = {other for other, h in hashes.items() if (phash ^ h).bit_count() <= 6}
+        assert set(index.nearest(phash)) == expected
+
+
+def test_hash_index_orders_matches_by_distance_and_removes_entries():
+    index = HashIndex(max_distance=6)
+    index.add(1, 0b111)
+    index.add(2, 0b1)
+    assert index.nearest(0) == [2, 1]
+    index.remove(2)
+    assert index.nearest(0) == [1]
+    assert len(index) == 1
+
+
+def test_labels_written_by_one_worker_are_seen_by_another():
+    first, second = worker(), worker()
+    assert second.get(0xABCDEF, 'v1') is None
+    first.put(0xABCDEF, 'v1', LABEL)
+    assert second.get(0xABCDEE, 'v1') == LABEL
+    assert second.get(0xABCDEF, 'v2') is None
+
+
+def test_labels_evicted_by_another_worker_are_misses():
+    first, second = worker(max_entries=1), worker(max_entries=1)
+    first.put(0x1, 'v1', LABEL)
+    assert second.get(0x1, 'v1') == LABEL
+    # evicts 0x1 from the table, second still has it in its index
+    first.put(0xFFFF0000FFFF0000, 'v1', LABEL)
+    assert second.get(0x1, 'v1') is None
+    assert second.stats()['entries'] == 1
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+import hyperbolic
+from hyperbolic import TokenBucket
+
+
+class FakeClock:
+    """A clock that only moves when slept on. Rates in the tests keep waits exact in binary."""
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(hyperbolic.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(hyperbolic.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_then_paces_requests(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == []
+
+    started = clock.now
+    for _ in range(4):
+        bucket.acquire()
+    assert clock.now - started == pytest.approx(2.0)
+
+
+def test_token_bucket_refills_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate=4, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+    clock.now += 60
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert sum(clock.slept) == pytest.approx(0.25)
+
+
+def test_token_bucket_without_a_rate_never_waits(clock):
+    bucket = TokenBucket(rate=0, capacity=1)
+    for _ in range(100):
+        bucket.acquire()
+    assert clock.slept == []
+
+
+def entry(index, **details):
+    return {'index': index, 'is_object': True, 'name': f'item {index}', 'description': 'd',
+            'category': 'c', 'price': 1.0, **details}
+
+
+def test_batch_entries_are_matched_by_index_not_position():
+    reply = json.dumps([entry(2), entry(1)])
+    items = hyperbolic.parse_batch_details(reply, 2)
+    assert [item['name'] for item in items] == ['item 1', 'item 2']
+
+
+def test_batch_entries_missing_duplicated_or_out_of_range_are_none():
+    reply = json.dumps([entry(1), entry(3), entry(3), entry(4), entry(0), {'name': 'no index'}])
+    assert hyperbolic.parse_batch_details(reply, 4) == [entry(1), None, None, entry(4)]
+
+
+def test_batch_entries_missing_required_keys_are_rejected():
+    incomplete = entry(1)
+    del incomplete['price']
+    not_an_object = {'index': 2, 'is_object': False}
+    items = hyperbolic.parse_batch_details(json.dumps([incomplete, not_an_object]), 2)
+    assert items == [None, not_an_object]
+
+
+def test_batch_reply_that_is_not_an_array_is_an_error():
+    with pytest.raises(ValueError):
+        hyperbolic.parse_batch_details(json.dumps({'index': 1}), 1)
+
+
+def test_only_images_without_a_valid_batch_entry_are_labeled_one_by_one(monkeypatch):
+    single_calls = []
+    monkeypatch.setattr(hyperbolic, 'get_item_details_from_images', lambda images: json.dumps([entry(1), entry(3)]))
+    monkeypatch.setattr(hyperbolic, 'get_item_details_from_image',
+                        lambda image: single_calls.append(image) or json.dumps(entry(9, name='single')))
+    results = hyperbolic.request_labels(['a', 'b', 'c'], [None, None, None])
+    assert single_calls == ['b']
+    assert [result['name'] for result in results] == ['item 1', 'single', 'item 3']
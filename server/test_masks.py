@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+
+from masks import CompactMask, mask_iou, upsample_masks
+
+
+def disk(size, center, radius):
+    ys, xs = np.mgrid[:size[0], :size[1]]
+    return (ys - center[1]) ** 2 + (xs - center[0]) ** 2 <= radius ** 2
+
+
+def iou(a, b):
+    return np.logical_and(a, b).sum() / np.logical_or(a, b).sum()
+
+
+def test_pack_and_unpack_round_trip():
+    rng = np.random.default_rng(0)
+    full = np.zeros((120, 200), dtype=bool)
+    full[30:70, 45:133] = rng.random((40, 88)) > 0.5
+
+    mask = CompactMask(full[20:90, 40:150], 40, 20, full.shape)
+
+    assert mask.bbox == (45, 30, 132, 69)
+    assert mask.nbytes < full[30:70, 45:133].nbytes
+    assert np.array_equal(mask.to_array(), full)
+    assert np.array_equal(mask.crop(50, 25, 100, 60), full[25:60, 50:100])
+
+
+def test_empty_mask():
+    mask = CompactMask(np.zeros((10, 10), dtype=bool), 5, 5, (50, 50))
+    assert mask.bbox is None
+    assert not mask.to_array().any()
+    assert mask_iou(mask, mask) == 1.0
+
+
+def test_mask_iou():
+    a = CompactMask(disk((100, 100), (40, 50), 20), 0, 0, (100, 100))
+    b = CompactMask(disk((100, 100), (50, 50), 20), 0, 0, (100, 100))
+    far = CompactMask(disk((100, 100), (90, 90), 5), 0, 0, (100, 100))
+    assert mask_iou(a, a) == 1.0
+    assert mask_iou(a, far) == 0.0
+    assert abs(mask_iou(a, b) - iou(a.to_array(), b.to_array())) < 1e-9
+
+
+def test_upsampled_masks_match_sam_dense_postprocessing():
+    image_size = (600, 800)
+    reshaped_size = (768, 1024)
+    # low resolution logits, positive inside two disks of SAM's padded input
+    ys, xs = np.mgrid[:256, :256]
+    logits = np.stack([
+        20.0 - np.hypot(xs - 80, ys - 90),
+        12.0 - np.hypot(xs - 200, ys - 40),
+    ]).astype(np.float32)
+
+    masks = upsample_masks(logits, image_size, reshaped_size, scores=[0.9, 0.8])
+
+    for mask, low in zip(masks, logits):
+        # what SAM's post_process_masks does: upsample to the padded input,
+        # crop the image, resize to the image size, threshold
+        padded = cv2.resize(low, (1024, 1024), interpolation=cv2.INTER_LINEAR)
+        dense = cv2.resize(padded[:reshaped_size[0], :reshaped_size[1]], image_size[::-1], interpolation=cv2.INTER_LINEAR) > 0
+        assert iou(mask.to_array(), dense) > 0.97
+    assert [mask.score for mask in masks] == [0.9, 0.8]
+
+
+def test_crop_scaled_matches_a_mask_upsampled_to_full_resolution():
+    proxy = disk((100, 150), (70, 50), 30)
+    mask = CompactMask(proxy, 0, 0, proxy.shape)
+    full = cv2.resize(proxy.astype(np.uint8) * 255, (600, 400), interpolation=cv2.INTER_LINEAR) > 127
+
+    assert iou(mask.crop_scaled(0, 0, 600, 400, 4.0), full) > 0.97
+    assert iou(mask.crop_scaled(160, 80, 400, 320, 4.0), full[80:320, 160:400]) > 0.97
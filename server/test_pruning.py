@@ -0,0 +1,57 @@
+import numpy as np
+
+import pruning
+from masks import CompactMask
+
+
+def box_mask(image_size, x_min, y_min, x_max, y_max, score):
+    mask = np.zeros(image_size, dtype=bool)
+    mask[y_min:y_max, x_min:x_max] = True
+    return CompactMask(mask, 0, 0, image_size, score)
+
+
+def test_prune_detections_rules():
+    boxes = [
+        [10, 10, 110, 110],  # kept
+        [200, 200, 300, 300],  # a person
+        [10, 10, 40, 40],  # too small
+        [0, 0, 990, 990],  # the whole room
+        [500, 500, 600, 600],  # kept, at the detector's own confidence
+    ]
+    keep = pruning.prune_detections(
+        boxes,
+        confidences=[0.9, 0.9, 0.9, 0.9, 0.01],
+        class_ids=[56, 0, 56, 56, 56],
+        class_names=['chair', 'person', 'chair', 'chair', 'chair'],
+        image_size=(1000, 1000),
+    )
+    assert keep.tolist() == [0, 4]
+
+
+def test_box_size_is_compared_at_full_resolution():
+    boxes = [[10, 10, 40, 40]]
+    args = dict(confidences=[0.9], class_ids=[56], class_names=None, image_size=(500, 500))
+    assert pruning.prune_detections(boxes, **args).tolist() == []
+    # 30 proxy pixels are 60 pixels of the full image
+    assert pruning.prune_detections(boxes, scale=2.0, **args).tolist() == [0]
+
+
+def test_duplicate_masks_across_a_tile_seam_keep_the_best_score():
+    size = (400, 1200)
+    masks = [
+        box_mask(size, 600, 100, 700, 200, 0.8),  # detected in the left tile
+        box_mask(size, 100, 100, 200, 200, 0.95),
+        box_mask(size, 602, 101, 701, 200, 0.9),  # the same item from the right tile
+        box_mask(size, 900, 100, 1000, 200, 0.5),  # poor SAM score
+    ]
+    assert pruning.prune_masks(masks) == [1, 2]
+
+
+def test_mask_iou_matrix_is_close_to_exact_iou():
+    size = (300, 300)
+    a = box_mask(size, 0, 0, 150, 150, None)
+    b = box_mask(size, 50, 50, 200, 200, None)
+    exact = (100 * 100) / (2 * 150 * 150 - 100 * 100)
+    ious = pruning.mask_iou_matrix([a, b])
+    assert np.allclose(np.diag(ious), 1.0)
+    assert abs(ious[0, 1] - exact) < 0.02
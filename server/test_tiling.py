@@ -0,0 +1,59 @@
+import numpy as np
+import supervision as sv
+from PIL import Image
+
+import tiling
+
+
+def detections(*boxes):
+    return sv.Detections(
+        xyxy=np.array(boxes, dtype=float),
+        confidence=np.full(len(boxes), 0.9),
+        class_id=np.zeros(len(boxes), dtype=int),
+    )
+
+
+def test_tiles_cover_the_image_and_stay_inside_it():
+    windows = tiling.tile_windows((2000, 700), tile_size=640, overlap=0.2)
+    covered = np.zeros((700, 2000), dtype=bool)
+    for x_min, y_min, x_max, y_max in windows:
+        assert 0 <= x_min < x_max <= 2000 and 0 <= y_min < y_max <= 700
+        assert x_max - x_min == 640 and y_max - y_min == 640
+        covered[y_min:y_max, x_min:x_max] = True
+    assert covered.all()
+    # the last column and row are flush with the edges
+    assert max(w[2] for w in windows) == 2000 and max(w[3] for w in windows) == 700
+
+
+def test_small_images_are_a_single_tile():
+    assert tiling.tile_windows((500, 300), tile_size=640) == [(0, 0, 500, 300)]
+
+
+def test_should_tile_modes():
+    assert not tiling.should_tile((2000, 1000), mode='auto', tile_size=640, min_side=2400)
+    assert tiling.should_tile((4000, 1000), mode='auto', tile_size=640, min_side=2400)
+    assert tiling.should_tile((700, 500), mode='on', tile_size=640)
+    assert not tiling.should_tile((8000, 1000), mode='off')
+
+
+def test_plan_adds_a_full_image_pass_to_tiled_images():
+    small, large = Image.new('RGB', (400, 300)), Image.new('RGB', (1200, 640))
+    inputs = tiling.plan([small, large], mode='on', tile_size=640, overlap=0.2)
+    offsets = [(index, offset) for index, _, offset in inputs]
+    assert offsets[0] == (0, (0, 0))
+    assert [offset for index, offset in offsets if index == 1] == [(0, 0), (512, 0), (560, 0), (0, 0)]
+    assert inputs[-1][1] is large
+
+
+def test_merge_joins_an_item_detected_in_two_overlapping_tiles():
+    merged = tiling.merge([
+        # the item at x 560..620 of the image, seen by the tiles starting at 0 and 512
+        (detections([560, 100, 620, 160], [10, 10, 60, 60]), (0, 0)),
+        (detections([48, 100, 108, 160]), (512, 0)),
+        (sv.Detections.empty(), (560, 0)),
+    ], nms_threshold=0.5)
+    assert sorted(merged.xyxy.tolist()) == [[10, 10, 60, 60], [560, 100, 620, 160]]
+
+
+def test_merge_of_no_detections_is_empty():
+    assert len(tiling.merge([(sv.Detections.empty(), (0, 0))], nms_threshold=0.5)) == 0
@@ -0,0 +1,61 @@
+import numpy as np
+import supervision as sv
+
+import tracking
+
+FRAME = np.zeros((480, 640, 3), dtype=np.uint8)
+
+
+def detections(*boxes, confidence=0.9):
+    if not boxes:
+        return sv.Detections.empty()
+    return sv.Detections(
+        xyxy=np.array(boxes, dtype=float),
+        confidence=np.full(len(boxes), confidence),
+        class_id=np.zeros(len(boxes), dtype=int),
+    )
+
+
+def run(sequence):
+    frames = [FRAME] * len(sequence)
+    calls = iter(sequence)
+    return tracking.best_views(frames, lambda frame: next(calls))
+
+
+def test_item_moving_across_keyframes_gets_one_view():
+    views = run([
+        detections([100, 100, 200, 200]),
+        detections([110, 100, 210, 200]),
+        detections([120, 100, 220, 200]),
+    ])
+    assert sum(len(boxes) for boxes in views.values()) == 1
+
+
+def test_item_seen_in_a_single_later_keyframe_is_kept():
+    views = run([
+        detections([100, 100, 200, 200]),
+        detections(),
+        detections([400, 300, 500, 400]),
+        detections(),
+    ])
+    assert views == {0: [[100, 100, 200, 200]], 2: [[400, 300, 500, 400]]}
+
+
+def test_item_confirmed_after_its_first_keyframe_is_not_duplicated():
+    views = run([
+        detections(),
+        detections([300, 200, 360, 260]),
+        detections([302, 200, 362, 260], [10, 10, 200, 200]),
+    ])
+    boxes = sorted(box for frame_boxes in views.values() for box in frame_boxes)
+    assert boxes == [[10, 10, 200, 200], [302, 200, 362, 260]]
+
+
+def test_item_lost_for_a_keyframe_keeps_its_track():
+    views = run([
+        detections([100, 100, 200, 200]),
+        detections([102, 100, 202, 200]),
+        detections(),
+        detections([104, 100, 204, 200]),
+    ])
+    assert sum(len(boxes) for boxes in views.values()) == 1
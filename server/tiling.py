@@ -0,0 +1,151 @@
+"""
+Sliced detection for images much larger than the detector's input.
+
+YOLO downsizes every image to 640 px, so on a wide panorama small items
+vanish. Large images are cut into overlapping tiles that are detected as
+one batch, together with a pass over the whole image for items larger than
+a tile, and the boxes are merged across tile borders with NMS.
+
+DETECTION_TILING:
+- auto (default): tile images whose longest side exceeds DETECTION_TILE_MIN_SIDE
+- on: tile every image larger than one tile
+- off: always detect on the whole image
+"""
+import os
+import threading
+import time
+
+import supervision as sv
+
+DETECTION_TILING = os.getenv("DETECTION_TILING", "auto")
+DETECTION_TILE_SIZE = int(os.getenv("DETECTION_TILE_SIZE", 640))
+DETECTION_TILE_OVERLAP = float(os.getenv("DETECTION_TILE_OVERLAP", 0.2))
+DETECTION_TILE_MIN_SIDE = int(os.getenv("DETECTION_TILE_MIN_SIDE", 2400))
+# Tiles per YOLO forward pass
+DETECTION_TILE_BATCH = int(os.getenv("DETECTION_TILE_BATCH", 8))
+DETECTION_TILE_FULL_PASS = os.getenv("DETECTION_TILE_FULL_PASS", "1") == "1"
+
+counters = {'images': 0, 'tiled_images': 0, 'detector_inputs': 0, 'seconds': 0.0}
+counters_lock = threading.Lock()
+
+
+def should_tile(image_size, mode=DETECTION_TILING, tile_size=DETECTION_TILE_SIZE, min_side=DETECTION_TILE_MIN_SIDE):
+    """Whether an image of (width, height) is detected tile by tile."""
+    longest = max(image_size)
+    if mode == 'on':
+        return longest > tile_size
+    if mode == 'auto':
+        return longest > max(min_side, tile_size)
+    return False
+
+
+def axis_starts(length, tile, step):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, step))
+    # the last tile is flush with the edge instead of running past it
+    return starts + [length - tile]
+
+
+def tile_windows(image_size, tile_size=DETECTION_TILE_SIZE, overlap=DETECTION_TILE_OVERLAP):
+    """
+    Cover an image with overlapping square tiles.
+
+    Args:
+        image_size (tuple): (width, height) of the image.
+        tile_size (int): Side of a tile in pixels.
+        overlap (float): Fraction of a tile shared with its neighbour.
+
+    Returns:
+        list: (x_min, y_min, x_max, y_max) windows.
+    """
+    width, height = image_size
+    step = max(1, int(tile_size * (1 - overlap)))
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in axis_starts(height, tile_size, step)
+        for x in axis_starts(width, tile_size, step)
+    ]
+
+
+def plan(images, mode=DETECTION_TILING, tile_size=DETECTION_TILE_SIZE, overlap=DETECTION_TILE_OVERLAP):
+    """
+    List the detector inputs for a batch of PIL images.
+
+    Returns:
+        list: (image index, PIL.Image, (x_offset, y_offset)) per detector input.
+    """
+    inputs = []
+    for index, image in enumerate(images):
+        if not should_tile(image.size, mode, tile_size):
+            inputs.append((index, image, (0, 0)))
+            continue
+        windows = tile_windows(image.size, tile_size, overlap)
+        inputs += [(index, image.crop(window), window[:2]) for window in windows]
+        if DETECTION_TILE_FULL_PASS:
+            inputs.append((index, image, (0, 0)))
+    return inputs
+
+
+def merge(parts, nms_threshold):
+    """
+    Merge the detections of the tiles of one image into image coordinates.
+
+    Args:
+        parts (list): (sv.Detections, (x_offset, y_offset)) per detector input.
+        nms_threshold (float): IoU above which overlapping boxes are merged.
+
+    Returns:
+        sv.Detections
+    """
+    shifted = []
+    for detections, (x_offset, y_offset) in parts:
+        if len(detections):
+            detections.xyxy = detections.xyxy + [x_offset, y_offset, x_offset, y_offset]
+            shifted.append(detections)
+    if not shifted:
+        return sv.Detections.empty()
+    return sv.Detections.merge(shifted).with_nms(threshold=nms_threshold, class_agnostic=True)
+
+
+def detect_tiled(model, images, nms_threshold, conf, batch_size=DETECTION_TILE_BATCH, **options):
+    """
+    Detect objects on a batch of PIL images, slicing the large ones.
+
+    Args:
+        model: Loaded ultralytics YOLO model.
+        images (list): PIL images.
+        nms_threshold (float): Class agnostic NMS IoU threshold.
+        conf (float): Detector confidence threshold.
+        batch_size (int): Detector inputs per forward pass.
+        options: mode, tile_size and overlap overrides for plan.
+
+    Returns:
+        list: sv.Detections per image, in image coordinates.
+    """
+    started = time.perf_counter()
+    inputs = plan(images, **options)
+    parts = [[] for _ in images]
+    for start in range(0, len(inputs), batch_size):
+        chunk = inputs[start:start + batch_size]
+        results = model([image for _, image, _ in chunk], conf=conf)
+        for (index, _, offset), result in zip(chunk, results):
+            parts[index].append((sv.Detections.from_ultralytics(result), offset))
+
+    with counters_lock:
+        counters['images'] += len(images)
+        counters['tiled_images'] += sum(1 for image_parts in parts if len(image_parts) > 1)
+        counters['detector_inputs'] += len(inputs)
+        counters['seconds'] += time.perf_counter() - started
+    return [merge(image_parts, nms_threshold) for image_parts in parts]
+
+
+def stats():
+    with counters_lock:
+        return {
+            'mode': DETECTION_TILING,
+            'tile_size': DETECTION_TILE_SIZE,
+            'overlap': DETECTION_TILE_OVERLAP,
+            **counters,
+            'seconds': round(counters['seconds'], 3),
+        }
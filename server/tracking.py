@@ -0,0 +1,110 @@
+"""
+Panorama-free video processing: detect items on the keyframes of a video,
+link the detections across frames with ByteTrack, and keep only the best
+view of every tracked item for segmentation and labeling.
+
+Keyframes are taken more densely than for stitching (TRACK_MIN_MOTION of the
+frame width apart) so that consecutive boxes of an item still overlap enough
+for the tracker to match them.
+"""
+import os
+
+import numpy as np
+import supervision as sv
+
+TRACK_MIN_MOTION = float(os.getenv("TRACK_MIN_MOTION", 0.08))
+TRACK_FRAME_BUDGET = int(os.getenv("TRACK_FRAME_BUDGET", 48))
+TRACK_ACTIVATION_THRESHOLD = float(os.getenv("TRACK_ACTIVATION_THRESHOLD", 0.1))
+# Keyframes a lost track is kept for in case the item shows up again
+TRACK_LOST_BUFFER = int(os.getenv("TRACK_LOST_BUFFER", 5))
+TRACK_MATCHING_THRESHOLD = float(os.getenv("TRACK_MATCHING_THRESHOLD", 0.8))
+
+
+def view_score(box, confidence, frame_size):
+    """
+    Rank views of the same item: a view cut off by the frame edge is worse
+    than any complete view, then larger and more confident views are better.
+    """
+    height, width = frame_size
+    x_min, y_min, x_max, y_max = box
+    complete = x_min > 1 and y_min > 1 and x_max < width - 2 and y_max < height - 2
+    return (complete, float((x_max - x_min) * (y_max - y_min) * confidence))
+
+
+def untracked(detections, tracked):
+    """Indices of the detections the tracker did not return, it returns their boxes unchanged."""
+    return [
+        i for i, box in enumerate(detections.xyxy)
+        if not any(np.array_equal(box, other) for other in tracked.xyxy)
+    ]
+
+
+def best_views(frames, detect):
+    """
+    Track detections across frames and pick the best view of every track.
+
+    ByteTrack only confirms a new track when it is matched again in the next
+    keyframe. A detection left without a track is kept as a pending view: if a
+    track is confirmed on it in the next keyframe the view counts for that
+    track, otherwise it is an item seen in a single keyframe and kept as is.
+
+    Args:
+        frames (list): RGB frames in video order.
+        detect (callable): Maps an RGB frame to pruned sv.Detections.
+
+    Returns:
+        dict: Frame index -> list of [x_min, y_min, x_max, y_max] boxes to
+        segment in that frame, one box per tracked item.
+    """
+    # supervision scales the lost buffer by frame_rate / 30, so at 30 it counts keyframes.
+    # sv.ByteTrack is removed in supervision 0.31, requirements.txt pins below it
+    tracker = sv.ByteTrack(
+        track_activation_threshold=TRACK_ACTIVATION_THRESHOLD,
+        lost_track_buffer=TRACK_LOST_BUFFER,
+        minimum_matching_threshold=TRACK_MATCHING_THRESHOLD,
+        frame_rate=30,
+    )
+    # detections below this never start a track, ByteTrack adds 0.1 to the activation threshold
+    start_threshold = getattr(tracker, 'det_thresh', TRACK_ACTIVATION_THRESHOLD)
+
+    best = {}  # tracker id -> (score, frame index, box)
+    singles = []  # (score, frame index, box) of items seen in a single keyframe
+    pending = []  # (score, frame index, box) of the previous keyframe's detections without a track
+    detections_seen = 0
+    for index, frame in enumerate(frames):
+        detections = detect(frame)
+        detections_seen += len(detections)
+        tracked = tracker.update_with_detections(detections)
+
+        new_tracks = []
+        for box, confidence, tracker_id in zip(tracked.xyxy, tracked.confidence, tracked.tracker_id):
+            score = view_score(box, confidence, frame.shape[:2])
+            if tracker_id not in best:
+                new_tracks.append(tracker_id)
+            if tracker_id not in best or score > best[tracker_id][0]:
+                best[tracker_id] = (score, index, box.tolist())
+
+        # a track confirmed now started on one of the previous keyframe's pending views
+        for tracker_id in new_tracks:
+            if not pending:
+                break
+            box = np.array([best[tracker_id][2]])
+            ious = sv.box_iou_batch(box, np.array([view[2] for view in pending]))[0]
+            match = int(np.argmax(ious))
+            if ious[match] > 0:
+                view = pending.pop(match)
+                best[tracker_id] = max(best[tracker_id], view, key=lambda v: v[0])
+        singles += pending
+
+        pending = [
+            (view_score(detections.xyxy[i], detections.confidence[i], frame.shape[:2]), index, detections.xyxy[i].tolist())
+            for i in untracked(detections, tracked)
+            if detections.confidence[i] >= start_threshold
+        ]
+    singles += pending
+
+    views = {}
+    for _, index, box in list(best.values()) + singles:
+        views.setdefault(index, []).append(box)
+    print(f"Tracked {len(best) + len(singles)} items across {len(frames)} keyframes ({detections_seen} detections)")
+    return {index: views[index] for index in sorted(views)}
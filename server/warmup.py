@@ -0,0 +1,153 @@
+"""
+Staged startup of the heavy subsystems behind the API.
+
+Importing server.py only sets up Flask, so lightweight endpoints answer right
+away. Each subsystem below is loaded once, on first use or by the background
+warm-up, and /ready reports which ones are warm.
+
+WARMUP_MODE:
+- background (default): start loading everything in a thread at startup
+- lazy: load each subsystem the first time a request needs it
+- eager: load everything before the app starts serving
+"""
+import os
+import threading
+import time
+import traceback
+
+WARMUP_MODE = os.getenv("WARMUP_MODE", "background")
+
+
+class Subsystem:
+    """A part of the backend that is slow to initialise and loaded once."""
+
+    def __init__(self, name, loader, optional=False):
+        self.name = name
+        self.loader = loader
+        self.optional = optional
+        self.lock = threading.Lock()
+        self.state = 'cold'
+        self.value = None
+        self.error = None
+        self.seconds = None
+
+    def load(self):
+        """Load the subsystem if needed and return it. Concurrent callers wait for the first."""
+        if self.state == 'ready':
+            return self.value
+
+        with self.lock:
+            if self.state == 'ready':
+                return self.value
+
+            self.state = 'loading'
+            started = time.perf_counter()
+            try:
+                self.value = self.loader()
+                self.state = 'ready'
+                self.error = None
+            except Exception as e:
+                # failed subsystems are retried by the next caller
+                self.state = 'failed'
+                self.error = str(e)
+                raise
+            finally:
+                self.seconds = round(time.perf_counter() - started, 3)
+                print(f"Subsystem {self.name} {self.state} after {self.seconds}s")
+        return self.value
+
+    def status(self):
+        return {
+            'state': self.state,
+            'optional': self.optional,
+            'seconds': self.seconds,
+            'error': self.error,
+        }
+
+
+def load_database():
+    import db
+    db.initialize_database()
+    return db
+
+
+def load_vector_store():
+    # the image listings read SQLite, so they require this subsystem to be sure
+    # the metadata of older images has been copied over from Chroma first
+    require('database')
+    import chroma
+    chroma.get_collection()
+    chroma.migrate_metadata_to_sqlite()
+    return chroma
+
+
+def load_embeddings():
+    import image_embedding
+    image_embedding.get_embedding_function()
+    return image_embedding
+
+
+def load_models():
+    import predict
+    predict.ensure_models()
+    return predict
+
+
+def load_blockchain():
+    import blockchain
+    blockchain.get_xrpl_helper()
+    return blockchain
+
+
+def load_pipeline():
+    require('database')
+    require('vector_store')
+    require('models')
+    require('embeddings')
+    import ml
+    return ml
+
+
+# Ordered so that the cheap subsystems are warm first
+SUBSYSTEMS = {
+    'database': Subsystem('database', load_database),
+    'vector_store': Subsystem('vector_store', load_vector_store),
+    'embeddings': Subsystem('embeddings', load_embeddings),
+    'models': Subsystem('models', load_models),
+    'pipeline': Subsystem('pipeline', load_pipeline),
+    'blockchain': Subsystem('blockchain', load_blockchain, optional=True),
+}
+
+
+def require(name):
+    """Return the loaded module of a subsystem, loading it first if needed."""
+    return SUBSYSTEMS[name].load()
+
+
+def warm_up():
+    """Load every subsystem in order, carrying on past failures."""
+    for subsystem in SUBSYSTEMS.values():
+        try:
+            subsystem.load()
+        except Exception:
+            traceback.print_exc()
+
+
+def start(mode=WARMUP_MODE):
+    """Begin warming up according to the startup mode."""
+    if mode == 'eager':
+        warm_up()
+    elif mode == 'background':
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+def readiness():
+    """
+    Return whether every required subsystem is warm, and the status of each.
+
+    Returns:
+        (bool, dict): Readiness and per-subsystem status.
+    """
+    statuses = {name: subsystem.status() for name, subsystem in SUBSYSTEMS.items()}
+    ready = all(s['state'] == 'ready' for s in statuses.values() if not s['optional'])
+    return ready, statuses